@@ -0,0 +1,54 @@
+import time
+import argparse
+
+import torch
+
+from models.wrn_prime import WideResNet
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.device import setup_model, to_device, bf16_supported
+
+parser = argparse.ArgumentParser(description='CPU inference throughput of WideResNet in fp32 and bf16',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--num_classes', type=int, default=10)
+parser.add_argument('--test_bs', type=int, default=200)
+parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+parser.add_argument('--repeats', type=int, default=10)
+args = parser.parse_args()
+
+device = torch.device('cpu')
+data = torch.randn(args.test_bs, 3, 32, 32)
+settings = [('fp32', False, False), ('fp32 channels_last', True, False)]
+if bf16_supported(device):
+    settings += [('bf16', False, True), ('bf16 channels_last', True, True)]
+
+
+def throughput(net):
+    with torch.inference_mode():
+        ref = net(to_device(data, net))[0]
+        begin = time.time()
+        for _ in range(args.repeats):
+            net(to_device(data, net))
+    return args.repeats * args.test_bs / (time.time() - begin), ref
+
+
+print('WRN-{}-{} | batch {}'.format(args.layers, args.widen_factor, args.test_bs))
+for threads in args.threads:
+    torch.set_num_threads(threads)
+    base = None
+    for name, channels_last, bf16 in settings:
+        # same weights for every setting
+        torch.manual_seed(1)
+        net = WideResNet(args.layers, args.num_classes, args.widen_factor, dropRate=0).eval()
+        net = setup_model(net, device, channels_last=channels_last, bf16=bf16)
+        images_per_s, logits = throughput(net)
+        if base is None:
+            base = (images_per_s, logits)
+        print('threads {:3d} | {:<20} {:8.1f} images/s | {:5.2f}x | max logit diff {:.2e}'.format(
+            threads, name, images_per_s, images_per_s / base[0], float((logits - base[1]).abs().max())))
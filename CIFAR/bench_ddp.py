@@ -0,0 +1,80 @@
+import os
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from models.wrn_prime import WideResNet
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.distributed import wrap_ddp
+
+parser = argparse.ArgumentParser(description='Images/s of data-parallel SR tuning steps (CE + L1 sparsity, as in '
+                                             'tune.py) on the CPU with 1, 2, 4 ... gloo processes and a fixed global batch',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4], help='Process counts to compare.')
+parser.add_argument('--cores', type=int, default=os.cpu_count(), help='CPU cores shared by the processes of a run.')
+parser.add_argument('--batch_size', '-b', type=int, default=128, help='Global batch size.')
+parser.add_argument('--steps', type=int, default=20, help='Training steps timed per setting.')
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--alpha', type=float, default=0.02, help='weight of the L1 term.')
+parser.add_argument('--port', type=int, default=29511, help='MASTER_PORT of the process groups.')
+args = parser.parse_args()
+
+
+def worker(rank, world_size, results):
+    # the environment torchrun would set up
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(args.cores // world_size, 1))
+    torch.manual_seed(rank)
+
+    net = wrap_ddp(WideResNet(args.layers, 10, args.widen_factor, dropRate=0.3), torch.device('cpu'))
+    optimizer = torch.optim.SGD(net.parameters(), 0.001, momentum=0.9, nesterov=True)
+    batch_size = args.batch_size // world_size
+    data, target = torch.randn(batch_size, 3, 32, 32), torch.randint(0, 10, (batch_size,))
+
+    def step():
+        x, vector_feature = net(data)
+        loss = F.cross_entropy(x, target) + args.alpha * vector_feature.abs().sum(1).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step()
+    dist.barrier()
+    begin = time.time()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    if rank == 0:
+        results.put(args.steps * batch_size * world_size / (time.time() - begin))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(args.port)
+    # forked workers inherit the parsed arguments and the imports above
+    ctx = mp.get_context('fork')
+
+    print('WRN-{}-{} SR tuning step | global batch {} | {} CPU cores | gloo'.format(
+        args.layers, args.widen_factor, args.batch_size, args.cores))
+    print('{:>10}{:>18}{:>12}{:>12}{:>14}'.format('processes', 'threads/process', 'img/s', 'speedup', 'efficiency'))
+    first = None
+    for world_size in args.procs:
+        results = ctx.SimpleQueue()
+        mp.start_processes(worker, args=(world_size, results), nprocs=world_size, start_method='fork')
+        throughput = results.get()
+        # speedup and parallel efficiency relative to the first process count
+        first = first or (world_size, throughput)
+        speedup = throughput / first[1]
+        print('{:>10}{:>18}{:>12.1f}{:>12.2f}{:>14.2f}'.format(
+            world_size, max(args.cores // world_size, 1), throughput, speedup, speedup * first[0] / world_size))
@@ -0,0 +1,105 @@
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+import torchvision.datasets as dset
+import torchvision.transforms as trn
+
+from models.wrn_prime import WideResNet
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.device import add_device_args, get_device, setup_model, to_device
+    from utils.tensor_cifar import TensorCIFAR, TensorLoader
+
+parser = argparse.ArgumentParser(description='Images/s of the CIFAR training input pipelines: torchvision DataLoader '
+                                             'vs in-memory tensor batches (--tensor_data), alone and with a training step',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--dataset', type=str, default='cifar10', choices=['cifar10', 'cifar100'])
+parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
+parser.add_argument('--batch_size', '-b', type=int, default=128, help='Batch size.')
+parser.add_argument('--batches', type=int, default=50, help='Batches timed per setting.')
+parser.add_argument('--prefetch', type=int, nargs='+', default=[0, 4], help='DataLoader worker counts to compare.')
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--no_train', action='store_true', help='Only time the input pipelines.')
+parser.add_argument('--ngpu', type=int, default=1, help='0 = CPU.')
+add_device_args(parser)
+args = parser.parse_args()
+
+device = get_device(args)
+
+if args.machine == 'acm':
+    cifar_path = '/opt/data/private/ood/data/cifar'
+
+if args.machine == 'local':
+    cifar_path = '/data1/church/ood/data/cifar'
+
+# mean and standard deviation of channels of CIFAR-10 images
+mean = [x / 255 for x in [125.3, 123.0, 113.9]]
+std = [x / 255 for x in [63.0, 62.1, 66.7]]
+train_transform = trn.Compose([trn.RandomHorizontalFlip(), trn.RandomCrop(32, padding=4),
+                               trn.ToTensor(), trn.Normalize(mean, std)])
+
+cifar = dset.CIFAR10 if args.dataset == 'cifar10' else dset.CIFAR100
+num_classes = 10 if args.dataset == 'cifar10' else 100
+train_data = cifar(cifar_path, train=True, transform=train_transform)
+
+loaders = [('DataLoader, {} workers'.format(workers),
+            torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=True, num_workers=workers,
+                                        pin_memory=device.type == 'cuda', drop_last=True))
+           for workers in args.prefetch]
+loaders.append(('tensor_data', TensorLoader(TensorCIFAR(train_data, mean, std, device), args.batch_size, shuffle=True,
+                                            flip=True, crop_padding=4, drop_last=True)))
+
+net, optimizer = None, None
+if not args.no_train:
+    torch.manual_seed(1)
+    net = setup_model(WideResNet(args.layers, num_classes, args.widen_factor, dropRate=0.3), device, args.ngpu,
+                      args.channels_last)
+    optimizer = torch.optim.SGD(net.parameters(), 0.1, momentum=0.9, nesterov=True)
+
+
+def step(data, target):
+    data, target = to_device(data, net), target.to(device)
+    loss = F.cross_entropy(net(data)[0], target)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def throughput(loader, train):
+    batches = iter(loader)
+    # the first batch starts the workers
+    next(batches)
+    sync()
+    begin, count = time.time(), 0
+    for data, target in batches:
+        if train:
+            step(data, target)
+        else:
+            data.to(device).float().sum().item()
+        count += len(target)
+        if count >= args.batches * args.batch_size:
+            break
+    sync()
+    return count / (time.time() - begin)
+
+
+print('{} training set | batch {} | device {}{}'.format(args.dataset, args.batch_size, device,
+                                                       '' if args.no_train else ' | WRN-{}-{} training step'.format(
+                                                           args.layers, args.widen_factor)))
+print('{:<26}{:>16}{:>16}'.format('input pipeline', 'loading img/s', 'training img/s'))
+for name, loader in loaders:
+    loading = throughput(loader, False)
+    training = throughput(loader, True) if not args.no_train else float('nan')
+    print('{:<26}{:>16.1f}{:>16.1f}'.format(name, loading, training))
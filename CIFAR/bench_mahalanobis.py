@@ -0,0 +1,60 @@
+import time
+import argparse
+
+import torch
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.score_calculation import class_gaussian_terms, gaussian_scores
+
+parser = argparse.ArgumentParser(description='Benchmarks the batched Mahalanobis scorer against the per-class loop',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--test_bs', type=int, default=200)
+parser.add_argument('--dim', type=int, default=128, help='feature dimension (128 for WRN-40-2).')
+parser.add_argument('--num_classes', type=int, nargs='+', default=[10, 100])
+parser.add_argument('--repeats', type=int, default=20)
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+
+
+def loop_scores(features, class_mean, precision):
+    # the original implementation: one B x B product per class, grown with torch.cat
+    for i in range(class_mean.size(0)):
+        zero_f = features - class_mean[i]
+        term_gau = -0.5*torch.mm(torch.mm(zero_f, precision), zero_f.t()).diag()
+        if i == 0:
+            gaussian_score = term_gau.view(-1,1)
+        else:
+            gaussian_score = torch.cat((gaussian_score, term_gau.view(-1,1)), 1)
+    return gaussian_score
+
+
+def timeit(fn):
+    fn()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    begin = time.time()
+    for _ in range(args.repeats):
+        out = fn()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - begin) / args.repeats, out
+
+
+torch.manual_seed(1)
+print('batch {} | dim {} | device {}'.format(args.test_bs, args.dim, args.device))
+for num_classes in args.num_classes:
+    features = torch.rand(args.test_bs, args.dim, device=args.device)
+    class_mean = torch.rand(num_classes, args.dim, device=args.device)
+    a = torch.randn(4 * args.dim, args.dim, device=args.device)
+    precision = torch.inverse(torch.mm(a.t(), a) / a.size(0))
+
+    t_loop, ref = timeit(lambda: loop_scores(features, class_mean, precision))
+    t_batch, out = timeit(lambda: gaussian_scores(features, precision, *class_gaussian_terms(class_mean, precision)))
+
+    print('classes {:3d} | loop {:8.3f} ms | batched {:8.3f} ms | speedup {:6.1f}x | max rel diff {:.2e}'.format(
+        num_classes, 1000 * t_loop, 1000 * t_batch, t_loop / t_batch,
+        float(((out - ref).abs() / ref.abs().clamp(min=1e-6)).max())))
@@ -0,0 +1,100 @@
+import os
+import argparse
+
+import torch
+import numpy as np
+import torchvision.datasets as dset
+import torchvision.transforms as trn
+
+from models.wrn_prime import WideResNet
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    import utils.score_calculation as lib
+    from utils.display_results import recall_level_default
+    from utils.ood_scheduler import run_datasets
+    from utils.detector import EnergyDetector, energy_threshold, export_detector, load_detector
+    from utils.checkpoint import load_model_state
+
+parser = argparse.ArgumentParser(description='Exports a WideResNet energy detector (normalization, energy head and '
+                                             'threshold in one graph) and checks it against the energy scores of test.py',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('model_path', type=str, help='checkpoint (state_dict) of a models/wrn_prime.py WideResNet.')
+parser.add_argument('--out', type=str, nargs='+', default=['./detector.pt'],
+                    help='Exported files: .pt for TorchScript, .onnx for ONNX.')
+parser.add_argument('--dataset', type=str, default='cifar10', choices=['cifar10', 'cifar100'])
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
+parser.add_argument('--T', default=1., type=float, help='temperature of the energy score')
+parser.add_argument('--threshold', type=float, default=None,
+                    help='energy threshold (default: keep recall_level of the in-distribution test set).')
+parser.add_argument('--recall_level', type=float, default=recall_level_default)
+parser.add_argument('--parity_size', type=int, default=1000, help='Test images used for the parity check.')
+parser.add_argument('--atol', type=float, default=1e-3, help='Largest energy difference accepted by the parity check.')
+parser.add_argument('--test_bs', type=int, default=200)
+parser.add_argument('--prefetch', type=int, default=2, help='Pre-fetching threads.')
+parser.add_argument('--threads', type=int, default=0, help='Intra-op CPU threads (0 = torch default).')
+args = parser.parse_args()
+print(args)
+
+# mean and standard deviation of channels of CIFAR-10 images
+mean = [x / 255 for x in [125.3, 123.0, 113.9]]
+std = [x / 255 for x in [63.0, 62.1, 66.7]]
+test_transform = trn.Compose([trn.ToTensor(), trn.Normalize(mean, std)])
+
+if args.machine == 'acm':
+    cifar_path = '/opt/data/private/ood/data/cifar'
+
+if args.machine == 'local':
+    cifar_path = '/data1/church/ood/data/cifar'
+
+cifar = dset.CIFAR10 if args.dataset == 'cifar10' else dset.CIFAR100
+num_classes = 10 if args.dataset == 'cifar10' else 100
+test_data = cifar(cifar_path, train=False, transform=test_transform)
+# the exported graph normalizes its input itself
+raw_data = cifar(cifar_path, train=False, transform=trn.ToTensor())
+
+net = WideResNet(args.layers, num_classes, args.widen_factor, dropRate=0)
+net.load_state_dict(load_model_state(args.model_path))
+net.eval()
+
+# reference: the energy scores test.py computes from the logits
+logits, _, _ = run_datasets(net, [test_data], args.test_bs, args.prefetch)[0]
+ref_energy = lib.get_scores(torch.from_numpy(logits), ['energy'], args.T)['energy']
+ref_pred = np.argmax(logits, 1)
+
+threshold = args.threshold
+if threshold is None:
+    threshold = energy_threshold(ref_energy, args.recall_level)
+print('Energy threshold: {:.4f} ({:.2f}% of the test set flagged as OOD)'.format(
+    threshold, 100 * np.mean(ref_energy > threshold)))
+
+detector = EnergyDetector(net, mean, std, args.T, threshold)
+parity_idxs = np.arange(min(args.parity_size, len(raw_data)))
+parity_loader = torch.utils.data.DataLoader(raw_data, batch_size=args.test_bs, sampler=[int(i) for i in parity_idxs],
+                                            num_workers=args.prefetch)
+
+for out in args.out:
+    export_detector(detector, out)
+    run = load_detector(out, args.threads)
+
+    outputs = {}
+    for images, _ in parity_loader:
+        for name, value in run(images.numpy()).items():
+            outputs.setdefault(name, []).append(value)
+    outputs = {name: np.concatenate(value) for name, value in outputs.items()}
+
+    energy_diff = np.abs(outputs['energy'] - ref_energy[parity_idxs]).max()
+    pred_agreement = np.mean(outputs['pred'] == ref_pred[parity_idxs])
+    # decisions can only differ for scores within the energy tolerance of the threshold
+    clear = np.abs(ref_energy[parity_idxs] - threshold) > args.atol
+    decision_agreement = np.mean(outputs['is_ood'][clear] == (ref_energy[parity_idxs][clear] > threshold))
+    print('{} | {:.1f} KB | max |energy diff| {:.2e} | prediction agreement {:.2f}% | decision agreement {:.2f}%'.format(
+        out, os.path.getsize(out) / 2**10, energy_diff, 100 * pred_agreement, 100 * decision_agreement))
+
+    if energy_diff > args.atol or pred_agreement < 1 or decision_agreement < 1:
+        raise Exception('exported detector {} does not match the energy scores of test.py'.format(out))
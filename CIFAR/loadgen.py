@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import numpy as np
+
+if __package__ is None:
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.serving import read_response
+
+parser = argparse.ArgumentParser(description='Load generator for serve.py: concurrent single-image requests',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--unix', type=str, default='', help='Connect to this Unix socket instead of host:port.')
+parser.add_argument('--concurrency', type=int, default=64, help='Concurrent clients (one connection each).')
+parser.add_argument('--requests', type=int, default=2000, help='Requests in total.')
+parser.add_argument('--spawn', type=int, nargs='*', default=None,
+                    help='Start serve.py once per given --max_batch (1 = per-request inference) and compare them.')
+parser.add_argument('--max_wait_ms', type=float, default=5., help='--max_wait_ms of the spawned servers.')
+parser.add_argument('--serve_args', type=str, default='', help='Extra arguments for the spawned servers.')
+args = parser.parse_args()
+
+images = np.random.RandomState(1).randint(0, 256, (64, 32, 32, 3)).astype(np.uint8)
+requests = [b'POST /score HTTP/1.1\r\nHost: localhost\r\nContent-Length: 3072\r\n\r\n' + image.tobytes()
+            for image in images]
+
+
+async def connect():
+    if args.unix != '':
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def client(num_requests, latencies):
+    reader, writer = await connect()
+    for i in range(num_requests):
+        begin = time.perf_counter()
+        writer.write(requests[i % len(requests)])
+        await writer.drain()
+        status, _ = await read_response(reader)
+        if status != 200:
+            raise Exception('request failed with status {}'.format(status))
+        latencies.append(time.perf_counter() - begin)
+    writer.close()
+
+
+async def get_stats():
+    reader, writer = await connect()
+    writer.write(b'GET /stats HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    await writer.drain()
+    _, stats = await read_response(reader)
+    writer.close()
+    return stats
+
+
+async def run_load():
+    latencies = []
+    per_client = [args.requests // args.concurrency + (i < args.requests % args.concurrency) for i in range(args.concurrency)]
+    begin = time.perf_counter()
+    await asyncio.gather(*[client(n, latencies) for n in per_client if n > 0])
+    elapsed = time.perf_counter() - begin
+    latencies = 1000 * np.asarray(latencies)
+    return {'throughput': len(latencies) / elapsed, 'p50_ms': np.percentile(latencies, 50),
+            'p99_ms': np.percentile(latencies, 99), 'server': await get_stats()}
+
+
+async def wait_for_server(timeout=120.):
+    begin = time.time()
+    while True:
+        try:
+            _, writer = await connect()
+            writer.close()
+            return
+        except OSError:
+            if time.time() - begin > timeout:
+                raise Exception('server did not start')
+            await asyncio.sleep(0.2)
+
+
+def print_result(name, result):
+    print('{:<14}{:>12.1f}{:>10.2f}{:>10.2f}{:>12.2f}'.format(
+        name, result['throughput'], result['p50_ms'], result['p99_ms'], result['server']['mean_batch']))
+
+
+print('{} requests from {} clients'.format(args.requests, args.concurrency))
+print('{:<14}{:>12}{:>10}{:>10}{:>12}'.format('server', 'requests/s', 'p50 ms', 'p99 ms', 'mean batch'))
+if args.spawn is None:
+    print_result('{}:{}'.format(args.host, args.port) if args.unix == '' else args.unix, asyncio.run(run_load()))
+else:
+    serve = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+    for max_batch in args.spawn:
+        address = ['--unix', args.unix] if args.unix != '' else ['--host', args.host, '--port', str(args.port)]
+        server = subprocess.Popen([sys.executable, serve, '--max_batch', str(max_batch),
+                                   '--max_wait_ms', str(args.max_wait_ms if max_batch > 1 else 0)]
+                                  + address + args.serve_args.split())
+        try:
+            asyncio.run(wait_for_server())
+            print_result('max_batch {}'.format(max_batch), asyncio.run(run_load()))
+        finally:
+            server.terminate()
+            server.wait()
+            if args.unix != '' and os.path.exists(args.unix):
+                os.remove(args.unix)
@@ -0,0 +1,40 @@
+import os
+import time
+import argparse
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    from utils.ood_benchmarks import ood_names, get_packable_dataset
+    from utils.packed_dataset import pack_dataset, packed_paths
+
+parser = argparse.ArgumentParser(description='Packs the OOD benchmarks into uint8 memory-mapped files for test.py --packed',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
+parser.add_argument('--names', type=str, nargs='+', default=ood_names, choices=ood_names)
+parser.add_argument('--out', type=str, default='./packed/', help='Folder for the packed benchmarks.')
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--prefetch', type=int, default=4, help='Decoding threads.')
+args = parser.parse_args()
+
+if args.machine == 'acm':
+    data_path = '/opt/data/private/ood/data/'
+
+if args.machine == 'local':
+    data_path = '/data1/church/ood/data/'
+
+ood_paths = {'Textures': data_path + 'dtd/images', 'SVHN': data_path + 'svhn/',
+             'Places365': data_path + 'places365', 'LSUN_C': data_path + 'LSUN_C',
+             'LSUN_Resize': data_path + 'LSUN_resize', 'iSUN': data_path + 'iSUN'}
+
+os.makedirs(args.out, exist_ok=True)
+for name in args.names:
+    begin = time.time()
+    meta = pack_dataset(get_packable_dataset(name, ood_paths[name]), os.path.join(args.out, name),
+                        args.batch_size, args.prefetch, meta={'name': name, 'source': ood_paths[name]})
+    images_path = packed_paths(os.path.join(args.out, name))[0]
+    print('{:<12} {:6d} images {} | {:7.1f} MB | {:6.1f} s'.format(
+        name, meta['num_examples'], 'x'.join(str(d) for d in meta['shape']),
+        os.path.getsize(images_path) / 2**20, time.time() - begin))
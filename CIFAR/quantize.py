@@ -0,0 +1,140 @@
+import os
+import argparse
+
+import torch
+import numpy as np
+import torchvision.datasets as dset
+import torchvision.transforms as trn
+
+from models.wrn_prime import WideResNet
+from models.allconv_prime import AllConvNet
+from models.densenet_prime import DenseNet3
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    import utils.score_calculation as lib
+    from utils.display_results import get_measures
+    from utils.feature_cache import get_subset_indices
+    from utils.ood_benchmarks import get_ood_datasets
+    from utils.ood_scheduler import run_datasets
+    from utils.quantization import quantize_model, model_size, latency
+    from utils.checkpoint import load_model_state
+
+parser = argparse.ArgumentParser(description='INT8 post-training quantization of a CIFAR OOD detector, with an '
+                                             'fp32 vs int8 report on the OOD benchmarks',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('model_path', type=str, help='fp32 checkpoint (state_dict) to quantize.')
+parser.add_argument('--dataset', type=str, default='cifar10', choices=['cifar10', 'cifar100'])
+parser.add_argument('--arch', '-a', type=str, default='wrn', choices=['allconv', 'wrn', 'densenet'], help='Choose architecture.')
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
+parser.add_argument('--test_bs', type=int, default=200)
+parser.add_argument('--calib_size', type=int, default=2000, help='Training images used to calibrate the activations.')
+parser.add_argument('--backend', type=str, default='x86', choices=torch.backends.quantized.supported_engines)
+parser.add_argument('--threads', type=int, default=0, help='Intra-op CPU threads (0 = torch default).')
+parser.add_argument('--prefetch', type=int, default=4, help='Pre-fetching threads.')
+parser.add_argument('--packed', type=str, default='./packed/', help='Folder of packed OOD benchmarks.')
+parser.add_argument('--cache', type=str, default='./cache/', help='Folder of the seeded OOD subsets.')
+parser.add_argument('--ood_seed', type=int, default=1, help='Seed of the scored OOD subsets.')
+parser.add_argument('--repeats', type=int, default=10, help='Forward passes per latency measurement.')
+parser.add_argument('--save', type=str, default='', help='Where to save the TorchScript INT8 model.')
+args = parser.parse_args()
+print(args)
+
+torch.manual_seed(1)
+np.random.seed(1)
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+# mean and standard deviation of channels of CIFAR-10 images
+mean = [x / 255 for x in [125.3, 123.0, 113.9]]
+std = [x / 255 for x in [63.0, 62.1, 66.7]]
+test_transform = trn.Compose([trn.ToTensor(), trn.Normalize(mean, std)])
+
+if args.machine == 'acm':
+    data_path = '/opt/data/private/ood/data/'
+
+if args.machine == 'local':
+    data_path = '/data1/church/ood/data/'
+
+cifar_path = data_path + 'cifar'
+ood_paths = {'Textures': data_path + 'dtd/images', 'SVHN': data_path + 'svhn/',
+             'Places365': data_path + 'places365', 'LSUN_C': data_path + 'LSUN_C',
+             'LSUN_Resize': data_path + 'LSUN_resize', 'iSUN': data_path + 'iSUN'}
+
+if args.dataset == 'cifar10':
+    train_data = dset.CIFAR10(cifar_path, train=True, transform=test_transform)
+    test_data = dset.CIFAR10(cifar_path, train=False, transform=test_transform)
+    num_classes = 10
+else:
+    train_data = dset.CIFAR100(cifar_path, train=True, transform=test_transform)
+    test_data = dset.CIFAR100(cifar_path, train=False, transform=test_transform)
+    num_classes = 100
+
+if args.arch == 'allconv':
+    net = AllConvNet(num_classes)
+elif args.arch == 'densenet':
+    net = DenseNet3(100, num_classes)
+else:
+    net = WideResNet(args.layers, num_classes, args.widen_factor, dropRate=0)
+net.load_state_dict(load_model_state(args.model_path))
+net.eval()
+
+# calibrate on training images, never on the data that is evaluated
+calib_idxs = get_subset_indices(train_data, args.calib_size, args.ood_seed)
+calib_loader = torch.utils.data.DataLoader(train_data, batch_size=args.test_bs, sampler=[int(i) for i in calib_idxs],
+                                           num_workers=args.prefetch)
+qnet = quantize_model(net, calib_loader, len(calib_loader), args.backend)
+
+# /////////////// Scoring ///////////////
+
+ood_sets = get_ood_datasets(ood_paths, mean, std, packed_dir=args.packed)
+ood_num_examples = len(test_data) // 5
+ood_idxs = [get_subset_indices(ood_data, ood_num_examples, args.ood_seed, args.cache) for _, ood_data in ood_sets]
+datasets = [test_data] + [ood_data for _, ood_data in ood_sets]
+index_lists = [np.arange(len(test_data))] + ood_idxs
+
+outputs = {}
+for name, model in [('fp32', net), ('int8', qnet)]:
+    outputs[name] = run_datasets(model, datasets, args.test_bs, args.prefetch, index_lists=index_lists)
+
+energy = {name: [lib.get_scores(torch.from_numpy(o[0]), ['energy'])['energy'] for o in outputs[name]]
+          for name in outputs}
+
+# /////////////// Report ///////////////
+
+data = next(iter(torch.utils.data.DataLoader(test_data, batch_size=args.test_bs)))[0]
+print('\n{:<28}{:>12}{:>12}{:>12}'.format('', 'fp32', 'int8', 'ratio'))
+size = [model_size(net) / 2**20, model_size(qnet) / 2**20]
+print('{:<28}{:>12.2f}{:>12.2f}{:>12.2f}'.format('size (MB)', size[0], size[1], size[1] / size[0]))
+for bs in [args.test_bs, 1]:
+    t = [1000 * latency(model, data[:bs], args.repeats) for model in [net, qnet]]
+    print('{:<28}{:>12.2f}{:>12.2f}{:>12.2f}'.format('latency, batch {} (ms)'.format(bs), t[0], t[1], t[1] / t[0]))
+
+errors = [100 * np.mean(np.argmax(outputs[name][0][0], 1) != outputs[name][0][2]) for name in ['fp32', 'int8']]
+print('{:<28}{:>12.2f}{:>12.2f}'.format('error (%)', errors[0], errors[1]))
+agreement = 100 * np.mean(np.argmax(outputs['fp32'][0][0], 1) == np.argmax(outputs['int8'][0][0], 1))
+print('{:<28}{:>24.2f}'.format('prediction agreement (%)', agreement))
+logit_diff = np.abs(outputs['fp32'][0][0] - outputs['int8'][0][0])
+print('{:<28}{:>24.4f}'.format('mean |logit diff|', logit_diff.mean()))
+print('{:<28}{:>24.4f}'.format('mean |energy diff|', np.abs(energy['fp32'][0] - energy['int8'][0]).mean()))
+
+# energy scores are higher for OOD samples; in-distribution is the positive class as in test.py
+print('\n{:<14}{:>9}{:>9}{:>9}{:>10}{:>9}{:>9}'.format('Energy', 'AUROC', 'int8', 'delta', 'FPR95', 'int8', 'delta'))
+rows = []
+for i, (ood_name, _) in enumerate(ood_sets):
+    measures = [get_measures(-energy[name][0], -energy[name][i + 1]) for name in ['fp32', 'int8']]
+    rows.append([100 * measures[0][0], 100 * measures[1][0], 100 * measures[0][2], 100 * measures[1][2]])
+    print('{:<14}{:>9.2f}{:>9.2f}{:>+9.2f}{:>10.2f}{:>9.2f}{:>+9.2f}'.format(
+        ood_name, rows[-1][0], rows[-1][1], rows[-1][1] - rows[-1][0], rows[-1][2], rows[-1][3], rows[-1][3] - rows[-1][2]))
+rows = np.mean(rows, 0)
+print('{:<14}{:>9.2f}{:>9.2f}{:>+9.2f}{:>10.2f}{:>9.2f}{:>+9.2f}'.format(
+    'Mean', rows[0], rows[1], rows[1] - rows[0], rows[2], rows[3], rows[3] - rows[2]))
+
+if args.save != '':
+    torch.jit.save(torch.jit.trace(qnet, data[:1]), args.save)
+    print('\nSaved', args.save)
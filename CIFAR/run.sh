@@ -19,6 +19,15 @@ elif [ "$1" = "energy" ]; then
         done
     done
     echo "||||||||done with "${dm}_${method}" energy score above |||||||||||||||||||"
+elif [ "$1" = "all" ]; then
+    for dm in ${data_models[$2]}; do
+        for method in ${methods[0]}; do
+            # MSP, energy and xent from one forward pass per dataset
+            echo "-----------"${dm}_${method}" all scores-----------------"
+            CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name ${dm}_${method} --num_to_avg 10 --score all
+        done
+    done
+    echo "||||||||done with "${dm}_${method}" all scores above |||||||||||||||||||"
 elif [ "$1" = "M" ]; then
     for dm in ${data_models[$2]}; do
         for method in ${methods[0]}; do
@@ -30,13 +39,10 @@ elif [ "$1" = "M" ]; then
     done
     echo "||||||||done with "${dm}_${method}_M" noise above|||||||||||||||||||"
 elif [ "$1" = "Odin" ]; then
-    for T in 1000 100 10 1; do
-	for noise in 0 0.0004 0.0008 0.0014 0.002 0.0024 0.0028 0.0032 0.0038 0.0048; do
-            echo "-------T="${T}_$2"   noise="$noise"--------"
-	    CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name $2 --score Odin --num_to_avg 10 --T $T --noise $noise -v #--test_bs 50
-	done
-        echo "||||Odin temperature|||||||||||||||||||||||||||||||||||||||||||"
-    done
+    # the whole temperature x noise grid in one process: one input gradient per temperature and batch
+    echo "-------Odin grid "$2"--------"
+    CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name $2 --score Odin --num_to_avg 10 --T_grid 1000,100,10,1 --noise_grid 0,0.0004,0.0008,0.0014,0.002,0.0024,0.0028,0.0032,0.0038,0.0048 #--test_bs 50
+    echo "||||Odin temperature|||||||||||||||||||||||||||||||||||||||||||"
 elif [ "$1" = "oe_tune" ] || [ "$1" = "energy_ft" ]; then # fine-tuning
     score=OE
     if [ "$1" = "energy_ft" ]; then # fine-tuning
@@ -61,13 +67,25 @@ elif [ "$1" = "oe_tune" ] || [ "$1" = "energy_ft" ]; then # fine-tuning
         done
     done
     echo "||||||||done with training above "$1"|||||||||||||||||||"
+elif [ "$1" = "amp" ]; then
+    # fp32 vs mixed-precision pretraining of WRN-40-2 on CIFAR-10: epoch time and test error are in the
+    # training logs (and *_training_results.csv), the energy FPR95 comes from test.py
+    for precision in fp32 amp; do
+        flag=""
+        if [ "$precision" = "amp" ]; then
+            flag="--amp"
+        fi
+        echo "-----------cifar10_wrn_pretrained "$precision"-----------------"
+        CUDA_VISIBLE_DEVICES=$gpu python train.py cifar10 --model wrn --layers 40 --widen-factor 2 --save ./snapshots/$precision/pretrained $flag
+        CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name cifar10_wrn_pretrained --load ./snapshots/$precision/ --num_to_avg 10 --score energy
+    done
+    echo "||||||||done with fp32 vs amp above|||||||||||||||||||"
 elif [ "$1" = "T" ]; then
     for dm in ${data_models[@]}; do
         for method in ${methods[0]}; do
-            for T in 1 2 5 10 20 50 100 200 500 1000; do
-                echo "-----------"${dm}_${method}_T_${T}"-----------------"
-                CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name ${dm}_${method} --num_to_avg 10 --score energy --T $T
-            done
+            # every temperature is scored from the same forward pass
+            echo "-----------"${dm}_${method}_T_sweep"-----------------"
+            CUDA_VISIBLE_DEVICES=$gpu python test.py --method_name ${dm}_${method} --num_to_avg 10 --score energy --T_grid 1,2,5,10,20,50,100,200,500,1000
         done
         echo "||||||||done with "${dm}_${method}_T" tempearture above|||||||||||||||||||"
     done
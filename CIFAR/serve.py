@@ -0,0 +1,104 @@
+import asyncio
+import argparse
+
+import torch
+import numpy as np
+
+from models.wrn_prime import WideResNet
+
+if __package__ is None:
+    import sys
+    from os import path
+
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    import utils.score_calculation as lib
+    from utils.device import add_device_args, get_device, setup_model
+    from utils.serving import MicroBatcher, BadRequest, read_request, write_response
+    from utils.checkpoint import load_model_state
+
+parser = argparse.ArgumentParser(description='Serves the energy OOD detector over HTTP, batching concurrent requests',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model_path', type=str, default='',
+                    help='checkpoint of a models/wrn_prime.py WideResNet (empty = random weights, for benchmarking).')
+parser.add_argument('--num_classes', type=int, default=10)
+parser.add_argument('--layers', default=40, type=int, help='total number of layers')
+parser.add_argument('--widen-factor', default=2, type=int, help='widen factor')
+parser.add_argument('--score', type=str, default='energy,MSP', help='Comma list of scores to return.')
+parser.add_argument('--T', default=1., type=float, help='temperature of the energy score')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--unix', type=str, default='', help='Listen on this Unix socket instead of host:port.')
+parser.add_argument('--max_batch', type=int, default=64, help='Largest batch of coalesced requests.')
+parser.add_argument('--max_wait_ms', type=float, default=5., help='Longest wait for a batch to fill.')
+parser.add_argument('--ngpu', type=int, default=0, help='0 = CPU.')
+add_device_args(parser)
+parser.add_argument('--bf16', action='store_true', help='Run inference under bf16 autocast.')
+args = parser.parse_args()
+
+score_names = args.score.split(',')
+for name in score_names:
+    if name not in lib.logit_score_names:
+        parser.error('unknown score: {}'.format(name))
+
+# mean and standard deviation of channels of CIFAR-10 images
+mean = [x / 255 for x in [125.3, 123.0, 113.9]]
+std = [x / 255 for x in [63.0, 62.1, 66.7]]
+image_shape = (32, 32, 3)
+
+net = WideResNet(args.layers, args.num_classes, args.widen_factor, dropRate=0)
+if args.model_path != '':
+    net.load_state_dict(load_model_state(args.model_path))
+else:
+    print('No --model_path: serving random weights')
+net.eval()
+device = get_device(args)
+net = setup_model(net, device, args.ngpu, args.channels_last, args.bf16)
+
+
+async def handle(reader, writer, batcher):
+    '''
+    POST /score: body = one H x W x 3 uint8 image (raw bytes) -> {"pred": ..., <score>: ...}
+    GET /stats: request counters, p50/p99 latency (ms) and throughput (requests/s)
+    '''
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, body = request
+            if method == 'POST' and path == '/score':
+                if len(body) != int(np.prod(image_shape)):
+                    write_response(writer, '400 Bad Request', {'error': 'expected {} uint8 bytes'.format(int(np.prod(image_shape)))})
+                else:
+                    write_response(writer, '200 OK', await batcher.score(np.frombuffer(body, dtype=np.uint8).reshape(image_shape)))
+            elif method == 'GET' and path == '/stats':
+                write_response(writer, '200 OK', batcher.stats.summary())
+            else:
+                write_response(writer, '404 Not Found', {'error': 'unknown route {} {}'.format(method, path)})
+            await writer.drain()
+    except BadRequest as e:
+        # the rest of the stream cannot be framed, so the connection ends with the error
+        write_response(writer, '400 Bad Request', {'error': str(e)})
+        await writer.drain()
+    except (ConnectionResetError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def main():
+    batcher = MicroBatcher(net, mean, std, score_names, args.T, args.max_batch, args.max_wait_ms / 1000.)
+    worker = asyncio.ensure_future(batcher.run())
+    client = lambda reader, writer: handle(reader, writer, batcher)
+    if args.unix != '':
+        server = await asyncio.start_unix_server(client, path=args.unix)
+        print('Serving on', args.unix, flush=True)
+    else:
+        server = await asyncio.start_server(client, args.host, args.port)
+        print('Serving on {}:{}'.format(args.host, args.port), flush=True)
+    async with server:
+        await server.serve_forever()
+    worker.cancel()
+
+
+asyncio.run(main())
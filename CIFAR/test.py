@@ -2,6 +2,7 @@
 import sys
 import os
 import pickle
+import hashlib
 import argparse
 
 import torch
@@ -24,16 +25,29 @@ if __package__ is None:
     from os import path
 
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
-    from utils.display_results import show_performance, get_measures, print_measures, print_measures_with_std
+    from utils.display_results import show_performance, get_measures, print_measures, print_measures_with_std, print_measures_table
+    from utils.display_results import recall_level_default, get_measures_resampled
     import utils.svhn_loader as svhn
     import utils.lsun_loader as lsun_loader
     import utils.score_calculation as lib
+    from utils.feature_cache import get_outputs_many, get_subset_indices, file_hash
+    from utils.ood_benchmarks import get_ood_datasets
+    from utils.device import add_device_args, get_device, setup_model, to_device
+    from utils.streaming_metrics import get_streaming_measures, StreamingMeasures
+    from utils.ood_scheduler import iter_outputs
+    from utils.checkpoint import find_checkpoint, load_model_state
+    from utils.validation_dataset import validation_split
+    from utils.calibration_tools import tune_temp, confidence_correct, calibration_measures, print_calibration_measures
 
 parser = argparse.ArgumentParser(description='Evaluates a CIFAR OOD Detector',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 # Setup
 parser.add_argument('--test_bs', type=int, default=200)
 parser.add_argument('--num_to_avg', type=int, default=1, help='Average measures across num_to_avg runs.')
+parser.add_argument('--resample', type=str, default='subset', choices=['none', 'subset', 'bootstrap'],
+                    help='none: re-score the OOD subset of every run; subset|bootstrap: score each OOD set once '
+                         'and evaluate the num_to_avg subsets (or bootstrap replicates) on the scores.')
+parser.add_argument('--ood_seed', type=int, default=1, help='OOD run r scores the subset drawn with seed ood_seed + r.')
 parser.add_argument('--method_name', '-m', type=str, default='cifar10_wrn_baseline', help='Method name.')
 parser.add_argument('--arch', '-a', type=str, default='wrn', choices=['allconv', 'wrn'], help='Choose architecture.')
 parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
@@ -47,16 +61,71 @@ parser.add_argument('--load', '-l', type=str, default='./snapshots/', help='Chec
 parser.add_argument('--save', '-s', type=str, default='./snapshots/', help='Folder to save score.')
 parser.add_argument('--ngpu', type=int, default=1, help='0 = CPU.')
 parser.add_argument('--prefetch', type=int, default=2, help='Pre-fetching threads.')
+add_device_args(parser)
+parser.add_argument('--bf16', action='store_true', help='Run inference under bf16 autocast.')
+parser.add_argument('--ood_workers', type=int, default=4, help='Worker pool shared by all OOD datasets.')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches pre-fetched per OOD worker.')
+parser.add_argument('--packed', type=str, default='./packed/',
+                    help='Folder of OOD benchmarks packed by pack_benchmarks.py (sets not found there are decoded).')
+parser.add_argument('--cache', type=str, default='./cache/', help="Folder for cached logits/features ('' = no cache).")
 
 # EG and benchmark details
 parser.add_argument('--out_as_pos', action='store_true', help='OE define OOD data as positive.')
-parser.add_argument('--score', type=str, default='energy', choices=['MSP', 'energy', 'M', 'xent', 'Odin'], help='score options.')
+parser.add_argument('--score', type=str, default='energy',
+                    help='score options: MSP|energy|M|xent|Odin, all, or a list of logit scores like MSP,energy,xent.')
 parser.add_argument('--T', default=1., type=float, help='temperature: energy|Odin')
+parser.add_argument('--T_grid', type=str, default='', help='comma-separated temperatures (energy|Odin), all scored in one run.')
 parser.add_argument('--use_xent', '-x', action='store_true', help='Use cross entropy scoring instead of the MSP.')
 parser.add_argument('--noise', type=float, default=0, help='noise for Odin')
+parser.add_argument('--noise_grid', type=str, default='', help='comma-separated Odin noise magnitudes, all scored in one run.')
+parser.add_argument('--lw', action='store_true', help='Ledoit-Wolf shrinkage of the Mahalanobis covariance.')
+parser.add_argument('--stream_bins', type=int, default=0,
+                    help='Approximate the measures from score histograms with this many bins (0 = exact measures).')
+parser.add_argument('--stream_range', type=str, default='',
+                    help="low,high of the histograms ('' = the range of the first in-distribution batch, widened by its width "
+                         "on both sides).")
+parser.add_argument('--calibration', '-c', action='store_true',
+                    help='Fit a temperature on the validation split held out by train.py/tune.py --calibration '
+                         '(last 10%% of the training set) and report test set calibration before and after.')
+parser.add_argument('--calib_method', type=str, default='newton', choices=['newton', 'lbfgs', 'bisection'],
+                    help='Temperature scaling solver.')
+parser.add_argument('--calib_bins', type=int, default=15, help='Equal-width confidence bins of the calibration errors.')
 args = parser.parse_args()
 
 print(args)
+
+# several logit scores can share one forward pass; M and Odin need their own passes
+if args.score == 'all':
+    score_names = list(lib.logit_score_names)
+else:
+    score_names = args.score.split(',')
+for name in score_names:
+    if name not in lib.logit_score_names + ['M', 'Odin']:
+        parser.error('unknown score: {}'.format(name))
+    if name not in lib.logit_score_names and len(score_names) > 1:
+        parser.error('{} cannot be combined with other scores'.format(name))
+
+# a temperature (and noise) sweep replaces the energy or Odin score by one score per setting
+temperatures = [float(t) for t in args.T_grid.split(',')] if args.T_grid != '' else []
+noises = [float(n) for n in args.noise_grid.split(',')] if args.noise_grid != '' else []
+sweep_names = []
+if args.score == 'Odin':
+    odin_temperatures = temperatures or [args.T]
+    odin_noises = noises or [args.noise]
+    odin_settings = [(T, noise) for T in odin_temperatures for noise in odin_noises]
+    if len(odin_settings) > 1:
+        sweep_names = ['Odin_T{:g}_n{:g}'.format(T, noise) for T, noise in odin_settings]
+        score_names = sweep_names
+    odin_names = dict(zip(odin_settings, score_names))
+elif noises:
+    parser.error('--noise_grid needs the Odin score')
+elif temperatures:
+    if 'energy' not in score_names:
+        parser.error('--T_grid needs the energy or Odin score')
+    sweep_names = ['energy_T{:g}'.format(t) for t in temperatures]
+    score_names = [name for name in score_names if name != 'energy'] + sweep_names
+
+logit_scores = [name for name in score_names if name in lib.logit_score_names] or ['MSP']
 # torch.manual_seed(1)
 # np.random.seed(1)
 
@@ -100,6 +169,12 @@ else:
 test_loader = torch.utils.data.DataLoader(test_data, batch_size=args.test_bs, shuffle=False,
                                           num_workers=args.prefetch, pin_memory=True)
 
+ood_paths = {'Textures': dtd_path, 'SVHN': svhn_path, 'Places365': places365_path,
+             'LSUN_C': lsun_c_path, 'LSUN_Resize': lsun_r_path, 'iSUN': isun_path}
+ood_sets = get_ood_datasets(ood_paths, mean, std, packed_dir=args.packed)
+if any(hasattr(ood_data, 'get_batch') for _, ood_data in ood_sets):
+    print('Packed benchmarks:', [name for name, ood_data in ood_sets if hasattr(ood_data, 'get_batch')])
+
 
 # Create model
 if args.arch == 'allconv':
@@ -117,54 +192,56 @@ else:
 print('\nThe number of model parameters: {}\n'.format(sum([p.data.nelement() for p in net.parameters()])))
 
 start_epoch = 0
+ckpt_hash = ''
 
 # Restore model
 if args.load != '':
-    for i in range(1000 - 1, -1, -1):
-        if 'pretrained' in args.method_name:
-            subdir = 'pretrained'
+    if 'pretrained' in args.method_name:
+        subdir = 'pretrained'
 
-        elif 'oe_tune' in args.method_name:
-            subdir = 'oe_tune'
+    elif 'oe_tune' in args.method_name:
+        subdir = 'oe_tune'
 
-        elif 'tune' in args.method_name:
-            # subdir = 'tune_sroe'
-            subdir = 'tune_sr'
-            # subdir = 'tune_test1'
-            # subdir = 'tune_test2'
+    elif 'tune' in args.method_name:
+        # subdir = 'tune_sroe'
+        subdir = 'tune_sr'
+        # subdir = 'tune_test1'
+        # subdir = 'tune_test2'
 
-        elif 'energy_ft' in args.method_name:
-            subdir = 'energy_ft'
+    elif 'energy_ft' in args.method_name:
+        subdir = 'energy_ft'
 
-        elif 'oe_scratch' in args.method_name:
-            subdir = 'oe_scratch'
+    elif 'oe_scratch' in args.method_name:
+        subdir = 'oe_scratch'
 
-        elif 'baseline' in args.method_name:
-            subdir = 'baseline'
+    elif 'baseline' in args.method_name:
+        subdir = 'baseline'
 
-        else:
-            raise Exception('unknown subdir: {}'.format(args.subdir))
-
-        model_name = os.path.join(os.path.join(args.load, subdir), args.method_name + '_epoch_' + str(i) + '.pt')
-        # print(model_name)
-        # exit(0)
-        # model_name = os.path.join(os.path.join(args.load, subdir), args.method_name + '_best' + '.pt')
-        if os.path.isfile(model_name):
-            net.load_state_dict(torch.load(model_name))
-            print('Model restored! Epoch:', i)
-            start_epoch = i + 1
-            break
-    if start_epoch == 0:
-        assert False, "could not resume "+model_name
+    else:
+        raise Exception('unknown subdir: {}'.format(args.subdir))
+
+    # the last epoch from the run manifest (older runs: the highest <method_name>_epoch_<i>.pt)
+    model_name, i = find_checkpoint(os.path.join(args.load, subdir), args.method_name)
+    # model_name, i = find_checkpoint(os.path.join(args.load, subdir), args.method_name, which='best')
+    if model_name is None:
+        assert False, "could not resume " + os.path.join(args.load, subdir, args.method_name)
+    net.load_state_dict(load_model_state(model_name))
+    print('Model restored! Epoch:', i)
+    ckpt_hash = file_hash(model_name)
+    start_epoch = i + 1
 
 net.eval()
 
-if args.ngpu > 1:
-    net = torch.nn.DataParallel(net, device_ids=list(range(args.ngpu)))
-
-if args.ngpu > 0:
-    net.cuda()
-    # torch.cuda.manual_seed(1)
+device = get_device(args)
+net = setup_model(net, device, args.ngpu, args.channels_last, args.bf16)
+if ckpt_hash != '':
+    # outputs under bf16 or channels_last differ from the fp32 ones, so they are cached apart
+    ckpt_hash = hashlib.sha1('|'.join([ckpt_hash, 'bf16' if args.bf16 else 'fp32',
+                                       'channels_last' if args.channels_last else 'contiguous']).encode()).hexdigest()
+# outputs are only cached for a checkpoint: without one (--load '') there is nothing to key them on
+output_cache = args.cache if ckpt_hash != '' else ''
+if args.cache != '' and output_cache == '':
+    print('No checkpoint loaded: network outputs are not cached')
 
 cudnn.benchmark = True  # fire on all cylinders
 
@@ -176,58 +253,139 @@ concat = lambda x: np.concatenate(x, axis=0)
 to_np = lambda x: x.data.cpu().numpy()
 
 
-def get_ood_scores(loader, in_dist=False):
-    _score = []
+def score_output(output):
+    # every requested score comes from the same logits (MSP for Mahalanobis, which won't need it returned)
+    smax = to_np(F.softmax(output, dim=1))
+    scores = lib.get_scores(output, logit_scores, args.T)
+    if temperatures:
+        scores.update(zip(sweep_names, lib.energy_sweep(output, temperatures)))
+    return scores, smax
+
+
+def right_wrong_scores(smax, targets):
+    preds = np.argmax(smax, axis=1)
+    right_indices = preds == np.asarray(targets).reshape(-1)
+    wrong_indices = np.invert(right_indices)
+    return -np.max(smax[right_indices], axis=1), -np.max(smax[wrong_indices], axis=1)
+
+
+def get_cached_ood_scores(outputs, in_dist=False):
+    # one forward pass per checkpoint and dataset; every score is computed from the stored logits
+    logits, _, targets = outputs
+    score, smax = score_output(torch.from_numpy(np.array(logits)))
+
+    if in_dist:
+        right_score, wrong_score = right_wrong_scores(smax, targets)
+        return score, right_score, wrong_score
+
+    else:
+        return score
+
+
+def get_ood_scores(loader, in_dist=False, num_examples=ood_num_examples, outputs=None):
+    # num_examples=None scores the whole OOD set; with precomputed outputs the loader is not used
+    if outputs is not None:
+        return get_cached_ood_scores(outputs, in_dist)
+
+    _score = {}
     _right_score = []
     _wrong_score = []
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch_idx, (data, target) in enumerate(loader):
-            if batch_idx >= ood_num_examples // args.test_bs and in_dist is False:
+            if num_examples is not None and batch_idx >= num_examples // args.test_bs and in_dist is False:
                 break
 
-            data = data.cuda()
+            data = to_device(data, net)
             output, vector_feature = net(data)
-            smax = to_np(F.softmax(output, dim=1))
-
-            # original MSP and Mahalanobis (but Mahalanobis won't need this returned)
-            if args.score == 'MSP':
-                _score.append(-np.max(smax, axis=1))
-                # _right_score.append(-np.max(smax[right_indices], axis=1))
-                # _wrong_score.append(-np.max(smax[wrong_indices], axis=1))
-
-            if args.score == 'energy':
-                _score.append(-to_np((args.T*torch.logsumexp(output / args.T, dim=1))))
-            
-            elif args.score == 'xent': 
-                _score.append( to_np( -1 * (F.softmax(output, dim=1) * F.log_softmax(output, dim=1)).sum(1)) )
-
-            else: # original MSP and Mahalanobis (but Mahalanobis won't need this returned)
-                _score.append(-np.max(smax, axis=1))
+            score, smax = score_output(output)
+            for name in score:
+                _score.setdefault(name, []).append(score[name])
 
             if in_dist:
-                preds = np.argmax(smax, axis=1)
-                targets = target.numpy().squeeze()
-                right_indices = preds == targets
-                wrong_indices = np.invert(right_indices)
-                _right_score.append(-np.max(smax[right_indices], axis=1))
-                _wrong_score.append(-np.max(smax[wrong_indices], axis=1))
+                right_score, wrong_score = right_wrong_scores(smax, target.numpy())
+                _right_score.append(right_score)
+                _wrong_score.append(wrong_score)
        
     if in_dist:    
-        return concat(_score).copy(), concat(_right_score).copy(), concat(_wrong_score).copy()
+        return {name: concat(_score[name]).copy() for name in _score}, concat(_right_score).copy(), concat(_wrong_score).copy()
     
     else:
-        return concat(_score)[:ood_num_examples].copy()
+        return {name: concat(_score[name])[:num_examples].copy() for name in _score}
+
+
+# every OOD run scores a fixed subset of indices drawn from its seed (persisted in the cache folder),
+# and the loaders only visit, and decode, those samples; bootstrap replicates are drawn from one subset
+num_subsets = 1 if args.resample == 'bootstrap' else args.num_to_avg
+ood_subsets = {name: [get_subset_indices(ood_data, ood_num_examples, args.ood_seed + r, args.cache)
+                      for r in range(num_subsets)] for name, ood_data in ood_sets}
+ood_union = {name: np.unique(np.concatenate(subsets)) for name, subsets in ood_subsets.items()}
+
+
+def subset_loader(dataset, idxs):
+    return torch.utils.data.DataLoader(dataset, batch_size=args.test_bs, sampler=[int(i) for i in idxs],
+                                       num_workers=args.ood_workers, pin_memory=True)
+
+
+def output_batches(datasets, outputs, num_workers, index_lists=None):
+    '''
+    (logits, targets) batches of the datasets, in row order: a slice at a time of the stored
+    outputs (memory-mapped when cached), or straight from the forward pass when there are none
+    '''
+    if outputs is None:
+        for _, logits, _, targets in iter_outputs(net, datasets, args.test_bs, num_workers, index_lists,
+                                                  args.prefetch_factor):
+            yield logits, targets
+        return
+    for logits, _, targets in outputs:
+        for start in range(0, len(logits), args.test_bs):
+            yield logits[start:start + args.test_bs], targets[start:start + args.test_bs]
+
+
+def stream_range(id_scores):
+    if args.stream_range != '':
+        return [float(v) for v in args.stream_range.split(',')]
+    low, high = float(np.min(id_scores)), float(np.max(id_scores))
+    # scores outside the range still count, in the edge bins
+    width = (high - low) or 1.
+    return low - width, high + width
+
+
+# logit scores are read from the outputs of one pass over the test set and every OOD subset, which all
+# stream through a single worker pool; Odin and Mahalanobis need gradients and use their own loaders
+id_outputs, ood_outputs = None, {}
+# with --stream_bins, logit scores go batch by batch into histograms: without a cache nothing is stored
+streaming = args.stream_bins > 0 and args.score not in ['Odin', 'M']
+# (Odin recomputes the test set with input perturbation, and --calibration scores it itself when needed)
+if args.score != 'Odin' and (output_cache != '' or (args.score != 'M' and not streaming)):
+    if args.score == 'M':
+        id_outputs = get_outputs_many(net, [test_data], args.test_bs, args.prefetch, output_cache, ckpt_hash)[0]
+    else:
+        outputs = get_outputs_many(net, [test_data] + [ood_data for _, ood_data in ood_sets], args.test_bs,
+                                   args.ood_workers, output_cache, ckpt_hash, args.prefetch_factor,
+                                   index_lists=[None] + [ood_union[name] for name, _ in ood_sets])
+        id_outputs, ood_outputs = outputs[0], dict(zip([name for name, _ in ood_sets], outputs[1:]))
+
+
+def get_odin_scores(loader, in_dist=False, num_examples=ood_num_examples):
+    # the whole T x noise grid from one pass over the loader
+    if num_examples is None:
+        num_examples = len(loader.dataset)
+    scores = lib.get_ood_scores_odin_grid(loader, net, args.test_bs, num_examples, odin_temperatures, odin_noises, in_dist)
+    if in_dist:
+        return {odin_names[k]: v for k, v in scores[0].items()}, scores[1], scores[2]
+    else:
+        return {odin_names[k]: v for k, v in scores.items()}
 
 
 if args.score == 'Odin':
     # separated because no grad is not applied
-    in_score, right_score, wrong_score = lib.get_ood_scores_odin(test_loader, net, args.test_bs, ood_num_examples, args.T, args.noise, in_dist=True)
+    in_score, right_score, wrong_score = get_odin_scores(test_loader, in_dist=True)
 
 
 elif args.score == 'M':
     from torch.autograd import Variable
-    _, right_score, wrong_score = get_ood_scores(test_loader, in_dist=True)
+    _, right_score, wrong_score = get_ood_scores(test_loader, in_dist=True, outputs=id_outputs)
 
     if 'cifar10_' in args.method_name:
         train_data = dset.CIFAR10(cifar_path, train=True, transform=test_transform)
@@ -240,7 +398,7 @@ elif args.score == 'M':
 
     temp_x = torch.rand(2,3,32,32)
     temp_x = Variable(temp_x)
-    temp_x = temp_x.cuda()
+    temp_x = to_device(temp_x, net)
     temp_list = net.feature_list(temp_x)[1]
     num_output = len(temp_list)
     feature_list = np.empty(num_output)
@@ -253,22 +411,67 @@ elif args.score == 'M':
     print('get sample mean and covariance', count)
     # print(feature_list) # 特征的维数
     # exit(0)
-    sample_mean, precision = lib.sample_estimator(net, num_classes, feature_list, train_loader)
+    # the estimate only depends on the checkpoint, so every noise magnitude of a sweep shares it;
+    # without a checkpoint (random weights) it is computed but not stored
+    shrinkage = 'ledoit_wolf' if args.lw else None
+    if ckpt_hash != '':
+        estimator_key = hashlib.sha1('|'.join([ckpt_hash, args.arch, str(args.layers), str(args.widen_factor),
+                                               str([int(f) for f in feature_list]), str(args.lw)]).encode()).hexdigest()
+        estimator_file = os.path.join(os.path.dirname(model_name),
+                                      args.method_name + '_mahalanobis_' + estimator_key[:16] + '.pt')
+        sample_mean, precision = lib.cached_sample_estimator(net, num_classes, feature_list, train_loader,
+                                                             estimator_file, shrinkage=shrinkage)
+    else:
+        sample_mean, precision = lib.sample_estimator(net, num_classes, feature_list, train_loader, shrinkage=shrinkage)
     in_score, _ = lib.get_Mahalanobis_score(net, test_loader, num_classes, sample_mean, precision, count-1, args.noise, num_batches, in_dist=True)
+    in_score = {'M': in_score}
+
+
+elif streaming:
+    # one histogram per score; the error rate only needs the counts
+    in_hists, num_right, num_wrong = {}, 0, 0
+    for logits, targets in output_batches([test_data], None if id_outputs is None else [id_outputs], args.prefetch):
+        score, smax = score_output(torch.from_numpy(np.array(logits)))
+        right_score, wrong_score = right_wrong_scores(smax, targets)
+        num_right += len(right_score); num_wrong += len(wrong_score)
+        for name in score:
+            values = score[name] if args.out_as_pos else -score[name]
+            if name not in in_hists:
+                in_hists[name] = StreamingMeasures(args.stream_bins, stream_range(values))
+            in_hists[name].update(values, positive=not args.out_as_pos)
 
 
 else:
-    in_score, right_score, wrong_score = get_ood_scores(test_loader, in_dist=True)
+    in_score, right_score, wrong_score = get_ood_scores(test_loader, in_dist=True, outputs=id_outputs)
 
 # print(in_score[:10])
 # exit(0)
 
 
-num_right = len(right_score)
-num_wrong = len(wrong_score)
+if not streaming:
+    num_right = len(right_score)
+    num_wrong = len(wrong_score)
 
 print('Error Rate {:.2f}'.format(100 * num_wrong / (num_wrong + num_right)))
 
+if args.calibration:
+    # the same held-out split as training with --calibration, scored in one pass (and cached) like the test set
+    if 'cifar10_' in args.method_name:
+        val_data = validation_split(dset.CIFAR10(cifar_path, train=True, transform=test_transform), val_share=0.1)[1]
+    else:
+        val_data = validation_split(dset.CIFAR100(cifar_path, train=True, transform=test_transform), val_share=0.1)[1]
+    calib_outputs = get_outputs_many(net, [val_data] + ([test_data] if id_outputs is None else []), args.test_bs,
+                                     args.prefetch, output_cache, ckpt_hash)
+    val_logits, _, val_targets = calib_outputs[0]
+    test_logits, _, test_targets = id_outputs if id_outputs is not None else calib_outputs[1]
+
+    T_calib = tune_temp(val_logits, val_targets, method=args.calib_method, device=device)
+    print('\n\nCalibration (temperature fitted on {} validation images: T = {:.4f})'.format(len(val_data), T_calib))
+    for T, name in [(1., 'Uncalibrated'), (T_calib, 'Temperature scaled')]:
+        confidence, correct, nll = confidence_correct(test_logits, test_targets, T)
+        print_calibration_measures(calibration_measures(confidence, correct, args.calib_bins), args.method_name + ' ' + name)
+        print('NLL: \t\t\t\t{:.4f}'.format(nll))
+
 # /////////////// End Detection Prelims ///////////////
 print('\nUsing CIFAR-10 as typical data') if num_classes == 10 else print('\nUsing CIFAR-100 as typical data')
 
@@ -277,91 +480,151 @@ print('\nUsing CIFAR-10 as typical data') if num_classes == 10 else print('\nUsi
 print('\n\nOut of Distribution Detection: ')
 
 # /////////////// OOD Detection ///////////////
-auroc_list, aupr_list, fpr_list = [], [], []
+auroc_list = {name: [] for name in score_names}
+aupr_list = {name: [] for name in score_names}
+fpr_list = {name: [] for name in score_names}
+table_rows = []
+
+def run_measures(pos, neg, pos_idxs=None, neg_idxs=None):
+    '''
+    aurocs, auprs, fprs (one per row of the index arrays) and the histogram AUROC error bound
+    '''
+    if args.stream_bins == 0:
+        if pos_idxs is None and neg_idxs is None:
+            measures = get_measures(pos, neg)
+            return [measures[0]], [measures[1]], [measures[2]], 0.
+        measures = get_measures_resampled(pos, neg, pos_idxs, neg_idxs)
+        return list(measures[0]), list(measures[1]), list(measures[2]), 0.
+
+    score_range = stream_range(neg if args.out_as_pos else pos)
+    num_runs = len(pos_idxs) if pos_idxs is not None else len(neg_idxs) if neg_idxs is not None else 1
+    runs = [get_streaming_measures(pos if pos_idxs is None else pos[pos_idxs[r]],
+                                   neg if neg_idxs is None else neg[neg_idxs[r]],
+                                   args.stream_bins, score_range) for r in range(num_runs)]
+    return [run[0] for run in runs], [run[1] for run in runs], [run[2] for run in runs], max(run[3] for run in runs)
+
+
+def stream_ood_hists(ood_data, union, weights, outputs):
+    '''
+    per score, one histogram of the OOD scores for every row of weights (how often a run counts
+    each sample of the union), filled a batch at a time with the bins of the in-distribution one
+    '''
+    hists, start = {}, 0
+    for logits, _ in output_batches([ood_data], None if outputs is None else [outputs], args.ood_workers, [union]):
+        score, _ = score_output(torch.from_numpy(np.array(logits)))
+        end = start + len(logits)
+        for name in score:
+            values = score[name] if args.out_as_pos else -score[name]
+            if name not in hists:
+                hists[name] = [StreamingMeasures(args.stream_bins, in_hists[name].score_range()) for _ in weights]
+            for hist, w in zip(hists[name], weights[:, start:end]):
+                hist.update(values, positive=args.out_as_pos, weights=w)
+        start = end
+    return hists
+
+
+def get_and_print_results(ood_name, ood_data, num_to_avg=args.num_to_avg):
+    subsets, union = ood_subsets[ood_name], ood_union[ood_name]
+
+    aurocs = {name: [] for name in score_names}
+    auprs = {name: [] for name in score_names}
+    fprs = {name: [] for name in score_names}
+    auroc_errors = {name: 0. for name in score_names}
+
+    if streaming:
+        # the runs only differ in how often they count each sample of the union
+        if args.resample == 'bootstrap':
+            idxs = np.random.RandomState(args.ood_seed).randint(len(union), size=(num_to_avg, len(union)))
+        else:
+            idxs = [np.searchsorted(union, subset) for subset in subsets]
+        weights = np.stack([np.bincount(i, minlength=len(union)) for i in idxs])
+        hists = stream_ood_hists(ood_data, union, weights, ood_outputs.get(ood_name))
+        for name in score_names:
+            for hist in hists[name]:
+                measures = hist.merge(in_hists[name]).measures((recall_level_default,))
+                aurocs[name].append(measures['auroc']); auprs[name].append(measures['aupr_in'])
+                fprs[name].append(measures['fpr'][recall_level_default])
+                auroc_errors[name] = max(auroc_errors[name], measures['auroc_error'])
+
+    elif args.resample != 'none':
+        # score the union of the run subsets once, then evaluate every run as an index array over the scores
+        if args.score == 'Odin':
+            out_score = get_odin_scores(subset_loader(ood_data, union), num_examples=None)
+        elif args.score == 'M':
+            ood_loader = subset_loader(ood_data, union)
+            out_score = {'M': lib.get_Mahalanobis_score(net, ood_loader, num_classes, sample_mean, precision, count-1, args.noise, len(ood_loader))[0]}
+        else:
+            out_score = get_ood_scores(None, num_examples=None, outputs=ood_outputs[ood_name])
 
-def get_and_print_results(ood_loader, num_to_avg=args.num_to_avg):
+        if args.resample == 'subset':
+            idxs = np.stack([np.searchsorted(union, subset) for subset in subsets])
+        else:
+            idxs = np.random.RandomState(args.ood_seed).randint(len(union), size=(num_to_avg, len(union)))
 
-    aurocs, auprs, fprs = [], [], []
+        for name in score_names:
+            if args.out_as_pos: # OE's defines out samples as positive
+                measures = run_measures(out_score[name], in_score[name], pos_idxs=idxs)
+            else:
+                measures = run_measures(-in_score[name], -out_score[name], neg_idxs=idxs)
+            aurocs[name], auprs[name], fprs[name], auroc_errors[name] = measures
 
-    for _ in range(num_to_avg):
+    for r in range(num_to_avg if args.resample == 'none' and not streaming else 0):
         if args.score == 'Odin':
-            out_score = lib.get_ood_scores_odin(ood_loader, net, args.test_bs, ood_num_examples, args.T, args.noise)
+            # the loader holds exactly the subset of this run
+            out_score = get_odin_scores(subset_loader(ood_data, subsets[r]), num_examples=None)
         elif args.score == 'M':
-            out_score, _ = lib.get_Mahalanobis_score(net, ood_loader, num_classes, sample_mean, precision, count-1, args.noise, num_batches)
-
+            ood_loader = subset_loader(ood_data, subsets[r])
+            out_score = {'M': lib.get_Mahalanobis_score(net, ood_loader, num_classes, sample_mean, precision, count-1, args.noise, len(ood_loader))[0]}
         else:
-            out_score = get_ood_scores(ood_loader)
-        
-        if args.out_as_pos: # OE's defines out samples as positive
-            measures = get_measures(out_score, in_score)
+            # the rows of this run in the (cached) outputs of the union
+            rows = np.searchsorted(union, subsets[r])
+            out_score = get_ood_scores(None, num_examples=None,
+                                       outputs=tuple(a[rows] for a in ood_outputs[ood_name]))
+
+        for name in score_names:
+            if args.out_as_pos: # OE's defines out samples as positive
+                measures = run_measures(out_score[name], in_score[name])
+            else:
+                measures = run_measures(-in_score[name], -out_score[name])
+            aurocs[name] += measures[0]; auprs[name] += measures[1]; fprs[name] += measures[2]
+            auroc_errors[name] = max(auroc_errors[name], measures[3])
+
+    for name in score_names:
+        method_name = args.method_name if len(score_names) == 1 else args.method_name + ' ' + name
+        if not streaming:
+            print(in_score[name][:3], out_score[name][:3])
+        auroc = np.mean(aurocs[name]); aupr = np.mean(auprs[name]); fpr = np.mean(fprs[name])
+        auroc_list[name].append(auroc); aupr_list[name].append(aupr); fpr_list[name].append(fpr)
+        table_rows.append((ood_name, name, auroc, aupr, fpr))
+
+        if num_to_avg >= 5:
+            print_measures_with_std(aurocs[name], auprs[name], fprs[name], method_name)
         else:
-            measures = get_measures(-in_score, -out_score)
-        aurocs.append(measures[0]); auprs.append(measures[1]); fprs.append(measures[2])
-    
-    print(in_score[:3], out_score[:3])
-    auroc = np.mean(aurocs); aupr = np.mean(auprs); fpr = np.mean(fprs)
-    auroc_list.append(auroc); aupr_list.append(aupr); fpr_list.append(fpr)
+            print_measures(auroc, aupr, fpr, method_name)
+        if args.stream_bins > 0:
+            print('AUROC error bound:\t{:.2f}'.format(100 * auroc_errors[name]))
 
-    if num_to_avg >= 5:
-        print_measures_with_std(aurocs, auprs, fprs, args.method_name)
-    else:
-        print_measures(auroc, aupr, fpr, args.method_name)
-
-# /////////////// Textures ///////////////
-ood_data = dset.ImageFolder(root=dtd_path,
-                            transform=trn.Compose([trn.Resize(32), trn.CenterCrop(32),
-                                                   trn.ToTensor(), trn.Normalize(mean, std)]))
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=4, pin_memory=True)
-print('\n\nTexture Detection')
-get_and_print_results(ood_loader)
-
-
-# /////////////// SVHN /////////////// # cropped and no sampling of the test set
-ood_data = svhn.SVHN(root=svhn_path, split="test",
-                     transform=trn.Compose(
-                         [#trn.Resize(32),
-                         trn.ToTensor(), trn.Normalize(mean, std)]), download=False)
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=2, pin_memory=True)
-print('\n\nSVHN Detection')
-get_and_print_results(ood_loader)
-
-# /////////////// Places365 ///////////////
-ood_data = dset.ImageFolder(root=places365_path,
-                            transform=trn.Compose([trn.Resize(32), trn.CenterCrop(32),
-                                                   trn.ToTensor(), trn.Normalize(mean, std)]))
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=2, pin_memory=True)
-print('\n\nPlaces365 Detection')
-get_and_print_results(ood_loader)
-
-# /////////////// LSUN-C ///////////////
-ood_data = dset.ImageFolder(root=lsun_c_path,
-                            transform=trn.Compose([trn.ToTensor(), trn.Normalize(mean, std)]))
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=1, pin_memory=True)
-print('\n\nLSUN_C Detection')
-get_and_print_results(ood_loader)
-
-# /////////////// LSUN-R ///////////////
-ood_data = dset.ImageFolder(root=lsun_r_path,
-                            transform=trn.Compose([trn.ToTensor(), trn.Normalize(mean, std)]))
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=1, pin_memory=True)
-print('\n\nLSUN_Resize Detection')
-get_and_print_results(ood_loader)
-
-# /////////////// iSUN ///////////////
-ood_data = dset.ImageFolder(root=isun_path,
-                            transform=trn.Compose([trn.ToTensor(), trn.Normalize(mean, std)]))
-ood_loader = torch.utils.data.DataLoader(ood_data, batch_size=args.test_bs, shuffle=True,
-                                         num_workers=1, pin_memory=True)
-print('\n\niSUN Detection')
-get_and_print_results(ood_loader)
+for ood_name, ood_data in ood_sets:
+    print('\n\n' + ood_name + ' Detection')
+    get_and_print_results(ood_name, ood_data)
 
 
 # /////////////// Mean Results ///////////////
 
 print('\n\nMean Test Results!!!!!')
-print_measures(np.mean(auroc_list), np.mean(aupr_list), np.mean(fpr_list), method_name=args.method_name)
\ No newline at end of file
+for name in score_names:
+    method_name = args.method_name if len(score_names) == 1 else args.method_name + ' ' + name
+    print_measures(np.mean(auroc_list[name]), np.mean(aupr_list[name]), np.mean(fpr_list[name]), method_name=method_name)
+    table_rows.append(('Mean', name, np.mean(auroc_list[name]), np.mean(aupr_list[name]), np.mean(fpr_list[name])))
+
+if len(score_names) > 1:
+    print('\n\nAll Scores')
+    print_measures_table(sorted(table_rows, key=lambda row: score_names.index(row[1])))
+
+if sweep_names:
+    print('\n\nBest Setting (lowest FPR{:d}, then highest AUROC)'.format(int(100 * recall_level_default)))
+    best_rows = []
+    for ood_name in [row[0] for row in table_rows if row[1] == sweep_names[0]]:
+        rows = [row for row in table_rows if row[0] == ood_name and row[1] in sweep_names]
+        best_rows.append(min(rows, key=lambda row: (row[4], -row[2])))
+    print_measures_table(best_rows)
@@ -2,7 +2,6 @@
 
 import os
 import time
-import shutil
 import argparse
 
 import torch
@@ -30,6 +29,10 @@ if __package__ is None:
 
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
     from utils.validation_dataset import validation_split
+    from utils.tensor_cifar import TensorCIFAR, TensorLoader
+    from utils.checkpoint import CheckpointManager, ResumableRandomSampler, find_checkpoint, load_model_state
+    from utils.device import add_device_args, get_device, setup_model, to_device, amp_autocast, grad_scaler
+    from utils.distributed import init_distributed, wrap_ddp, all_reduce_values, shard_indices
 
 
 parser = argparse.ArgumentParser(description='Trains a CIFAR Classifier',
@@ -43,7 +46,8 @@ parser.add_argument('--calibration', '-c', action='store_true',
 # Optimization options
 parser.add_argument('--epochs', '-e', type=int, default=100, help='Number of epochs to train.')
 parser.add_argument('--learning_rate', '-lr', type=float, default=0.1, help='The initial learning rate.')
-parser.add_argument('--batch_size', '-b', type=int, default=128, help='Batch size.')
+parser.add_argument('--batch_size', '-b', type=int, default=128,
+                    help='Batch size (over all processes of a torchrun run).')
 parser.add_argument('--test_bs', type=int, default=200)
 parser.add_argument('--momentum', type=float, default=0.9, help='Momentum.')
 parser.add_argument('--decay', '-d', type=float, default=0.0005, help='Weight decay (L2 penalty).')
@@ -60,19 +64,35 @@ parser.add_argument('--droprate', default=0.3, type=float, help='dropout probabi
 parser.add_argument('--save', '-s', type=str, default='./snapshots/test', help='Folder to save checkpoints.')
 parser.add_argument('--load', '-l', type=str, default='', help='Checkpoint path to resume / test.')
 parser.add_argument('--test', '-t', action='store_true', help='Test only flag.')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue the run in --save from its latest checkpoint (optimizer, schedule, RNG and data order included).')
+parser.add_argument('--save_every', type=int, default=0,
+                    help='Also checkpoint every N training steps (0 = only after every epoch).')
 
 # Acceleration
 parser.add_argument('--ngpu', type=int, default=1, help='0 = CPU.')
 parser.add_argument('--prefetch', type=int, default=4, help='Pre-fetching threads.')
+add_device_args(parser)
+parser.add_argument('--amp', action='store_true',
+                    help='Mixed-precision training: fp16 autocast with loss scaling on cuda, bf16 autocast on the CPU.')
+parser.add_argument('--tensor_data', action='store_true',
+                    help='Hold CIFAR as one uint8 tensor on the device and augment whole batches there (no loader workers).')
 
 parser.add_argument('--machine', type=str, default='local', choices=['acm', 'local'], help='Choose machine.')
 
 args = parser.parse_args()
 
+# under torchrun, one process per GPU or per share of the CPU cores; only rank 0 prints and writes files
+device, rank, world_size = init_distributed(get_device(args))
+if args.batch_size % world_size != 0:
+    raise Exception('batch size {} is not divisible by {} processes'.format(args.batch_size, world_size))
+batch_size = args.batch_size // world_size
+
 state = {k: v for k, v in args._get_kwargs()}
 print(state)
 
-torch.manual_seed(1)
+# a random stream per process (dropout, augmentation); DDP copies the initial weights of rank 0
+torch.manual_seed(1 + rank)
 np.random.seed(1)
 
 if args.machine == 'acm':
@@ -108,12 +128,24 @@ if args.calibration:
     train_data, val_data = validation_split(train_data, val_share=0.1)
     calib_indicator = '_calib'
 
-train_loader = torch.utils.data.DataLoader(
-    train_data, batch_size=args.batch_size, shuffle=True,
-    num_workers=args.prefetch, pin_memory=True)
-test_loader = torch.utils.data.DataLoader(
-    test_data, batch_size=args.test_bs, shuffle=False,
-    num_workers=args.prefetch, pin_memory=True)
+# the data order of every epoch is fixed by the seed, so a run can resume in the middle of an epoch
+# (and sharded over the processes of a distributed run, like DistributedSampler)
+train_sampler = ResumableRandomSampler(train_data, seed=1, num_replicas=world_size, rank=rank)
+# every process tests its share of the test set
+test_sampler = shard_indices(len(test_data), rank, world_size)
+
+if args.tensor_data:
+    # the same augmentation as train_transform, applied to whole batches
+    train_loader = TensorLoader(TensorCIFAR(train_data, mean, std, device), batch_size, sampler=train_sampler,
+                                flip=True, crop_padding=4)
+    test_loader = TensorLoader(TensorCIFAR(test_data, mean, std, device), args.test_bs, sampler=test_sampler)
+else:
+    train_loader = torch.utils.data.DataLoader(
+        train_data, batch_size=batch_size, sampler=train_sampler, generator=train_sampler.generator,
+        num_workers=args.prefetch, pin_memory=True)
+    test_loader = torch.utils.data.DataLoader(
+        test_data, batch_size=args.test_bs, sampler=test_sampler,
+        num_workers=args.prefetch, pin_memory=True)
 
 
 # Create model
@@ -162,22 +194,16 @@ start_epoch = 0
 
 # Restore model if desired
 if args.load != '':
-    for i in range(1000 - 1, -1, -1):
-        model_name = os.path.join(args.load, args.dataset + calib_indicator + '_' + args.model +
-                                  '_baseline_epoch_' + str(i) + '.pt')
-        if os.path.isfile(model_name):
-            net.load_state_dict(torch.load(model_name))
-            print('Model restored! Epoch:', i)
-            start_epoch = i + 1
-            break
-    if start_epoch == 0:
+    model_name, i = find_checkpoint(args.load, args.dataset + calib_indicator + '_' + args.model + '_baseline')
+    if model_name is None:
         assert False, "could not resume"
+    net.load_state_dict(load_model_state(model_name))
+    print('Model restored! Epoch:', i)
+    start_epoch = i + 1
 
-if args.ngpu > 1:
-    net = torch.nn.DataParallel(net, device_ids=list(range(args.ngpu)))
+net = wrap_ddp(setup_model(net, device, args.ngpu, args.channels_last), device)
 
-if args.ngpu > 0:
-    net.cuda()
+if device.type == 'cuda':
     torch.cuda.manual_seed(1)
 
 cudnn.benchmark = True  # fire on all cylinders
@@ -185,6 +211,7 @@ cudnn.benchmark = True  # fire on all cylinders
 optimizer = torch.optim.SGD(
     net.parameters(), state['learning_rate'], momentum=state['momentum'],
     weight_decay=state['decay'], nesterov=True)
+scaler = grad_scaler(device, args.amp)
 
 
 def cosine_annealing(step, total_steps, lr_max, lr_min):
@@ -199,27 +226,41 @@ scheduler = torch.optim.lr_scheduler.LambdaLR(
         1,  # since lr_lambda computes multiplicative factor
         1e-6 / args.learning_rate))
 
+# full-state checkpoints of this run; the best test accuracy is kept as <run>_best.pt
+checkpoints = CheckpointManager(args.save, args.dataset + calib_indicator + '_' + args.model + '_pretrained',
+                                net, optimizer, scheduler, scaler, best_modes={'test_accuracy': 'max'},
+                                resume=args.resume,
+                                save_every=args.save_every, main=rank == 0)
+start_iter = 0
+if args.resume:
+    start_epoch, start_iter = checkpoints.resume()
+
 
 # /////////////// Training ///////////////
 
-def train():
+def train(epoch, start_iter=0):
     net.train()  # enter train mode
     loss_avg = 0.0
-    for data, target in train_loader:
-        data, target = data.cuda(), target.cuda()
+    for iteration, (data, target) in enumerate(train_loader, start_iter):
+        data, target = to_device(data, net), target.to(device)
 
-        # forward
-        x = net(data)
+        # forward; under --amp only the network runs in reduced precision, the loss is fp32
+        with amp_autocast(device, args.amp):
+            x = net(data)
         # backward
         optimizer.zero_grad()
-        loss = F.cross_entropy(x, target)
-        loss.backward()
-        optimizer.step()
+        loss = F.cross_entropy(x.float(), target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
 
         # exponential moving average
         loss_avg = loss_avg * 0.8 + float(loss) * 0.2
 
+        # periodic (--save_every) checkpoints, and after a SIGTERM: checkpoint this position and exit
+        checkpoints.after_step(epoch, iteration + 1)
+
     state['train_loss'] = loss_avg
 
 
@@ -228,12 +269,15 @@ def test():
     net.eval()
     loss_avg = 0.0
     correct = 0
-    with torch.no_grad():
+    batches = 0
+    with torch.inference_mode():
         for data, target in test_loader:
-            data, target = data.cuda(), target.cuda()
+            data, target = to_device(data, net), target.to(device)
 
             # forward
-            output = net(data)
+            with amp_autocast(device, args.amp):
+                output = net(data)
+            output = output.float()
             loss = F.cross_entropy(output, target)
 
             # accuracy
@@ -242,9 +286,12 @@ def test():
 
             # test loss average
             loss_avg += float(loss.data)
+            batches += 1
 
-    state['test_loss'] = loss_avg / len(test_loader)
-    state['test_accuracy'] = correct / len(test_loader.dataset)
+    # totals over the shards of all processes
+    loss_avg, correct, batches = all_reduce_values([loss_avg, correct, batches])
+    state['test_loss'] = loss_avg / batches
+    state['test_accuracy'] = correct / len(test_data)
 
 
 if args.test:
@@ -253,48 +300,48 @@ if args.test:
     exit()
 
 # Make save directory
-if not os.path.exists(args.save):
-    os.makedirs(args.save)
-if not os.path.isdir(args.save):
-    raise Exception('%s is not a dir' % args.save)
-
-with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
-                                  '_pretrained_training_results.csv'), 'w') as f:
-    f.write('epoch,time(s),train_loss,test_loss,test_error(%)\n')
+if rank == 0:
+    if not os.path.exists(args.save):
+        os.makedirs(args.save)
+    if not os.path.isdir(args.save):
+        raise Exception('%s is not a dir' % args.save)
+
+# a resumed run appends to its results
+if rank == 0 and not (args.resume and (start_epoch, start_iter) != (0, 0)):
+    with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
+                                      '_pretrained_training_results.csv'), 'w') as f:
+        f.write('epoch,time(s),train_loss,test_loss,test_error(%)\n')
 
 print('Beginning Training\n')
 
-# Main loop
-best_acc = 0
+checkpoints.handle_sigterm()
 
+# Main loop
 for epoch in range(start_epoch, args.epochs):
     state['epoch'] = epoch
 
     begin_epoch = time.time()
 
-    train()
+    epoch_start_iter = start_iter if epoch == start_epoch else 0
+    train_sampler.set_epoch(epoch, epoch_start_iter * batch_size)
+    train(epoch, epoch_start_iter)
     test()
 
-    # Save model
-    torch.save(net.state_dict(),
-               os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
-                            '_pretrained_epoch_' + str(epoch) + '.pt'))
-    # Let us not waste space and delete the previous model
-    prev_path = os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
-                             '_pretrained_epoch_' + str(epoch - 1) + '.pt')
-    if os.path.exists(prev_path): os.remove(prev_path)
+    # Save model; the previous epoch's checkpoint is deleted, the best one is kept
+    checkpoints.save_epoch(epoch, {'test_accuracy': state['test_accuracy']})
 
     # Show results
 
-    with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
-                                      '_pretrained_training_results.csv'), 'a') as f:
-        f.write('%03d,%05d,%0.6f,%0.5f,%0.2f\n' % (
-            (epoch + 1),
-            time.time() - begin_epoch,
-            state['train_loss'],
-            state['test_loss'],
-            100 - 100. * state['test_accuracy'],
-        ))
+    if rank == 0:
+        with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model +
+                                          '_pretrained_training_results.csv'), 'a') as f:
+            f.write('%03d,%05d,%0.6f,%0.5f,%0.2f\n' % (
+                (epoch + 1),
+                time.time() - begin_epoch,
+                state['train_loss'],
+                state['test_loss'],
+                100 - 100. * state['test_accuracy'],
+            ))
 
     # # print state with rounded decimals
     # print({k: round(v, 4) if isinstance(v, float) else v for k, v in state.items()})
@@ -307,14 +354,4 @@ for epoch in range(start_epoch, args.epochs):
         100 - 100. * state['test_accuracy'])
     )
 
-    #  Saving best model
-    test_acc = state['test_accuracy']
-    is_best = test_acc > best_acc
-    best_acc = max(test_acc, best_acc)
-
-    save_path = os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model  +
-                            '_pretrained_epoch_' + str(epoch) + '.pt')
-
-    if is_best:
-        shutil.copyfile(save_path, os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model  +
-                            '_pretrained_best' + '.pt'))
+    checkpoints.check_stop(epoch + 1, 0)
@@ -23,7 +23,12 @@ if __package__ is None:
 
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
     from utils.tinyimages_80mn_loader import TinyImages
+    from utils.outlier_stream import OutlierStream
     from utils.validation_dataset import validation_split
+    from utils.tensor_cifar import TensorCIFAR, TensorLoader
+    from utils.checkpoint import CheckpointManager, ResumableRandomSampler, find_checkpoint, load_model_state
+    from utils.device import add_device_args, get_device, setup_model, to_device, amp_autocast, grad_scaler
+    from utils.distributed import init_distributed, wrap_ddp, all_reduce_values, shard_indices
 
 parser = argparse.ArgumentParser(description='Tunes a CIFAR Classifier with OE',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -37,8 +42,15 @@ parser.add_argument('--calibration', '-c', action='store_true',
 # Optimization options
 parser.add_argument('--epochs', '-e', type=int, default=10, help='Number of epochs to train.')
 parser.add_argument('--learning_rate', '-lr', type=float, default=0.001, help='The initial learning rate.')
-parser.add_argument('--batch_size', '-b', type=int, default=128, help='Batch size.')
-parser.add_argument('--oe_batch_size', type=int, default=256, help='Batch size.')
+parser.add_argument('--batch_size', '-b', type=int, default=128,
+                    help='Batch size (over all processes of a torchrun run).')
+parser.add_argument('--oe_batch_size', type=int, default=256,
+                    help='Batch size (over all processes of a torchrun run).')
+parser.add_argument('--oe_ratio', type=float, default=0,
+                    help='Outliers per in-distribution sample in a batch; overrides --oe_batch_size (0 = unused).')
+parser.add_argument('--oe_order', type=str, default='shuffle', choices=['shuffle', 'offset'],
+                    help='Order of every pass over the outlier set: a new permutation, or dataset order from a random offset.')
+parser.add_argument('--oe_prefetch', type=int, default=2, help='Outlier batches loaded ahead of training.')
 parser.add_argument('--test_bs', type=int, default=200)
 parser.add_argument('--momentum', type=float, default=0.9, help='Momentum.')
 parser.add_argument('--decay', '-d', type=float, default=0.0005, help='Weight decay (L2 penalty).')
@@ -52,10 +64,19 @@ parser.add_argument('--droprate', default=0.3, type=float, help='dropout probabi
 parser.add_argument('--save', '-s', type=str, default='./snapshots/tune_sr', help='Folder to save checkpoints.')
 parser.add_argument('--load', '-l', type=str, default='./snapshots/pretrained', help='Checkpoint path to resume / test.')
 parser.add_argument('--test', '-t', action='store_true', help='Test only flag.')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue the run in --save from its latest checkpoint (optimizer, schedule, RNG and data order included).')
+parser.add_argument('--save_every', type=int, default=0,
+                    help='Also checkpoint every N training steps (0 = only after every epoch).')
 
 # Acceleration
 parser.add_argument('--ngpu', type=int, default=1, help='0 = CPU.')
 parser.add_argument('--prefetch', type=int, default=4, help='Pre-fetching threads.')
+add_device_args(parser)
+parser.add_argument('--amp', action='store_true',
+                    help='Mixed-precision training: fp16 autocast with loss scaling on cuda, bf16 autocast on the CPU.')
+parser.add_argument('--tensor_data', action='store_true',
+                    help='Hold CIFAR as one uint8 tensor on the device and augment whole batches there (no loader workers).')
 
 # EG specific
 parser.add_argument('--score', type=str, default='OE', help='OE|energy')
@@ -66,13 +87,23 @@ parser.add_argument('--alpha', type=float, default=0.02, help='hyperparameter al
 parser.add_argument('--beta', type=float, default=0.5, help='hyperparameter beta.')
 
 args = parser.parse_args()
+if args.oe_ratio > 0:
+    args.oe_batch_size = int(round(args.batch_size * args.oe_ratio))
 
-if os.path.isdir(args.save) == False:
+# under torchrun, one process per GPU or per share of the CPU cores; only rank 0 prints and writes files
+device, rank, world_size = init_distributed(get_device(args))
+for name in ['batch_size', 'oe_batch_size']:
+    if getattr(args, name) % world_size != 0:
+        raise Exception('{} {} is not divisible by {} processes'.format(name, getattr(args, name), world_size))
+batch_size, oe_batch_size = args.batch_size // world_size, args.oe_batch_size // world_size
+
+if rank == 0 and os.path.isdir(args.save) == False:
     os.mkdir(args.save)
 state = {k: v for k, v in args._get_kwargs()}
 print(state)
 
-torch.manual_seed(1)
+# a random stream per process (dropout, augmentation); DDP copies the initial weights of rank 0
+torch.manual_seed(1 + rank)
 np.random.seed(args.seed)
 
 if args.machine == 'remote':
@@ -124,20 +155,29 @@ ood_data = dset.ImageFolder(
      # trn.RandomHorizontalFlip(), trn.ToTensor(), trn.Normalize(mean, std)]))
 
 
-train_loader_in = torch.utils.data.DataLoader(
-    train_data_in,
-    batch_size=args.batch_size, shuffle=True,
-    num_workers=args.prefetch, pin_memory=True)
+# the data order of every epoch is fixed by the seed, so a run can resume in the middle of an epoch
+# (and sharded over the processes of a distributed run, like DistributedSampler)
+train_sampler = ResumableRandomSampler(train_data_in, seed=args.seed, num_replicas=world_size, rank=rank)
+# every process tests its share of the test set
+test_sampler = shard_indices(len(test_data), rank, world_size)
 
-train_loader_out = torch.utils.data.DataLoader(
-    ood_data,
-    batch_size=args.oe_batch_size, shuffle=False,
-    num_workers=args.prefetch, pin_memory=True)
+if args.tensor_data:
+    # the same augmentation as train_transform (RandomCrop without padding only flips), applied to whole batches
+    train_loader_in = TensorLoader(TensorCIFAR(train_data_in, mean, std, device), batch_size,
+                                   sampler=train_sampler, flip=True)
+else:
+    train_loader_in = torch.utils.data.DataLoader(
+        train_data_in,
+        batch_size=batch_size, sampler=train_sampler, generator=train_sampler.generator,
+        num_workers=args.prefetch, pin_memory=True)
 
-test_loader = torch.utils.data.DataLoader(
-    test_data,
-    batch_size=args.batch_size, shuffle=False,
-    num_workers=args.prefetch, pin_memory=True)
+if args.tensor_data:
+    test_loader = TensorLoader(TensorCIFAR(test_data, mean, std, device), args.batch_size, sampler=test_sampler)
+else:
+    test_loader = torch.utils.data.DataLoader(
+        test_data,
+        batch_size=args.batch_size, sampler=test_sampler,
+        num_workers=args.prefetch, pin_memory=True)
 
 # Create model
 if args.model == 'allconv':
@@ -160,29 +200,20 @@ def recursion_change_bn(module):
     return module
 
 # Restore model
-model_found = False
 if args.load != '':
-    for i in range(1000 - 1, -1, -1):
-        
-        model_name = os.path.join(args.load, args.dataset + calib_indicator + '_' + args.model +
-                                  '_pretrained_epoch_' + str(i) + '.pt')
-
-        # model_name = os.path.join(args.load, args.dataset + calib_indicator + '_' + args.model +
-        #                           '_pretrained_best.pt')
-
-        if os.path.isfile(model_name):
-            net.load_state_dict(torch.load(model_name))
-            print('Model restored! Epoch:', i)
-            model_found = True
-            break
-    if not model_found:
+    model_name, i = find_checkpoint(args.load, args.dataset + calib_indicator + '_' + args.model + '_pretrained')
+
+    # model_name, i = find_checkpoint(args.load, args.dataset + calib_indicator + '_' + args.model + '_pretrained',
+    #                                 which='best')
+
+    if model_name is None:
         assert False, "could not find model to restore"
+    net.load_state_dict(load_model_state(model_name))
+    print('Model restored! Epoch:', i)
 
-if args.ngpu > 1:
-    net = torch.nn.DataParallel(net, device_ids=list(range(args.ngpu)))
+net = wrap_ddp(setup_model(net, device, args.ngpu, args.channels_last), device)
 
-if args.ngpu > 0:
-    net.cuda()
+if device.type == 'cuda':
     torch.cuda.manual_seed(1)
 
 cudnn.benchmark = True  # fire on all cylinders
@@ -190,6 +221,7 @@ cudnn.benchmark = True  # fire on all cylinders
 optimizer = torch.optim.SGD(
     net.parameters(), state['learning_rate'], momentum=state['momentum'],
     weight_decay=state['decay'], nesterov=True)
+scaler = grad_scaler(device, args.amp)
 
 
 def cosine_annealing(step, total_steps, lr_max, lr_min):
@@ -205,6 +237,20 @@ scheduler = torch.optim.lr_scheduler.LambdaLR(
         1,  # since lr_lambda computes multiplicative factor
         1e-6 / args.learning_rate))
 
+# full-state checkpoints of this run
+checkpoints = CheckpointManager(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) +
+                                '_tune', net, optimizer, scheduler, scaler, resume=args.resume,
+                                save_every=args.save_every, main=rank == 0)
+start_epoch, start_iter = 0, 0
+if args.resume:
+    start_epoch, start_iter = checkpoints.resume()
+
+# an endless outlier stream in a new order every pass (each process reads its shard), loaded ahead of training;
+# its position follows the training steps, so a resumed run continues with the outliers it would have seen
+train_loader_out = OutlierStream(ood_data, oe_batch_size, seed=args.seed, num_replicas=world_size, rank=rank,
+                                 order=args.oe_order, start=(start_epoch * len(train_loader_in) + start_iter) *
+                                 oe_batch_size, num_workers=args.prefetch, prefetch=args.oe_prefetch, pin_memory=True)
+
 
 class OELoss(nn.Module):
     def __init__(self):
@@ -213,77 +259,98 @@ class OELoss(nn.Module):
     def forward(self, x):
         return -(x.mean(1) - torch.logsumexp(x, dim=1)).mean()
 
-oe_criterion = OELoss().cuda()
+oe_criterion = OELoss().to(device)
+
 
+def average_terms(terms_avg, terms):
+    # exponential moving averages of the unweighted loss terms, read with a single device sync
+    values = torch.stack(list(terms.values())).tolist()
+    return {name: terms_avg.get(name, 0.) * 0.8 + value * 0.2 for name, value in zip(terms, values)}
 
-def train_oe():
+
+def train_oe(epoch, start_iter=0):
     net.train()  # enter train mode
-    loss_avg = 0.0
+    terms_avg = {}
 
-    # start at a random point of the outlier dataset; this induces more randomness without obliterating locality
-    # train_loader_out.dataset.offset = np.random.randint(len(train_loader_out.dataset))
-    for in_set, out_set in zip(train_loader_in, train_loader_out):
-        data = torch.cat((in_set[0], out_set[0]), 0)
+    # the outlier stream never ends, so an epoch is one pass over the in-distribution data
+    for iteration, (in_set, out_set) in enumerate(zip(train_loader_in, train_loader_out), start_iter):
+        # with --tensor_data the CIFAR batch is already on the device, the outliers come from host memory
+        data = torch.cat((to_device(in_set[0], net), to_device(out_set[0], net)), 0)
         target = in_set[1]
         
         # 正常样本的长度
         in_len = len(in_set[0]) 
 
-        data, target = data.cuda(), target.cuda()
+        data, target = to_device(data, net), target.to(device)
 
-        # forward
-        x, vector_feature = net(data)
+        # forward; under --amp only the network runs in reduced precision, the loss terms are fp32
+        with amp_autocast(device, args.amp):
+            x, vector_feature = net(data)
+        x, vector_feature = x.float(), vector_feature.float()
 
         optimizer.zero_grad()
 
-        loss = F.cross_entropy(x[:in_len], target)
+        ce_term = F.cross_entropy(x[:in_len], target)
 
         sum_feature = torch.sum(abs(vector_feature), dim=1)
 
         l1_term = torch.mean(sum_feature)
- 
-        loss += args.alpha* l1_term
-   
+
         # loss += args.beta * -(x[len(in_set[0]):].mean(1) - torch.logsumexp(x[len(in_set[0]):], dim=1)).mean()
-        loss += args.beta * oe_criterion(x[len(in_set[0]):])
+        oe_term = oe_criterion(x[len(in_set[0]):])
+
+        loss = ce_term + args.alpha* l1_term + args.beta * oe_term
 
         # backward
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
 
         # exponential moving average
-        loss_avg = loss_avg * 0.8 + float(loss) * 0.2
-    state['train_loss'] = loss_avg
+        terms_avg = average_terms(terms_avg, {'loss': loss, 'CE': ce_term, 'L1': l1_term, 'OE': oe_term})
+
+        # periodic (--save_every) checkpoints, and after a SIGTERM: checkpoint this position and exit
+        checkpoints.after_step(epoch, iteration + 1)
+    state['train_loss'] = terms_avg['loss']
+    state['train_terms'] = {name: terms_avg[name] for name in ['CE', 'L1', 'OE']}
+    state['outliers_seen'] = train_loader_out.distinct_seen(all_ranks=True)
 
 
-def train():
+def train(epoch, start_iter=0):
     net.train()  # enter train mode
-    loss_avg = 0.0
-    for data, target in train_loader_in:
-        data, target = data.cuda(), target.cuda()
+    terms_avg = {}
+    for iteration, (data, target) in enumerate(train_loader_in, start_iter):
+        data, target = to_device(data, net), target.to(device)
 
-        # forward
-        x, vector_feature = net(data)
+        # forward; under --amp only the network runs in reduced precision, the loss terms are fp32
+        with amp_autocast(device, args.amp):
+            x, vector_feature = net(data)
+        x, vector_feature = x.float(), vector_feature.float()
 
         optimizer.zero_grad()
-        loss = F.cross_entropy(x, target)
+        ce_term = F.cross_entropy(x, target)
 
         sum_feature = torch.sum(abs(vector_feature), dim=1)
 
         l1_term = torch.mean(sum_feature)
- 
-        loss += args.alpha* l1_term
+
+        loss = ce_term + args.alpha* l1_term
 
         # backward
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
 
         # exponential moving average
-        loss_avg = loss_avg * 0.8 + float(loss) * 0.2
+        terms_avg = average_terms(terms_avg, {'loss': loss, 'CE': ce_term, 'L1': l1_term})
 
-    state['train_loss'] = loss_avg
+        # periodic (--save_every) checkpoints, and after a SIGTERM: checkpoint this position and exit
+        checkpoints.after_step(epoch, iteration + 1)
+
+    state['train_loss'] = terms_avg['loss']
+    state['train_terms'] = {name: terms_avg[name] for name in ['CE', 'L1']}
 
 
 # test function
@@ -291,12 +358,15 @@ def test():
     net.eval()
     loss_avg = 0.0
     correct = 0
-    with torch.no_grad():
+    batches = 0
+    with torch.inference_mode():
         for data, target in test_loader:
-            data, target = data.cuda(), target.cuda()
+            data, target = to_device(data, net), target.to(device)
 
             # forward
-            output,_ = net(data)
+            with amp_autocast(device, args.amp):
+                output,_ = net(data)
+            output = output.float()
             loss = F.cross_entropy(output, target)
 
             # accuracy
@@ -305,9 +375,12 @@ def test():
 
             # test loss average
             loss_avg += float(loss.data)
+            batches += 1
 
-    state['test_loss'] = loss_avg / len(test_loader)
-    state['test_accuracy'] = correct / len(test_loader.dataset)
+    # totals over the shards of all processes
+    loss_avg, correct, batches = all_reduce_values([loss_avg, correct, batches])
+    state['test_loss'] = loss_avg / batches
+    state['test_accuracy'] = correct / len(test_data)
 
 
 if args.test:
@@ -316,55 +389,57 @@ if args.test:
     exit()
 
 # Make save directory
-if not os.path.exists(args.save):
-    os.makedirs(args.save)
-if not os.path.isdir(args.save):
-    raise Exception('%s is not a dir' % args.save)
+if rank == 0:
+    if not os.path.exists(args.save):
+        os.makedirs(args.save)
+    if not os.path.isdir(args.save):
+        raise Exception('%s is not a dir' % args.save)
 
 # with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) + 
 #                                   '_' + save_info+'_training_results.csv'), 'w') as f:
 
-with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) + 
-                                  '_tune_training_results.csv'), 'w') as f:
+# a resumed run appends to its results
+if rank == 0 and not (args.resume and (start_epoch, start_iter) != (0, 0)):
+    with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) + 
+                                      '_tune_training_results.csv'), 'w') as f:
 
-    f.write('epoch,time(s),train_loss,test_loss,test_error(%)\n')
+        f.write('epoch,time(s),train_loss,test_loss,test_error(%)\n')
 
 print('Beginning Training\n')
 
+checkpoints.handle_sigterm()
+
 # Main loop
-for epoch in range(0, args.epochs):
+for epoch in range(start_epoch, args.epochs):
     state['epoch'] = epoch
 
     begin_epoch = time.time()
 
+    epoch_start_iter = start_iter if epoch == start_epoch else 0
+    train_sampler.set_epoch(epoch, epoch_start_iter * batch_size)
+
     # tune with Sparsity Regularization
-    train()
+    train(epoch, epoch_start_iter)
 
     # tune with SROE
-    # train_oe()
+    # train_oe(epoch, epoch_start_iter)
 
     test()
  
-    # Save model
-    torch.save(net.state_dict(),
-               os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) +  
-                            '_tune_epoch_' + str(epoch) + '.pt'))
-    
-               # Let us not waste space and delete the previous model
-    prev_path = os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) +  
-                             '_tune_epoch_'+ str(epoch - 1) + '.pt')
-    if os.path.exists(prev_path): os.remove(prev_path)
+    # Save model; the previous epoch's checkpoint is deleted
+    checkpoints.save_epoch(epoch)
 
     # Show results
-    with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) +  
-                                      '_tune_training_results.csv'), 'a') as f:
-        f.write('%03d,%05d,%0.6f,%0.5f,%0.2f\n' % (
-            (epoch + 1),
-            time.time() - begin_epoch,
-            state['train_loss'],
-            state['test_loss'],
-            100 - 100. * state['test_accuracy'],
-        ))
+    if rank == 0:
+        with open(os.path.join(args.save, args.dataset + calib_indicator + '_' + args.model + '_s' + str(args.seed) +
+                                          '_tune_training_results.csv'), 'a') as f:
+            f.write('%03d,%05d,%0.6f,%0.5f,%0.2f\n' % (
+                (epoch + 1),
+                time.time() - begin_epoch,
+                state['train_loss'],
+                state['test_loss'],
+                100 - 100. * state['test_accuracy'],
+            ))
 
     # # print state with rounded decimals
     # print({k: round(v, 4) if isinstance(v, float) else v for k, v in state.items()})
@@ -375,4 +450,10 @@ for epoch in range(0, args.epochs):
         state['train_loss'],
         state['test_loss'],
         100 - 100. * state['test_accuracy'])
+        + ''.join(' | {} {:.4f}'.format(name, value) for name, value in state['train_terms'].items())
+        + (' | Outliers seen {}'.format(state['outliers_seen']) if 'outliers_seen' in state else '')
     )
+
+    checkpoints.check_stop(epoch + 1, 0)
+
+train_loader_out.close()
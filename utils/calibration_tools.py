@@ -1,37 +1,33 @@
 import numpy as np
+import torch
 
 
-def calib_err(confidence, correct, p='2', beta=100):
-    # beta is target bin size
-    idxs = np.argsort(confidence)
-    confidence = confidence[idxs]
-    correct = correct[idxs]
-    bins = [[i * beta, (i + 1) * beta] for i in range(len(confidence) // beta)]
-    bins[-1] = [bins[-1][0], len(confidence)]
-
-    cerr = 0
-    total_examples = len(confidence)
-    for i in range(len(bins) - 1):
-        bin_confidence = confidence[bins[i][0]:bins[i][1]]
-        bin_correct = correct[bins[i][0]:bins[i][1]]
-        num_examples_in_bin = len(bin_confidence)
-
-        if num_examples_in_bin > 0:
-            difference = np.abs(np.nanmean(bin_confidence) - np.nanmean(bin_correct))
-
-            if p == '2':
-                cerr += num_examples_in_bin / total_examples * np.square(difference)
-            elif p == '1':
-                cerr += num_examples_in_bin / total_examples * difference
-            elif p == 'infty' or p == 'infinity' or p == 'max':
-                cerr = np.maximum(cerr, difference)
-            else:
-                assert False, "p must be '1', '2', or 'infty'"
+def _bin_errors(confidence_sums, correct_sums, counts, p):
+    # calibration error from per-bin sums of the confidences and of the correct indicators
+    nonempty = counts > 0
+    counts = counts[nonempty]
+    difference = np.abs(confidence_sums[nonempty] - correct_sums[nonempty]) / counts
+    weights = counts / counts.sum()
 
     if p == '2':
-        cerr = np.sqrt(cerr)
+        return np.sqrt(np.sum(weights * np.square(difference)))
+    elif p == '1':
+        return np.sum(weights * difference)
+    elif p == 'infty' or p == 'infinity' or p == 'max':
+        return np.max(difference)
+    else:
+        assert False, "p must be '1', '2', or 'infty'"
+
+
+def calib_err(confidence, correct, p='2', beta=100):
+    # beta is target bin size: bins of beta consecutive confidences, the last one takes the remainder
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+    idxs = np.argsort(confidence)
+    starts = beta * np.arange(max(len(confidence) // beta, 1))
 
-    return cerr
+    counts = np.diff(np.r_[starts, len(confidence)])
+    return _bin_errors(np.add.reduceat(confidence[idxs], starts), np.add.reduceat(correct[idxs], starts), counts, p)
 
 
 def soft_f1(confidence, correct):
@@ -47,40 +43,92 @@ def soft_f1(confidence, correct):
     return 2 * ((1 - confidence) * wrong).sum()/(1 - confidence + wrong).sum()
 
 
-def tune_temp(logits, labels, binary_search=True, lower=0.2, upper=5.0, eps=0.0001):
-    logits = np.array(logits)
-
-    if binary_search:
-        import torch
-        import torch.nn.functional as F
-
-        logits = torch.FloatTensor(logits)
-        labels = torch.LongTensor(labels)
-        t_guess = torch.FloatTensor([0.5*(lower + upper)]).requires_grad_()
-
-        while upper - lower > eps:
-            if torch.autograd.grad(F.cross_entropy(logits / t_guess, labels), t_guess)[0] > 0:
-                upper = 0.5 * (lower + upper)
-            else:
-                lower = 0.5 * (lower + upper)
-            t_guess = t_guess * 0 + 0.5 * (lower + upper)
-
-        t = min([lower, 0.5 * (lower + upper), upper], key=lambda x: float(F.cross_entropy(logits / x, labels)))
-    else:
-        import cvxpy as cx
-
-        set_size = np.array(logits).shape[0]
-
-        t = cx.Variable()
-
-        expr = sum((cx.Minimize(cx.log_sum_exp(logits[i, :] * t) - logits[i, labels[i]] * t)
-                    for i in range(set_size)))
-        p = cx.Problem(expr, [lower <= t, t <= upper])
-
-        p.solve()   # p.solve(solver=cx.SCS)
-        t = 1 / t.value
-
-    return t
+def calibration_measures(confidence, correct, num_bins=15):
+    '''
+    ECE, MCE and RMS calibration error over num_bins equal-width confidence bins, and the soft F1
+    score, from one bincount pass
+    '''
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+    bins = np.minimum((confidence * num_bins).astype(np.int64), num_bins - 1)
+    sums = [np.bincount(bins, weights=w, minlength=num_bins) for w in [confidence, correct, None]]
+
+    return {'ece': _bin_errors(sums[0], sums[1], sums[2], '1'), 'mce': _bin_errors(sums[0], sums[1], sums[2], 'max'),
+            'rms': _bin_errors(sums[0], sums[1], sums[2], '2'), 'sf1': soft_f1(confidence, correct)}
+
+
+def confidence_correct(logits, labels, T=1.):
+    '''
+    max softmax probability at temperature T, whether the prediction is right, and the mean NLL
+    '''
+    logits = torch.as_tensor(np.array(logits)).float() / T
+    labels = torch.as_tensor(np.array(labels)).long().to(logits.device)
+    log_probs = torch.log_softmax(logits, dim=1)
+    confidence, preds = log_probs.max(1)
+    nll = -log_probs.gather(1, labels[:, None]).mean()
+
+    return confidence.exp().cpu().numpy(), (preds == labels).cpu().numpy().astype(np.float64), float(nll)
+
+
+def _nll_derivatives(logits, labels, s):
+    # first and second derivative of the mean NLL of softmax(s * logits) in the inverse temperature s:
+    # the mean of E_p[z] - z_y and the mean of Var_p[z]
+    probs = torch.softmax(s * logits, dim=1)
+    expected = (probs * logits).sum(1)
+    variance = (probs * logits * logits).sum(1) - expected * expected
+    return float((expected - logits.gather(1, labels[:, None])[:, 0]).mean()), float(variance.mean())
+
+
+def tune_temp(logits, labels, method='newton', lower=0.2, upper=5.0, eps=0.0001, max_iter=100, device=None):
+    '''
+    The temperature in [lower, upper] minimising the NLL of softmax(logits / T) on held-out data.
+    The NLL is convex in s = 1 / T, so method 'newton' (default) takes safeguarded Newton steps on s,
+    falling back to bisection whenever a step leaves the current bracket; 'bisection' only bisects,
+    'lbfgs' runs torch.optim.LBFGS on log T. Everything runs on device (default: that of logits).
+    '''
+    logits = torch.as_tensor(np.array(logits) if not torch.is_tensor(logits) else logits)
+    if device is not None:
+        logits = logits.to(device)
+    logits = logits.double()
+    labels = torch.as_tensor(np.array(labels) if not torch.is_tensor(labels) else labels).long().to(logits.device)
+
+    if method == 'lbfgs':
+        log_t = torch.zeros(1, dtype=logits.dtype, device=logits.device, requires_grad=True)
+        # eps is a bracket width for the other methods; LBFGS stops on its own (much tighter) tolerances
+        optimizer = torch.optim.LBFGS([log_t], lr=1, max_iter=max_iter, tolerance_change=1e-12, tolerance_grad=1e-9,
+                                      line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = torch.nn.functional.cross_entropy(logits / log_t.exp(), labels)
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        return float(np.clip(np.exp(log_t.item()), lower, upper))
+
+    if method not in ['newton', 'bisection']:
+        raise Exception('unknown temperature scaling method: {}'.format(method))
+
+    # the bracket [lo, hi] always holds the minimiser; the derivative is increasing in s
+    lo, hi = 1. / upper, 1. / lower
+    s = min(max(1., lo), hi)
+    for _ in range(max_iter):
+        grad, hess = _nll_derivatives(logits, labels, s)
+        if grad > 0:
+            hi = s
+        else:
+            lo = s
+        step = grad / hess if method == 'newton' and hess > 0 else np.inf
+        s_next = s - step
+        if not lo < s_next < hi:
+            s_next = 0.5 * (lo + hi)
+        if abs(s_next - s) < eps * s or hi - lo < eps * s:
+            s = s_next
+            break
+        s = s_next
+
+    return 1. / s
 
 
 def get_measures(confidence, correct):
@@ -105,6 +153,14 @@ def print_measures_with_std(rmss, mads, sf1s, method_name='Baseline'):
     print('Soft F1 Score (%):   \t\t{:.2f}\t+/- {:.2f}'.format(100 * np.mean(sf1s), 100 * np.std(sf1s)))
 
 
+def print_calibration_measures(measures, method_name='Baseline'):
+    print('\t\t\t\t\t\t\t' + method_name)
+    print('ECE (%): \t\t\t{:.2f}'.format(100 * measures['ece']))
+    print('MCE (%): \t\t\t{:.2f}'.format(100 * measures['mce']))
+    print('RMS Calib Error (%): \t\t{:.2f}'.format(100 * measures['rms']))
+    print('Soft F1 Score (%):   \t\t{:.2f}'.format(100 * measures['sf1']))
+
+
 def show_calibration_results(confidence, correct, method_name='Baseline'):
 
     print('\t\t\t\t' + method_name)
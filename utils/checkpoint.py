@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import signal
+import threading
+
+import numpy as np
+import torch
+
+from utils.distributed import is_distributed, all_reduce_values
+
+
+checkpoint_version = 1
+
+
+def unwrap(net):
+    return net.module if isinstance(net, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)) else net
+
+
+def atomic_save(obj, path):
+    '''
+    torch.save through a temporary file, so path always holds a complete checkpoint
+    '''
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def manifest_path(save_dir, run_name):
+    return os.path.join(save_dir, run_name + '_manifest.json')
+
+
+def load_manifest(save_dir, run_name):
+    path = manifest_path(save_dir, run_name)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_checkpoint(save_dir, run_name, which='latest'):
+    '''
+    (path, epoch) of the last completed epoch of a run (which='latest') or of its best epoch
+    (which='best', or the name of a tracked metric), read from the run manifest; (None, None) if
+    there is none. Runs saved before the manifest existed are found by probing
+    <run_name>_epoch_<i>.pt for i = 999 ... 0.
+    '''
+    manifest = load_manifest(save_dir, run_name)
+    if manifest is None:
+        for i in range(1000 - 1, -1, -1):
+            path = os.path.join(save_dir, run_name + '_epoch_' + str(i) + '.pt')
+            if os.path.isfile(path):
+                return path, i
+        return None, None
+
+    if which == 'latest':
+        if len(manifest['epochs']) == 0:
+            return None, None
+        epoch = max(int(e) for e in manifest['epochs'])
+        return os.path.join(save_dir, manifest['epochs'][str(epoch)]), epoch
+
+    best = manifest['best']
+    if which == 'best':
+        which = next(iter(best), None)
+    if which not in best:
+        return None, None
+    return os.path.join(save_dir, best[which]['file']), best[which]['epoch']
+
+
+def load_model_state(path):
+    '''
+    the model state_dict of a checkpoint file, either a full checkpoint (CheckpointManager) or a plain state_dict
+    '''
+    obj = torch.load(path, map_location='cpu')
+    if isinstance(obj, dict) and 'checkpoint_version' in obj:
+        return obj['model']
+    return obj
+
+
+def snapshot(obj):
+    '''
+    a copy of a (nested) state dict that training can no longer change: tensors are copied to host
+    memory, and numpy scalars (e.g. learning rates from a numpy schedule) become python numbers, so
+    the checkpoint loads with torch.load(weights_only=True)
+    '''
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    return obj.item() if isinstance(obj, np.generic) else obj
+
+
+def get_rng_state():
+    np_state = np.random.get_state()
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            # as a tensor, so checkpoints stay loadable with torch.load(weights_only=True)
+            'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), int(np_state[2]), int(np_state[3]),
+                      float(np_state[4])),
+            'python': random.getstate()}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32)) + tuple(np_state[2:]))
+    random.setstate(state['python'])
+
+
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    '''
+    Shuffles like RandomSampler, but the order of an epoch only depends on (seed, epoch) and can be
+    entered at any position, so a run resumed from a mid-epoch checkpoint visits the remaining
+    samples of the interrupted epoch in the original order.
+    len() is always a whole epoch, so a schedule computed from len(loader) is the same whether or
+    not a run was resumed.
+    With num_replicas processes (DistributedSampler), every process draws the same epoch order and
+    takes every num_replicas-th sample from rank on; the order is padded with its first samples to a
+    multiple of num_replicas, so all processes run the same number of steps. start counts the
+    samples of this process.
+    generator: for DataLoader(generator=...), so that the loader draws its worker seeds from a
+    generator reseeded every epoch instead of from the global RNG, whose state is checkpointed
+    '''
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.dataset_size = len(data_source)
+        self.num_samples = (self.dataset_size + num_replicas - 1) // num_replicas
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.generator = torch.Generator()
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+        self.generator.manual_seed((self.seed * 100003 + epoch) * self.num_replicas + self.rank)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 100003 + self.epoch)
+        order = torch.randperm(self.dataset_size, generator=generator)
+        total_size = self.num_samples * self.num_replicas
+        if total_size > self.dataset_size:
+            order = torch.cat([order, order[:total_size - self.dataset_size]])
+        order = order[self.rank:total_size:self.num_replicas][self.start:]
+        # the start position only applies to the epoch it was set for
+        self.start = 0
+        return iter(order.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class BackgroundWriter(object):
+    '''
+    Runs file writes in order on a background thread, so the training loop only waits for disk I/O
+    when more than max_pending jobs are queued. Pending jobs are finished by flush, which also runs
+    at interpreter exit (including sys.exit after a SIGTERM); an error in a job is raised by the next
+    submit or flush.
+    '''
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if self.error is None:
+                    job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception('background checkpoint write failed') from error
+
+    def submit(self, job):
+        self.check()
+        self.jobs.put(job)
+
+    def flush(self):
+        self.jobs.join()
+        self.check()
+
+
+class CheckpointManager(object):
+    '''
+    Full-state checkpoints of a training run in save_dir: model, optimizer, LR scheduler, grad
+    scaler, RNG states and the position in the data order (epoch and batch), each written atomically.
+    <run_name>_manifest.json maps the completed epochs and the best epoch of every metric in
+    best_modes ({name: 'max' | 'min'}) to their files, so resuming and test-time lookup read one
+    file instead of probing for checkpoint names.
+    Epoch checkpoints are <run_name>_epoch_<e>.pt (the last keep_last are kept), the best ones
+    <run_name>_best.pt (<run_name>_best_<metric>.pt for several metrics) and a mid-epoch one
+    <run_name>_last.pt, also written every save_every training steps (0 = never).
+    The state is copied to host memory in the training loop and serialized by a BackgroundWriter
+    (background=False writes in the loop). Every file is complete before the manifest names it.
+    With handle_sigterm, a SIGTERM only sets stop_requested; after_step then saves the current
+    position and exits between two training steps.
+    In a distributed run every process has a manager, but only the main one (rank 0) writes files;
+    all of them load the checkpoint on resume, and a SIGTERM received by any process stops all of
+    them after the same step: the processes agree on the flag every sync_every steps (and at
+    --save_every boundaries), not after every step, so the check adds no round-trip to most steps.
+    '''
+    def __init__(self, save_dir, run_name, net, optimizer=None, scheduler=None, scaler=None,
+                 best_modes=None, keep_last=1, resume=False, save_every=0, background=True, max_pending=2,
+                 main=True, sync_every=20):
+        self.save_dir = save_dir
+        self.run_name = run_name
+        self.net = net
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.scaler = scaler
+        self.best_modes = best_modes or {}
+        self.keep_last = keep_last
+        self.save_every = save_every
+        self.main = main
+        self.sync_every = sync_every
+        self.writer = BackgroundWriter(max_pending) if background and main else None
+        self.stop_requested = False
+        self.steps = 0
+
+        manifest = load_manifest(save_dir, run_name) if resume else None
+        self.manifest = manifest or {'run': run_name, 'epochs': {}, 'best': {}, 'latest': None}
+
+    def handle_sigterm(self):
+        def request_stop(signum, frame):
+            print('SIGTERM: saving a checkpoint after this step')
+            self.stop_requested = True
+        signal.signal(signal.SIGTERM, request_stop)
+
+    def state(self, epoch, iteration):
+        # position: the epoch and the batch within it at which training continues, and the steps taken so far
+        state = {'checkpoint_version': checkpoint_version,
+                 'position': {'epoch': epoch, 'iteration': iteration, 'steps': self.steps},
+                 'model': unwrap(self.net).state_dict(), 'rng': get_rng_state()}
+        for name in ['optimizer', 'scheduler', 'scaler']:
+            module = getattr(self, name)
+            if module is not None:
+                state[name] = module.state_dict()
+        return snapshot(state)
+
+    def submit(self, job):
+        if not self.main:
+            return
+        if self.writer is None:
+            job()
+        else:
+            self.writer.submit(job)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def write_manifest(self, text):
+        path = manifest_path(self.save_dir, self.run_name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+    def remove(self, name):
+        path = os.path.join(self.save_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save_epoch(self, epoch, metrics=None):
+        '''
+        checkpoint after a completed epoch; metrics ({name: value}) update the best checkpoints
+        '''
+        name = self.run_name + '_epoch_' + str(epoch) + '.pt'
+        state = self.state(epoch + 1, 0)
+
+        links = []
+        for metric, value in (metrics or {}).items():
+            if metric not in self.best_modes:
+                continue
+            best = self.manifest['best'].get(metric)
+            better = max if self.best_modes[metric] == 'max' else min
+            if best is None or better(value, best['value']) != best['value']:
+                best_name = self.run_name + ('_best.pt' if len(self.best_modes) == 1 else '_best_' + metric + '.pt')
+                links.append(best_name)
+                self.manifest['best'][metric] = {'file': best_name, 'epoch': epoch, 'value': value}
+
+        epochs = self.manifest['epochs']
+        epochs[str(epoch)] = name
+        stale = sorted(int(e) for e in epochs)[:-self.keep_last] if self.keep_last > 0 else []
+        old_files = [epochs.pop(str(e)) for e in stale]
+        partial = self.manifest['latest']
+        if partial is not None and partial != name and partial not in epochs.values():
+            old_files.append(partial)
+        self.manifest['latest'] = name
+        manifest = json.dumps(self.manifest, indent=2)
+
+        def job():
+            atomic_save(state, os.path.join(self.save_dir, name))
+            for best_name in links:
+                self.link(name, best_name)
+            # the manifest only points to complete files, and files are removed once it no longer does
+            self.write_manifest(manifest)
+            for old in old_files:
+                self.remove(old)
+        self.submit(job)
+
+    def save_partial(self, epoch, iteration):
+        '''
+        checkpoint inside an epoch, after its first iteration batches
+        '''
+        name = self.run_name + '_last.pt'
+        state = self.state(epoch, iteration)
+        self.manifest['latest'] = name
+        manifest = json.dumps(self.manifest, indent=2)
+
+        def job():
+            atomic_save(state, os.path.join(self.save_dir, name))
+            self.write_manifest(manifest)
+        self.submit(job)
+
+    def link(self, name, link_name):
+        # a hard link shares the epoch file's data, so keeping the best checkpoint costs no copy
+        src, dst = os.path.join(self.save_dir, name), os.path.join(self.save_dir, link_name)
+        if os.path.exists(dst + '.tmp'):
+            os.remove(dst + '.tmp')
+        try:
+            os.link(src, dst + '.tmp')
+        except OSError:
+            import shutil
+            shutil.copyfile(src, dst + '.tmp')
+        os.replace(dst + '.tmp', dst)
+
+    def resume(self):
+        '''
+        restore everything from the latest checkpoint of the run and return the (epoch, iteration)
+        to continue from; (0, 0) if the run has no checkpoint
+        '''
+        if self.manifest['latest'] is None:
+            return 0, 0
+        path = os.path.join(self.save_dir, self.manifest['latest'])
+        state = torch.load(path, map_location='cpu')
+        unwrap(self.net).load_state_dict(state['model'])
+        for name in ['optimizer', 'scheduler', 'scaler']:
+            module = getattr(self, name)
+            if module is not None and name in state:
+                module.load_state_dict(state[name])
+        # the other processes keep their own random streams (e.g. dropout masks)
+        if self.main:
+            set_rng_state(state['rng'])
+        # the --save_every cadence continues from the interrupted run
+        # (checkpoints without the count: the scheduler steps once per training step)
+        self.steps = state['position'].get('steps', self.scheduler.last_epoch if self.scheduler is not None else 0)
+        print('Resumed from', path, '| epoch', state['position']['epoch'], '| iteration', state['position']['iteration'])
+        return state['position']['epoch'], state['position']['iteration']
+
+    def after_step(self, epoch, iteration):
+        '''
+        call after every training step, with the position (epoch, iteration) training continues from:
+        checkpoints every save_every steps, and exits after a SIGTERM (check_stop)
+        '''
+        self.steps += 1
+        save = self.save_every > 0 and self.steps % self.save_every == 0
+        if save and not self.stop_requested:
+            self.save_partial(epoch, iteration)
+        # the step count is the same in every process, so they all check the flag at the same steps
+        self.check_stop(epoch, iteration, sync=save or self.steps % self.sync_every == 0)
+
+    def check_stop(self, epoch, iteration, sync=True):
+        '''
+        after a SIGTERM: save the position (epoch, iteration), wait for the pending writes and exit;
+        iteration 0 is the start of an epoch, which the checkpoint of the epoch before already holds.
+        In a distributed run the processes only stop at a sync point.
+        '''
+        if is_distributed():
+            if not sync:
+                return
+            # one decision for all processes: the next gradient all-reduce would wait for a stopped process
+            self.stop_requested = all_reduce_values([float(self.stop_requested)], op='max')[0] > 0
+        if self.stop_requested:
+            if iteration > 0:
+                self.save_partial(epoch, iteration)
+            self.flush()
+            sys.exit(143)
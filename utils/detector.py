@@ -0,0 +1,78 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+# outputs of an exported detector, in order
+output_names = ['logits', 'pred', 'energy', 'is_ood']
+
+
+class EnergyDetector(nn.Module):
+    '''
+    A classifier with its input normalization, the energy head and the detection threshold in one graph
+    input: images in [0, 1] (the output of ToTensor), N x 3 x 32 x 32
+    return: logits, predicted class, energy score -T*logsumexp(logits/T) (higher = more OOD, as in
+    score_calculation.get_scores) and the decision energy > threshold (True = OOD)
+    '''
+    def __init__(self, net, mean, std, T=1., threshold=0.):
+        super(EnergyDetector, self).__init__()
+        self.net = net
+        self.register_buffer('mean', torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1))
+        self.register_buffer('T', torch.tensor(float(T)))
+        self.register_buffer('threshold', torch.tensor(float(threshold)))
+
+    def forward(self, x):
+        out = self.net((x - self.mean) / self.std)
+        logits = out[0] if isinstance(out, tuple) else out
+        energy = -self.T * torch.logsumexp(logits / self.T, dim=1)
+        return logits, logits.argmax(1), energy, energy > self.threshold
+
+
+def energy_threshold(in_energy, recall_level):
+    '''
+    the energy below which recall_level of the in-distribution samples fall, i.e. the threshold at
+    which the detector keeps a TPR of recall_level (as in the FPR95 measure)
+    '''
+    return float(np.quantile(np.asarray(in_energy, dtype=np.float64), recall_level))
+
+
+def export_detector(detector, path, batch_size=1):
+    '''
+    save detector as TorchScript (.pt) or ONNX (.onnx, with a dynamic batch dimension)
+    '''
+    detector = detector.cpu().eval()
+    example = torch.rand(batch_size, 3, 32, 32)
+    if path.endswith('.onnx'):
+        torch.onnx.export(detector, (example,), path, input_names=['images'], output_names=output_names,
+                          dynamic_axes={name: {0: 'batch'} for name in ['images'] + output_names}, dynamo=False)
+    else:
+        with torch.inference_mode():
+            torch.jit.save(torch.jit.trace(detector, example), path)
+
+
+def load_detector(path, threads=0):
+    '''
+    load an exported detector for CPU inference (onnxruntime for .onnx files)
+    return: a function of a N x 3 x 32 x 32 float array in [0, 1] -> dict of numpy outputs
+    '''
+    if path.endswith('.onnx'):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception('running an ONNX detector needs onnxruntime (pip install onnxruntime)')
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        return lambda images: dict(zip(output_names, session.run(None, {'images': np.asarray(images, dtype=np.float32)})))
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    module = torch.jit.load(path, map_location='cpu')
+
+    def run(images):
+        with torch.inference_mode():
+            outputs = module(torch.as_tensor(np.asarray(images, dtype=np.float32)))
+        return dict(zip(output_names, [o.numpy() for o in outputs]))
+
+    return run
@@ -0,0 +1,113 @@
+import torch
+
+
+def add_device_args(parser):
+    '''
+    --device, --threads and --channels_last, shared by the training and test scripts
+    '''
+    parser.add_argument('--device', type=str, default='auto',
+                        help="cuda | cuda:N | cpu; auto = cuda when available (and --ngpu > 0), else cpu.")
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op CPU threads (0 = torch default).')
+    parser.add_argument('--channels_last', action='store_true', help='Run convolutions in channels_last memory format.')
+
+
+def get_device(args):
+    '''
+    resolve --device (and the legacy --ngpu 0 = CPU) and apply --threads
+    '''
+    name = args.device
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() and getattr(args, 'ngpu', 1) > 0 else 'cpu'
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    return torch.device(name)
+
+
+def setup_model(net, device, ngpu=1, channels_last=False, bf16=False):
+    '''
+    move net to device, wrapped in DataParallel for ngpu > 1 on cuda
+    the memory format is recorded on the returned module, so to_device can match it for the inputs
+    bf16: for inference only, run the forward passes under bf16 autocast (see AutocastModel)
+    '''
+    if device.type == 'cuda' and ngpu > 1:
+        net = torch.nn.DataParallel(net, device_ids=list(range(ngpu)))
+    net.to(device)
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+    net.channels_last = channels_last
+    if bf16:
+        if bf16_supported(device):
+            net = AutocastModel(net, device)
+        else:
+            print('bf16 is not supported on', device, '- running in fp32')
+    return net
+
+
+def model_device(net):
+    # fully quantized models may have no parameters; they run on the CPU
+    param = next(net.parameters(), None)
+    return param.device if param is not None else torch.device('cpu')
+
+
+def to_device(data, net):
+    '''
+    move a batch of images to the device (and memory format) of net
+    '''
+    data = data.to(model_device(net), non_blocking=True)
+    if getattr(net, 'channels_last', False) and data.dim() == 4:
+        data = data.contiguous(memory_format=torch.channels_last)
+    return data
+
+
+def bf16_supported(device):
+    return device.type == 'cpu' or torch.cuda.is_bf16_supported()
+
+
+def amp_dtype(device):
+    # fp16 on cuda (with loss scaling), bf16 elsewhere: it keeps the fp32 range and needs no scaling
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+
+def amp_autocast(device, enabled=True):
+    '''
+    mixed-precision autocast for training (--amp); a no-op when not enabled
+    '''
+    return torch.autocast(device.type, dtype=amp_dtype(device), enabled=enabled)
+
+
+def grad_scaler(device, enabled=True):
+    '''
+    loss scaler for --amp; only fp16 needs one, so it is disabled (step and backward pass through) for bf16
+    '''
+    return torch.amp.GradScaler(device.type, enabled=enabled and amp_dtype(device) == torch.float16)
+
+
+def to_float(x):
+    if isinstance(x, (tuple, list)):
+        return type(x)(to_float(v) for v in x)
+    return x.float() if torch.is_tensor(x) and x.is_floating_point() else x
+
+
+class AutocastModel(torch.nn.Module):
+    '''
+    Runs the forward passes of a model (forward, feature_list, intermediate_forward) under bf16
+    autocast and returns fp32 outputs, so that the scorers work unchanged
+    '''
+    def __init__(self, net, device):
+        super(AutocastModel, self).__init__()
+        self.net = net
+        self.device_type = device.type
+        self.channels_last = getattr(net, 'channels_last', False)
+
+    def run(self, fn, *args):
+        with torch.autocast(self.device_type, dtype=torch.bfloat16):
+            return to_float(fn(*args))
+
+    def forward(self, x):
+        return self.run(self.net, x)
+
+    def feature_list(self, x):
+        return self.run(self.net.feature_list, x)
+
+    def intermediate_forward(self, x, layer_index):
+        return self.run(self.net.intermediate_forward, x, layer_index)
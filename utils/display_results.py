@@ -1,95 +1,163 @@
 import numpy as np
-import sklearn.metrics as sk
 
 recall_level_default = 0.95
 
 
-def stable_cumsum(arr, rtol=1e-05, atol=1e-08):
-    """Use high precision for cumsum and check that final value matches sum
+def fused_measures(y_score, y_true, recall_levels=(recall_level_default,)):
+    """Every OOD measure from a single sort of the scores
     Parameters
     ----------
-    arr : array-like
-        To be cumulatively summed as flat
-    rtol : float
-        Relative tolerance, see ``np.allclose``
-    atol : float
-        Absolute tolerance, see ``np.allclose``
+    y_score : array, shape (n_rows, n_samples)
+        Scores, one independent problem per row
+    y_true : array, shape (n_rows, n_samples)
+        Binary labels, 1 for the positive class
+    recall_levels : tuple of float
+        Recall levels at which the FPR and the score threshold are reported
+
+    AUROC and AUPR match sklearn's roc_auc_score and average_precision_score, and the FPR is read at
+    the curve vertex whose recall is closest to the recall level (the last one on ties). Rows are
+    kept at full length (tied scores are handled by only using the last position of every run of
+    equal scores as a curve vertex), so many problems of the same size are evaluated in one
+    vectorized call.
     """
-    out = np.cumsum(arr, dtype=np.float64)
-    expected = np.sum(arr, dtype=np.float64)
-    if not np.allclose(out[-1], expected, rtol=rtol, atol=atol):
-        raise RuntimeError('cumsum was found to be unstable: '
-                           'its last element does not correspond to sum')
-    return out
-
-
-def fpr_and_fdr_at_recall(y_true, y_score, recall_level=recall_level_default, pos_label=None):
-    classes = np.unique(y_true)
-    if (pos_label is None and
-            not (np.array_equal(classes, [0, 1]) or
-                     np.array_equal(classes, [-1, 1]) or
-                     np.array_equal(classes, [0]) or
-                     np.array_equal(classes, [-1]) or
-                     np.array_equal(classes, [1]))):
-        raise ValueError("Data is not binary and pos_label is not specified")
-    elif pos_label is None:
-        pos_label = 1.
-
-    # make y_true a boolean vector
-    y_true = (y_true == pos_label)
-
-    # sort scores and corresponding truth values
-    desc_score_indices = np.argsort(y_score, kind="mergesort")[::-1]
-    y_score = y_score[desc_score_indices]
-    y_true = y_true[desc_score_indices]
-
-    # y_score typically has many tied values. Here we extract
-    # the indices associated with the distinct values. We also
-    # concatenate a value for the end of the curve.
-    distinct_value_indices = np.where(np.diff(y_score))[0]
-    threshold_idxs = np.r_[distinct_value_indices, y_true.size - 1]
+    y_score = np.atleast_2d(y_score)
+    y_true = np.atleast_2d(y_true)
+    n = y_score.shape[1]
+    positions = np.arange(n)
 
-    # accumulate the true positives with decreasing threshold
-    tps = stable_cumsum(y_true)[threshold_idxs]
-    fps = 1 + threshold_idxs - tps      # add one because of zero-based indexing
-
-    thresholds = y_score[threshold_idxs]
-
-    recall = tps / tps[-1]
-    
-    last_ind = tps.searchsorted(tps[-1])
-    sl = slice(last_ind, None, -1)      # [last_ind::-1]
-    recall, fps, tps, thresholds = np.r_[recall[sl], 1], np.r_[fps[sl], 0], np.r_[tps[sl], 0], thresholds[sl]
-
-    cutoff = np.argmin(np.abs(recall - recall_level))
+    # sort scores and corresponding truth values, descending
+    desc_score_indices = np.argsort(y_score, axis=1, kind="mergesort")[:, ::-1]
+    y_score = np.take_along_axis(y_score, desc_score_indices, axis=1)
+    y_true = np.take_along_axis(y_true, desc_score_indices, axis=1)
 
-    return fps[cutoff] / (np.sum(np.logical_not(y_true)))   # , fps[cutoff]/(fps[cutoff] + tps[cutoff])
+    # a curve vertex at the end of every run of tied scores
+    vertex = np.ones(y_score.shape, dtype=bool)
+    vertex[:, :-1] = y_score[:, 1:] != y_score[:, :-1]
 
+    # accumulate the true positives with decreasing threshold
+    tps = np.cumsum(y_true, axis=1, dtype=np.float64)
+    fps = 1 + positions - tps       # add one because of zero-based indexing
+    num_pos = tps[:, -1:]
+    num_neg = fps[:, -1:]
+
+    # counts at the previous vertex of every position (0 before the first one)
+    last_vertex = np.maximum.accumulate(np.where(vertex, positions, -1), axis=1)
+    prev_vertex = np.concatenate((np.full((len(y_score), 1), -1), last_vertex[:, :-1]), axis=1)
+    prev_tps = np.where(prev_vertex >= 0, np.take_along_axis(tps, np.maximum(prev_vertex, 0), axis=1), 0.)
+    prev_fps = np.where(prev_vertex >= 0, np.take_along_axis(fps, np.maximum(prev_vertex, 0), axis=1), 0.)
+
+    # trapezoidal ROC area and step-wise average precision, summed over vertices
+    auroc = np.sum(np.where(vertex, (fps - prev_fps) * (tps + prev_tps), 0.), axis=1) / (2 * num_pos * num_neg)[:, 0]
+    aupr_in = np.sum(np.where(vertex, (tps - prev_tps) * tps / (tps + fps), 0.), axis=1) / num_pos[:, 0]
+    # negatives as the positive class: the same vertices read from the other end
+    tns = num_neg - prev_fps
+    aupr_out = np.sum(np.where(vertex, (fps - prev_fps) * tns / (tns + num_pos - prev_tps), 0.),
+                      axis=1) / num_neg[:, 0]
+
+    # FPR at recall: vertices up to the first one with full recall, the last one wins ties
+    first_full = np.argmax(tps >= num_pos, axis=1)[:, None]
+    candidate = vertex & (prev_vertex < first_full)
+    recall = tps / num_pos
+    fpr, threshold = {}, {}
+    for recall_level in recall_levels:
+        distance = np.where(candidate, np.abs(recall - recall_level), np.inf)
+        cutoff = n - 1 - np.argmin(distance[:, ::-1], axis=1)
+        fpr[recall_level] = np.take_along_axis(fps, cutoff[:, None], axis=1)[:, 0] / num_neg[:, 0]
+        threshold[recall_level] = np.take_along_axis(y_score, cutoff[:, None], axis=1)[:, 0]
+
+    return {'auroc': auroc, 'aupr_in': aupr_in, 'aupr_out': aupr_out, 'fpr': fpr, 'threshold': threshold}
+
+
+def fused_measures_torch(y_score, y_true, recall_levels=(recall_level_default,)):
+    """fused_measures for 1-D torch tensors, computed on their device; returns python floats"""
+    import torch
+
+    n = y_score.numel()
+    positions = torch.arange(n, device=y_score.device)
+
+    y_score, desc_score_indices = torch.sort(y_score.reshape(-1), descending=True)
+    y_true = y_true.reshape(-1)[desc_score_indices]
+
+    vertex = torch.ones(n, dtype=torch.bool, device=y_score.device)
+    vertex[:-1] = y_score[1:] != y_score[:-1]
+
+    tps = torch.cumsum(y_true.double(), 0)
+    fps = 1 + positions.double() - tps
+    num_pos = tps[-1]
+    num_neg = fps[-1]
+
+    last_vertex = torch.cummax(torch.where(vertex, positions, torch.full_like(positions, -1)), 0)[0]
+    prev_vertex = torch.cat((last_vertex.new_full((1,), -1), last_vertex[:-1]))
+    prev_tps = torch.where(prev_vertex >= 0, tps[prev_vertex.clamp(min=0)], torch.zeros_like(tps))
+    prev_fps = torch.where(prev_vertex >= 0, fps[prev_vertex.clamp(min=0)], torch.zeros_like(fps))
+
+    zero = torch.zeros_like(tps)
+    auroc = torch.where(vertex, (fps - prev_fps) * (tps + prev_tps), zero).sum() / (2 * num_pos * num_neg)
+    aupr_in = torch.where(vertex, (tps - prev_tps) * tps / (tps + fps), zero).sum() / num_pos
+    tns = num_neg - prev_fps
+    aupr_out = torch.where(vertex, (fps - prev_fps) * tns / (tns + num_pos - prev_tps), zero).sum() / num_neg
+
+    first_full = torch.nonzero(tps >= num_pos)[0, 0]
+    candidate = vertex & (prev_vertex < first_full)
+    recall = tps / num_pos
+    fpr, threshold = {}, {}
+    for recall_level in recall_levels:
+        distance = torch.where(candidate, (recall - recall_level).abs(), torch.full_like(recall, float('inf')))
+        cutoff = n - 1 - int(torch.argmin(distance.flip(0)))
+        fpr[recall_level] = float(fps[cutoff] / num_neg)
+        threshold[recall_level] = float(y_score[cutoff])
+
+    return {'auroc': float(auroc), 'aupr_in': float(aupr_in), 'aupr_out': float(aupr_out),
+            'fpr': fpr, 'threshold': threshold}
+
+
+def get_all_measures(_pos, _neg, recall_levels=(0.8, 0.9, recall_level_default)):
+    """AUROC, AUPR (in and out), and the FPR and detection threshold at several recall levels,
+    all from one sort; with torch tensors the computation stays on their device"""
+    if not isinstance(_pos, np.ndarray) and hasattr(_pos, 'device'):
+        import torch
+        examples = torch.cat((_pos.reshape(-1), _neg.reshape(-1)))
+        labels = torch.zeros_like(examples)
+        labels[:_pos.numel()] = 1
+        return fused_measures_torch(examples, labels, recall_levels)
 
-def get_measures(_pos, _neg, recall_level=recall_level_default):
     pos = np.array(_pos[:]).reshape((-1, 1))
     neg = np.array(_neg[:]).reshape((-1, 1))
-    examples = np.squeeze(np.vstack((pos, neg)))
+    examples = np.squeeze(np.vstack((pos, neg)), axis=1)
     labels = np.zeros(len(examples), dtype=np.int32)
     labels[:len(pos)] += 1
 
-    # fpr, tpr, thresholds = sk.roc_curve(labels, examples)
-    # print(pos[:100])
-    # print(neg[:100])
-    # print(len(labels))
-    # print(len(fpr))
-    # print(len(tpr))
+    measures = fused_measures(examples, labels, recall_levels)
+    return {'auroc': float(measures['auroc'][0]), 'aupr_in': float(measures['aupr_in'][0]),
+            'aupr_out': float(measures['aupr_out'][0]),
+            'fpr': {k: float(v[0]) for k, v in measures['fpr'].items()},
+            'threshold': {k: float(v[0]) for k, v in measures['threshold'].items()}}
 
-    # print(tpr)
-    # print(thresholds)
-    # exit(0)
 
+def get_measures(_pos, _neg, recall_level=recall_level_default):
+    measures = get_all_measures(_pos, _neg, (recall_level,))
 
-    auroc = sk.roc_auc_score(labels, examples)
-    aupr = sk.average_precision_score(labels, examples)
-    fpr = fpr_and_fdr_at_recall(labels, examples, recall_level)
+    return measures['auroc'], measures['aupr_in'], measures['fpr'][recall_level]
 
-    return auroc, aupr, fpr
+
+def get_measures_resampled(_pos, _neg, pos_idxs=None, neg_idxs=None, recall_level=recall_level_default):
+    """get_measures for many resamples of the same scores in one vectorized call
+    :param pos_idxs: (num_replicates, m) indices into _pos, or None to keep every positive
+    :param neg_idxs: (num_replicates, m) indices into _neg, or None to keep every negative
+    :return: arrays of aurocs, auprs, fprs, one entry per replicate
+    """
+    pos = np.asarray(_pos).reshape(-1)
+    neg = np.asarray(_neg).reshape(-1)
+    num_replicates = len(pos_idxs if pos_idxs is not None else neg_idxs)
+
+    pos = pos[pos_idxs] if pos_idxs is not None else np.broadcast_to(pos, (num_replicates, len(pos)))
+    neg = neg[neg_idxs] if neg_idxs is not None else np.broadcast_to(neg, (num_replicates, len(neg)))
+    examples = np.concatenate((pos, neg), axis=1)
+    labels = np.zeros(examples.shape, dtype=np.int32)
+    labels[:, :pos.shape[1]] += 1
+
+    measures = fused_measures(examples, labels, (recall_level,))
+    return measures['auroc'], measures['aupr_in'], measures['fpr'][recall_level]
 
 
 def show_performance(pos, neg, method_name='Ours', recall_level=recall_level_default):
@@ -127,6 +195,16 @@ def print_measures_with_std(aurocs, auprs, fprs, method_name='Ours', recall_leve
     print('AUPR:  \t\t\t{:.2f}\t+/- {:.2f}'.format(100 * np.mean(auprs), 100 * np.std(auprs)))
 
 
+def print_measures_table(rows, recall_level=recall_level_default):
+    '''
+    :param rows: (dataset, method, auroc, aupr, fpr) tuples, printed one line each
+    '''
+    print('{:<14}{:<28}{:>8}{:>8}{:>8}'.format('Dataset', 'Method', 'FPR{:d}'.format(int(100 * recall_level)),
+                                               'AUROC', 'AUPR'))
+    for dataset, method, auroc, aupr, fpr in rows:
+        print('{:<14}{:<28}{:>8.2f}{:>8.2f}{:>8.2f}'.format(dataset, method, 100 * fpr, 100 * auroc, 100 * aupr))
+
+
 def show_performance_comparison(pos_base, neg_base, pos_ours, neg_ours, baseline_name='Baseline',
                                 method_name='Ours', recall_level=recall_level_default):
     '''
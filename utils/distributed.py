@@ -0,0 +1,79 @@
+import os
+import builtins
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_distributed(device):
+    '''
+    Join the process group described by the torchrun environment (RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR, MASTER_PORT) when there is more than one process: nccl for cuda devices, gloo
+    otherwise, so that CPU processes on one or several machines train together. Every process
+    but rank 0 stops printing.
+    return: the device of this process (cuda:LOCAL_RANK on cuda), its rank and the world size
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return device, 0, 1
+
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo')
+    rank = dist.get_rank()
+
+    if rank != 0:
+        builtin_print = builtins.print
+        builtins.print = lambda *args, **kwargs: builtin_print(*args, **kwargs) if kwargs.pop('force', False) else None
+    return device, rank, world_size
+
+
+def wrap_ddp(net, device):
+    '''
+    DistributedDataParallel around a model set up by device.setup_model (a no-op without a process group)
+    '''
+    if not is_distributed():
+        return net
+    ddp = torch.nn.parallel.DistributedDataParallel(net, device_ids=[device.index] if device.type == 'cuda' else None)
+    ddp.channels_last = getattr(net, 'channels_last', False)
+    return ddp
+
+
+def all_reduce_array(array, op='sum'):
+    '''
+    elementwise sum (or max) of a numpy array over all processes
+    '''
+    if not is_distributed():
+        return array
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).to(device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX if op == 'max' else dist.ReduceOp.SUM)
+    return tensor.cpu().numpy()
+
+
+def all_reduce_values(values, op='sum'):
+    '''
+    sum (or max) of a list of numbers over all processes
+    '''
+    return all_reduce_array(np.asarray(values, dtype=np.float64), op).tolist()
+
+
+def shard_indices(num_samples, rank, world_size):
+    '''
+    the samples one process evaluates: every world_size-th sample from rank on, without padding
+    '''
+    return list(range(rank, num_samples, world_size))
@@ -0,0 +1,134 @@
+import os
+import hashlib
+
+import numpy as np
+
+from utils.ood_scheduler import run_datasets
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''
+    sha1 of a file's content, used to key caches on a checkpoint
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dataset_key(dataset):
+    '''
+    identify a dataset by its class, location, split, size and transform; a part of another
+    dataset (validation_dataset.PartialDataset) by its parent and offset
+    '''
+    if hasattr(dataset, 'parent_ds'):
+        desc = [type(dataset).__name__, dataset_key(dataset.parent_ds), str(getattr(dataset, 'offset', '')),
+                str(len(dataset))]
+        return hashlib.sha1('|'.join(desc).encode()).hexdigest()
+    desc = [type(dataset).__name__,
+            str(getattr(dataset, 'root', '')),
+            str(getattr(dataset, 'train', getattr(dataset, 'split', ''))),
+            str(len(dataset)),
+            repr(getattr(dataset, 'transform', None))]
+    return hashlib.sha1('|'.join(desc).encode()).hexdigest()
+
+
+def cache_prefix(cache_dir, ckpt_hash, dataset, idxs=None):
+    desc = ckpt_hash + dataset_key(dataset)
+    if idxs is not None:
+        desc += hashlib.sha1(np.ascontiguousarray(idxs, dtype=np.int64).tobytes()).hexdigest()
+    key = hashlib.sha1(desc.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, type(dataset).__name__ + '_' + key)
+
+
+def get_subset_indices(dataset, num_examples, seed, cache_dir=''):
+    '''
+    The sorted indices of a seeded random subset of min(num_examples, len(dataset)) samples.
+    With cache_dir set they are stored under cache_dir/subsets, so every later run (and every
+    checkpoint) scores exactly the same samples.
+    '''
+    num_examples = min(num_examples, len(dataset))
+    path = ''
+    if cache_dir != '':
+        path = os.path.join(cache_dir, 'subsets', '{}_{}_n{}_s{}.npy'.format(
+            type(dataset).__name__, dataset_key(dataset)[:16], num_examples, seed))
+        if os.path.isfile(path):
+            return np.load(path)
+
+    idxs = np.sort(np.random.RandomState(seed).permutation(len(dataset))[:num_examples])
+
+    if path != '':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, idxs)
+        os.replace(path + '.tmp', path)
+    return idxs
+
+
+def get_outputs_many(net, datasets, batch_size, num_workers=4, cache_dir='', ckpt_hash='', prefetch_factor=2,
+                     index_lists=None):
+    '''
+    Run net over every sample of each dataset (in order) and return, per dataset, the logits,
+    the penultimate features and the targets as numpy arrays.
+    With cache_dir set, the arrays are kept as .npy files keyed by the checkpoint hash and the
+    dataset, and later calls only memory-map them. Datasets that are not cached yet are scored
+    together, in one pass through a single worker pool (see ood_scheduler.run_datasets).
+    index_lists: per-dataset indices to score instead of every sample (None entries mean all);
+    they are part of the cache key
+    '''
+    if index_lists is None:
+        index_lists = [None] * len(datasets)
+    names = ['logits', 'features', 'targets']
+    outputs = [None] * len(datasets)
+    paths = [None] * len(datasets)
+
+    if cache_dir != '':
+        for i, dataset in enumerate(datasets):
+            prefix = cache_prefix(cache_dir, ckpt_hash, dataset, index_lists[i])
+            paths[i] = [prefix + '_' + name + '.npy' for name in names]
+            if all(os.path.isfile(p) for p in paths[i]):
+                outputs[i] = tuple(np.load(p, mmap_mode='r') for p in paths[i])
+        os.makedirs(cache_dir, exist_ok=True)
+
+    for i in range(len(datasets)):
+        if outputs[i] is None and index_lists[i] is not None and len(index_lists[i]) == 0:
+            # nothing to score, and no batch would ever allocate (or fill) the cache files
+            outputs[i] = (np.empty((0, 0), np.float32), np.empty((0, 0), np.float32), np.empty(0, np.int64))
+
+    missing = [i for i in range(len(datasets)) if outputs[i] is None]
+    if len(missing) == 0:
+        return outputs
+
+    allocate = None
+    if cache_dir != '':
+        # fill memory-mapped temporary files directly
+        allocate = lambda j, shapes, dtypes: [np.lib.format.open_memmap(p + '.tmp', mode='w+', dtype=t, shape=s)
+                                              for p, s, t in zip(paths[missing[j]], shapes, dtypes)]
+
+    computed = run_datasets(net, [datasets[i] for i in missing], batch_size, num_workers,
+                            index_lists=[np.arange(len(datasets[i])) if index_lists[i] is None else index_lists[i]
+                                         for i in missing],
+                            allocate=allocate, prefetch_factor=prefetch_factor)
+
+    for i, arrays in zip(missing, computed):
+        if cache_dir == '':
+            outputs[i] = tuple(arrays)
+            continue
+
+        for a in arrays:
+            a.flush()
+        # only publish complete files, so an interrupted run never leaves a bad cache
+        for p in paths[i]:
+            os.replace(p + '.tmp', p)
+        print('Cached outputs:', paths[i][0][:-len('_logits.npy')])
+        outputs[i] = tuple(np.load(p, mmap_mode='r') for p in paths[i])
+
+    return outputs
+
+
+def get_outputs(net, dataset, batch_size, num_workers=2, cache_dir='', ckpt_hash=''):
+    '''
+    get_outputs_many for a single dataset
+    '''
+    return get_outputs_many(net, [dataset], batch_size, num_workers, cache_dir, ckpt_hash)[0]
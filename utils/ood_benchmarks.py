@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import torchvision.datasets as dset
+import torchvision.transforms as trn
+
+import utils.svhn_loader as svhn
+from utils.packed_dataset import PackedDataset, is_packed
+
+# benchmark names, in the order they are reported
+ood_names = ['Textures', 'SVHN', 'Places365', 'LSUN_C', 'LSUN_Resize', 'iSUN']
+
+
+def crop_transforms(name):
+    '''
+    the fixed, pre-normalization part of the test transform of a benchmark
+    '''
+    if name in ['Textures', 'Places365']:
+        return [trn.Resize(32), trn.CenterCrop(32)]
+    return []
+
+
+def get_ood_dataset(name, path, transform):
+    if name == 'SVHN':
+        # cropped and no sampling of the test set
+        return svhn.SVHN(root=path, split="test", transform=transform, download=False)
+    elif name in ['Textures', 'Places365', 'LSUN_C', 'LSUN_Resize', 'iSUN']:
+        return dset.ImageFolder(root=path, transform=transform)
+    else:
+        raise Exception('unknown OOD benchmark: {}'.format(name))
+
+
+def get_packable_dataset(name, path):
+    '''
+    a benchmark returning H x W x 3 uint8 arrays after its resize/crop, for packed_dataset.pack_dataset
+    '''
+    return get_ood_dataset(name, path, trn.Compose(crop_transforms(name) + [np.array]))
+
+
+def get_ood_datasets(paths, mean, std, names=ood_names, packed_dir=''):
+    '''
+    The OOD benchmarks with their test transforms
+    paths: dict of benchmark name -> root folder
+    packed_dir: folder of benchmarks packed by pack_benchmarks.py, used instead of decoding the images
+    return: list of (name, dataset)
+    '''
+    ood_sets = []
+    for name in names:
+        prefix = os.path.join(packed_dir, name)
+        if packed_dir != '' and is_packed(prefix):
+            ood_data = PackedDataset(prefix, mean, std)
+        else:
+            ood_data = get_ood_dataset(name, paths[name],
+                                       trn.Compose(crop_transforms(name) + [trn.ToTensor(), trn.Normalize(mean, std)]))
+        ood_sets.append((name, ood_data))
+
+    return ood_sets
@@ -0,0 +1,120 @@
+import bisect
+
+import numpy as np
+import torch
+
+from utils.device import to_device
+
+
+class TaggedConcatDataset(torch.utils.data.ConcatDataset):
+    '''
+    ConcatDataset whose items also carry the index of the dataset they come from
+    '''
+    def __getitem__(self, idx):
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        img, target = super(TaggedConcatDataset, self).__getitem__(idx)
+        return img, target, dataset_idx
+
+
+class InterleavedBatchSampler(torch.utils.data.Sampler):
+    '''
+    Batches of a single dataset each, taken round-robin across the datasets so that every dataset
+    keeps the worker pool busy; within a dataset the given index order is kept
+    index_lists: per-dataset lists of local indices to visit
+    offsets: start of every dataset in the concatenated index space
+    '''
+    def __init__(self, index_lists, offsets, batch_size):
+        self.batches = [[[offset + int(i) for i in idxs[start:start + batch_size]]
+                         for start in range(0, len(idxs), batch_size)]
+                        for idxs, offset in zip(index_lists, offsets)]
+
+    def __iter__(self):
+        for round_batches in zip_longest_batches(self.batches):
+            for batch in round_batches:
+                yield batch
+
+    def __len__(self):
+        return sum(len(batches) for batches in self.batches)
+
+
+def zip_longest_batches(batches):
+    for i in range(max([len(b) for b in batches] + [0])):
+        yield [b[i] for b in batches if i < len(b)]
+
+
+def iter_outputs(net, datasets, batch_size, num_workers=4, index_lists=None, prefetch_factor=2):
+    '''
+    Stream the batches of several datasets through one DataLoader (a single worker pool) into a
+    single inference loop; every batch is tagged with its dataset. Datasets with a get_batch method
+    (packed_dataset.PackedDataset) skip the workers and are read a batch at a time
+    index_lists: per-dataset indices to score (default: every sample, in order)
+    yield: (dataset_idx, logits, features, targets) numpy batches, the rows of every dataset in the
+    order of its index list
+    '''
+    if index_lists is None:
+        index_lists = [np.arange(len(d)) for d in datasets]
+
+    # packed datasets gather whole batches from their memory map in this process; the others are
+    # decoded by the worker pool
+    packed = [i for i, d in enumerate(datasets) if hasattr(d, 'get_batch')]
+    loaded = [i for i in range(len(datasets)) if i not in packed]
+
+    def batches():
+        loader_iter = iter([])
+        if loaded:
+            concat_data = TaggedConcatDataset([datasets[i] for i in loaded])
+            offsets = [0] + concat_data.cumulative_sizes[:-1]
+            sampler = InterleavedBatchSampler([index_lists[i] for i in loaded], offsets, batch_size)
+            loader_kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+            loader = torch.utils.data.DataLoader(concat_data, batch_sampler=sampler, num_workers=num_workers,
+                                                 pin_memory=True, **loader_kwargs)
+            # start the workers first, so they decode while the packed datasets are scored
+            loader_iter = iter(loader)
+
+        for i in packed:
+            for start in range(0, len(index_lists[i]), batch_size):
+                data, target = datasets[i].get_batch(index_lists[i][start:start + batch_size])
+                yield data, target, torch.full((data.size(0),), i, dtype=torch.long)
+
+        tags = torch.tensor(loaded, dtype=torch.long)
+        for data, target, dataset_idx in loader_iter:
+            yield data, target, tags[dataset_idx]
+
+    net.eval()
+    for data, target, dataset_idx in batches():
+        # only the forward pass runs in inference mode, the caller gets control back between batches
+        with torch.inference_mode():
+            output, vector_feature = net(to_device(data, net))
+        batch = [output.float().cpu().numpy(), vector_feature.float().cpu().numpy(),
+                 np.asarray(target).reshape(-1)]
+
+        # a batch holds one dataset, but route by tag so mixed batches would work too
+        for i in np.unique(dataset_idx.numpy()):
+            mask = (dataset_idx == i).numpy()
+            yield (int(i),) + tuple(b[mask] for b in batch)
+
+
+def run_datasets(net, datasets, batch_size, num_workers=4, index_lists=None, allocate=None, prefetch_factor=2):
+    '''
+    The batches of iter_outputs routed to the arrays of their dataset
+    allocate(dataset_idx, shapes, dtypes): returns the output arrays of a dataset (default: np.empty)
+    return: per-dataset [logits, features, targets], rows in the order of index_lists
+    '''
+    if index_lists is None:
+        index_lists = [np.arange(len(d)) for d in datasets]
+    if allocate is None:
+        allocate = lambda dataset_idx, shapes, dtypes: [np.empty(s, dtype=t) for s, t in zip(shapes, dtypes)]
+
+    outputs = [None] * len(datasets)
+    filled = [0] * len(datasets)
+
+    for i, *batch in iter_outputs(net, datasets, batch_size, num_workers, index_lists, prefetch_factor):
+        if outputs[i] is None:
+            n = len(index_lists[i])
+            outputs[i] = allocate(i, [(n,) + b.shape[1:] for b in batch], [b.dtype for b in batch])
+        end = filled[i] + len(batch[0])
+        for a, b in zip(outputs[i], batch):
+            a[filled[i]:end] = b
+        filled[i] = end
+
+    return outputs
@@ -0,0 +1,121 @@
+import queue
+import threading
+import collections
+
+import numpy as np
+import torch
+
+from utils.distributed import all_reduce_array
+
+
+class InfiniteSampler(torch.utils.data.Sampler):
+    '''
+    An endless sequence of sample indices: epoch after epoch of the dataset, every epoch in a new
+    order that only depends on (seed, epoch). order='shuffle' permutes the whole epoch, order='offset'
+    reads the dataset in order from a random starting point (keeps the locality of sequential
+    reads). With num_replicas processes, every process takes every num_replicas-th index of the
+    (padded) epoch from rank on, like DistributedSampler.
+    start: the number of indices of this process already consumed, to continue a stream
+    '''
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0, order='shuffle', start=0):
+        if order not in ['shuffle', 'offset']:
+            raise Exception('unknown outlier order: {}'.format(order))
+        self.dataset_size = len(data_source)
+        self.num_samples = (self.dataset_size + num_replicas - 1) // num_replicas
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.order = order
+        self.start = start
+
+    def epoch_order(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 100003 + epoch)
+        if self.order == 'shuffle':
+            order = torch.randperm(self.dataset_size, generator=generator)
+        else:
+            offset = int(torch.randint(self.dataset_size, (1,), generator=generator))
+            order = torch.arange(self.dataset_size).roll(-offset)
+        total_size = self.num_samples * self.num_replicas
+        if total_size > self.dataset_size:
+            order = torch.cat([order, order[:total_size - self.dataset_size]])
+        return order[self.rank:total_size:self.num_replicas].numpy()
+
+    def __iter__(self):
+        epoch, skip = divmod(self.start, self.num_samples)
+        while True:
+            yield from self.epoch_order(epoch)[skip:].tolist()
+            epoch, skip = epoch + 1, 0
+
+
+class OutlierStream(object):
+    '''
+    Endless batches of (images, targets) from any outlier dataset (ImageFolder, TinyImages,
+    PackedDataset, ...), loaded by a DataLoader over an InfiniteSampler, so every epoch of the
+    outlier set is visited in a new order instead of the same first slice.
+    A background thread keeps up to prefetch batches ready, so next() only waits when loading is
+    slower than training. The thread starts with the first next(); close() stops it.
+    Every delivered index is marked in a bitmap of the dataset (one byte per sample), and
+    distinct_seen() is the number of different outliers used so far; with all_ranks=True the
+    bitmaps of all processes are merged first (their shards change from pass to pass).
+    '''
+    def __init__(self, dataset, batch_size, seed=0, num_replicas=1, rank=0, order='shuffle', start=0,
+                 num_workers=0, prefetch=2, pin_memory=False):
+        self.sampler = InfiniteSampler(dataset, seed, num_replicas, rank, order, start)
+        self.batch_size = batch_size
+        # the index lists of the batches the loader has requested and not yet delivered, in order
+        self.pending = collections.deque()
+        self.loader = torch.utils.data.DataLoader(dataset, batch_sampler=self.batches(), num_workers=num_workers,
+                                                  pin_memory=pin_memory)
+        self.seen = np.zeros(len(dataset), dtype=np.uint8)
+        self.num_seen = 0
+        self.ready = queue.Queue(maxsize=prefetch)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def batches(self):
+        indices = iter(self.sampler)
+        while True:
+            batch = [next(indices) for _ in range(self.batch_size)]
+            self.pending.append(batch)
+            yield batch
+
+    def run(self):
+        try:
+            for batch in self.loader:
+                while not self.stopping.is_set():
+                    try:
+                        self.ready.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stopping.is_set():
+                    return
+        except Exception as e:
+            self.ready.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        batch = self.ready.get()
+        if isinstance(batch, Exception):
+            raise Exception('outlier loading failed') from batch
+
+        idxs = np.unique(self.pending.popleft())
+        self.num_seen += len(idxs) - int(self.seen[idxs].sum())
+        self.seen[idxs] = 1
+        return batch
+
+    def distinct_seen(self, all_ranks=False):
+        if all_ranks:
+            return int(np.count_nonzero(all_reduce_array(self.seen, op='max')))
+        return self.num_seen
+
+    def close(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,84 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torchvision.transforms as trn
+
+
+def packed_paths(prefix):
+    '''
+    images (N x H x W x 3 uint8), labels (N int64) and json sidecar of a packed dataset
+    '''
+    return prefix + '_images.npy', prefix + '_labels.npy', prefix + '.json'
+
+
+def pack_dataset(dataset, prefix, batch_size=256, num_workers=4, meta=None):
+    '''
+    Decode dataset once and store it as a single contiguous uint8 .npy file plus labels and a json sidecar
+    dataset: must return (H x W x 3 uint8 array, label), i.e. the fixed resize/crop of the benchmark
+    but no ToTensor/Normalize; every image must have the same size
+    meta: extra fields for the sidecar (e.g. the source folder)
+    '''
+    images_path, labels_path, meta_path = packed_paths(prefix)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    images, labels = None, np.empty(len(dataset), dtype=np.int64)
+    start = 0
+    for img, target in loader:
+        if images is None:
+            images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                               shape=(len(dataset),) + tuple(img.shape[1:]))
+        end = start + img.size(0)
+        images[start:end] = img.numpy()
+        labels[start:end] = np.asarray(target).reshape(-1)
+        start = end
+    images.flush()
+
+    with open(labels_path + '.tmp', 'wb') as f:
+        np.save(f, labels)
+    meta = dict(meta or {}, num_examples=len(dataset), shape=list(images.shape[1:]))
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # the sidecar is published last: a packed dataset exists once its json does
+    for p in [images_path, labels_path, meta_path]:
+        os.replace(p + '.tmp', p)
+    return meta
+
+
+def is_packed(prefix):
+    return os.path.isfile(packed_paths(prefix)[2])
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    '''
+    A dataset written by pack_dataset: the images are memory-mapped and only converted and
+    normalized when read, a whole batch at a time with get_batch
+    '''
+    def __init__(self, prefix, mean, std):
+        images_path, labels_path, meta_path = packed_paths(prefix)
+        self.root = prefix
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.data = np.load(images_path, mmap_mode='r')
+        self.targets = np.load(labels_path)
+        # kept for the cache key (see feature_cache.dataset_key), applied in get_batch
+        self.transform = trn.Normalize(mean, std)
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+    def get_batch(self, idxs):
+        '''
+        normalized images (B x 3 x H x W) and labels of the samples idxs, read with one gather
+        '''
+        idxs = np.asarray(idxs)
+        img = torch.from_numpy(np.ascontiguousarray(self.data[idxs])).permute(0, 3, 1, 2).float().div_(255)
+        return img.sub_(self.mean).div_(self.std), torch.from_numpy(self.targets[idxs])
+
+    def __getitem__(self, index):
+        img, target = self.get_batch([index])
+        return img[0], int(target[0])
+
+    def __len__(self):
+        return len(self.targets)
@@ -0,0 +1,55 @@
+import io
+import copy
+import time
+import warnings
+
+import torch
+from torch.ao.quantization import QConfigMapping, get_default_qconfig, default_dynamic_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def quantize_model(net, calib_loader, num_batches=10, backend='x86'):
+    '''
+    Post-training INT8 quantization of a CPU model with FX graph mode: convolutions (with their
+    batch norms and activations) get static INT8 weights and activations, calibrated on
+    num_batches of calib_loader; the Linear head is dynamically quantized, so the logits are
+    computed from fp32 features
+    return: a GraphModule with the same outputs as net (e.g. the (logits, features) tuple); net is not modified
+    '''
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(backend)) \
+                                      .set_object_type(torch.nn.Linear, default_dynamic_qconfig)
+
+    net = copy.deepcopy(net).cpu().eval()
+    data, _ = next(iter(calib_loader))
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, which we do not depend on
+        warnings.simplefilter('ignore')
+        prepared = prepare_fx(net, qconfig_mapping, (data,))
+        with torch.inference_mode():
+            for batch_idx, (data, _) in enumerate(calib_loader):
+                if batch_idx >= num_batches:
+                    break
+                prepared(data)
+        return convert_fx(prepared)
+
+
+def model_size(net):
+    '''
+    size in bytes of the serialized state_dict of net
+    '''
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(net, data, repeats=10):
+    '''
+    mean seconds per forward pass of data
+    '''
+    with torch.inference_mode():
+        net(data)
+        begin = time.time()
+        for _ in range(repeats):
+            net(data)
+    return (time.time() - begin) / repeats
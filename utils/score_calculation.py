@@ -1,4 +1,5 @@
 from __future__ import print_function
+import os
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
@@ -10,9 +11,46 @@ import torchvision.transforms as transforms
 import numpy as np
 from scipy import misc
 
+from utils.device import to_device
+
 to_np = lambda x: x.data.cpu().numpy()
 concat = lambda x: np.concatenate(x, axis=0)
 
+# the models in models/*_prime.py return (logits, features)
+logits_of = lambda x: x[0] if isinstance(x, tuple) else x
+
+# scores that are pure post-processing of the logits
+logit_score_names = ['MSP', 'energy', 'xent']
+
+
+def get_scores(output, score_names, T=1.):
+    '''
+    OOD scores (higher = more OOD) of a batch of logits for every name in score_names
+    MSP: negative max softmax, energy: negative T*logsumexp(output/T), xent: entropy of the softmax
+    return: dict of score name -> numpy array
+    '''
+    scores = {}
+    for name in score_names:
+        if name == 'MSP':
+            scores[name] = -to_np(F.softmax(output, dim=1).max(1)[0])
+        elif name == 'energy':
+            scores[name] = -to_np(T*torch.logsumexp(output / T, dim=1))
+        elif name == 'xent':
+            scores[name] = to_np(-1 * (F.softmax(output, dim=1) * F.log_softmax(output, dim=1)).sum(1))
+        else:
+            raise ValueError('unknown score: {}'.format(name))
+    return scores
+
+
+def energy_sweep(output, temperatures):
+    '''
+    Energy scores -T*logsumexp(output/T) for a whole grid of temperatures in one broadcast logsumexp
+    return: len(temperatures) x batch_size numpy array
+    '''
+    T = torch.as_tensor(temperatures, dtype=output.dtype, device=output.device).view(-1, 1)
+    return -to_np(T * torch.logsumexp(output.unsqueeze(0) / T.unsqueeze(2), dim=2))
+
+
 def get_ood_scores_odin(loader, net, bs, ood_num_examples, T, noise, in_dist=False):
     _score = []
     _right_score = []
@@ -22,10 +60,10 @@ def get_ood_scores_odin(loader, net, bs, ood_num_examples, T, noise, in_dist=Fal
     for batch_idx, (data, target) in enumerate(loader):
         if batch_idx >= ood_num_examples // bs and in_dist is False:
             break
-        data = data.cuda()
+        data = to_device(data, net)
         data = Variable(data, requires_grad = True)
 
-        output = net(data)
+        output = logits_of(net(data))
         smax = to_np(F.softmax(output, dim=1))
 
         odin_score = ODIN(data, output,net, T, noise)
@@ -56,7 +94,7 @@ def ODIN(inputs, outputs, model, temper, noiseMagnitude1):
     # Using temperature scaling
     outputs = outputs / temper
 
-    labels = Variable(torch.LongTensor(maxIndexTemp).cuda())
+    labels = Variable(torch.as_tensor(maxIndexTemp, device=outputs.device))
     loss = criterion(outputs, labels)
     loss.backward()
 
@@ -72,8 +110,8 @@ def ODIN(inputs, outputs, model, temper, noiseMagnitude1):
     #gradient.index_copy_(1, torch.LongTensor([2]).cuda(), gradient.index_select(1, torch.LongTensor([2]).cuda()) / (66.7/255.0))
 
     # Adding small perturbations to images
-    tempInputs = torch.add(inputs.data,  -noiseMagnitude1, gradient)
-    outputs = model(Variable(tempInputs))
+    tempInputs = torch.add(inputs.data, gradient, alpha=-noiseMagnitude1)
+    outputs = logits_of(model(Variable(tempInputs)))
     outputs = outputs / temper
     # Calculating the confidence after adding perturbations
     nnOutputs = outputs.data.cpu()
@@ -84,244 +122,283 @@ def ODIN(inputs, outputs, model, temper, noiseMagnitude1):
     return nnOutputs
 
 
+def get_ood_scores_odin_grid(loader, net, bs, ood_num_examples, temperatures, noises, in_dist=False):
+    '''
+    ODIN scores for every (temperature, noise magnitude) pair of a grid in one pass over loader:
+    per batch, one input gradient per temperature, and all noise magnitudes of that temperature
+    evaluated by stacking the perturbed copies into a single forward
+    return: dict (T, noise) -> scores (plus right/wrong MSP scores when in_dist)
+    '''
+    _score = {(T, noise): [] for T in temperatures for noise in noises}
+    _right_score = []
+    _wrong_score = []
+
+    net.eval()
+    std = None
+    for batch_idx, (data, target) in enumerate(loader):
+        if batch_idx >= ood_num_examples // bs and in_dist is False:
+            break
+        data = to_device(data, net)
+        data.requires_grad_(True)
+        if std is None:
+            std = torch.tensor([63.0/255.0, 62.1/255.0, 66.7/255.0], device=data.device).view(1, 1, 3, 1, 1)
+            magnitudes = torch.tensor(noises, dtype=data.dtype, device=data.device).view(-1, 1, 1, 1, 1)
+
+        output = logits_of(net(data))
+        labels = output.data.max(1)[1]
+
+        for t_idx, T in enumerate(temperatures):
+            # sign of the gradient of the temperature-scaled cross entropy w.r.t. the input
+            loss = F.cross_entropy(output / T, labels)
+            gradient, = torch.autograd.grad(loss, data, retain_graph=t_idx < len(temperatures) - 1)
+            gradient = (torch.ge(gradient, 0).float() - 0.5) * 2 / std
+
+            # noises x batch copies of the batch, scored with one forward
+            temp_inputs = data.data.unsqueeze(0) - magnitudes * gradient
+            with torch.no_grad():
+                outputs = logits_of(net(temp_inputs.view((-1,) + data.shape[1:]))) / T
+            odin_score = -to_np(F.softmax(outputs, dim=1).max(1)[0]).reshape(len(noises), -1)
+
+            for n_idx, noise in enumerate(noises):
+                _score[(T, noise)].append(odin_score[n_idx])
+
+        if in_dist:
+            smax = to_np(F.softmax(output.data, dim=1))
+            preds = np.argmax(smax, axis=1)
+            right_indices = preds == target.numpy().reshape(-1)
+            wrong_indices = np.invert(right_indices)
+
+            _right_score.append(-np.max(smax[right_indices], axis=1))
+            _wrong_score.append(-np.max(smax[wrong_indices], axis=1))
+
+    if in_dist:
+        return {k: concat(v).copy() for k, v in _score.items()}, concat(_right_score).copy(), concat(_wrong_score).copy()
+    else:
+        return {k: concat(v)[:ood_num_examples].copy() for k, v in _score.items()}
+
+
+def class_gaussian_terms(class_mean, precision):
+    '''
+    Precompute the per-class parts of the Mahalanobis distance (in float64)
+    return: mu_c^T P (num_classes x D), mu_c^T P mu_c (num_classes)
+    '''
+    mean_p = torch.mm(class_mean.double(), precision.double())
+    return mean_p, (mean_p * class_mean.double()).sum(1)
+
+
+def gaussian_scores(features, precision, mean_p, mean_term):
+    '''
+    Class-conditional Gaussian score -0.5 * (f - mu_c)^T P (f - mu_c) for every sample and class
+    in one contraction: f^T P f - 2 f^T P mu_c + mu_c^T P mu_c, i.e. O(B*D^2 + B*C*D) per batch
+    instead of one B x B matrix per class. Accumulated in float64 to avoid cancellation.
+    return: batch_size x num_classes
+    '''
+    f = features.double()
+    quad = (torch.mm(f, precision.double()) * f).sum(1, keepdim=True)
+    return (-0.5 * (quad - 2 * torch.mm(f, mean_p.t()) + mean_term)).float()
+
+
 def get_Mahalanobis_score(model, test_loader, num_classes, sample_mean, precision, layer_index, magnitude, num_batches, in_dist=False):
     '''
     Compute the proposed Mahalanobis confidence score on input dataset
     return: Mahalanobis score from layer_index
     '''
     model.eval()
-    Mahalanobis = []
-    Gassion_Entropy = []
+
+    num_examples = len(test_loader.dataset)
+    if not in_dist:
+        num_examples = min(num_examples, num_batches * test_loader.batch_size)
+    Mahalanobis = np.empty(num_examples, dtype=np.float32)
+    Gassion_Entropy = np.empty(num_examples, dtype=np.float32)
+    start = 0
+
+    class_mean = sample_mean[layer_index]
+    layer_precision = precision[layer_index]
+    mean_p, mean_term = class_gaussian_terms(class_mean, layer_precision)
+    std = torch.tensor([63.0/255.0, 62.1/255.0, 66.7/255.0], device=class_mean.device).view(1, 3, 1, 1)
 
     for batch_idx, (data, target) in enumerate(test_loader):
         if batch_idx >= num_batches and in_dist is False:
             break
 
-
-        
-        data, target = data.cuda(), target.cuda()
-        data, target = Variable(data, requires_grad = True), Variable(target)
+        data = to_device(data, model)
+        data = Variable(data, requires_grad = True)
         
         out_features = model.intermediate_forward(data, layer_index)
         out_features = out_features.view(out_features.size(0), out_features.size(1), -1)
         out_features = torch.mean(out_features, 2)
         
-        # compute Mahalanobis score
-        gaussian_score = 0
-        for i in range(num_classes):
-            batch_sample_mean = sample_mean[layer_index][i]
-            zero_f = out_features.data - batch_sample_mean
-
-            # print(torch.mm( torch.mm(zero_f, precision[layer_index]),  zero_f.t() ).shape)
-            # batchsize * batchsize
-            # exit(0)
-
-            # torch.mm(a, b)是矩阵a和b矩阵相乘，比如a的维度是(1, 2)，b的维度是(2, 3)，返回的就是(1, 3)的矩阵
-            # 如果输入是一个向量(1D 张量)，则返回一个以input为对角线元素的2D方阵
-            # 如果输入是一个矩阵(2D 张量)，则返回一个包含input对角线元素的1D张量
-            # 矩阵返回对角线元素, 对角线元素返回矩阵
-            term_gau = -0.5*torch.mm( torch.mm(zero_f, precision[layer_index]),  zero_f.t() ).diag()
-            # print(term_gau.shape)
-            # batchsize * 1
-            # exit(0)
-            if i == 0:
-                gaussian_score = term_gau.view(-1,1)
-            else:
-                gaussian_score = torch.cat((gaussian_score, term_gau.view(-1,1)), 1)
-            # print(term_gau)
-            # print(term_gau.shape)
-            # batchsize
-            # exit(0)
+        # compute Mahalanobis score for all classes at once: batchsize * num_classes
+        gaussian_score = gaussian_scores(out_features.data, layer_precision, mean_p, mean_term)
         
         # Input_processing
         sample_pred = gaussian_score.max(1)[1]
-        batch_sample_mean = sample_mean[layer_index].index_select(0, sample_pred)
-        zero_f = out_features - Variable(batch_sample_mean)
-        pure_gau = -0.5*torch.mm(torch.mm(zero_f, Variable(precision[layer_index])), zero_f.t()).diag()
+        batch_sample_mean = class_mean.index_select(0, sample_pred)
+        zero_f = out_features - batch_sample_mean
+        # row-wise quadratic form, the diagonal of zero_f * P * zero_f^T
+        pure_gau = -0.5*(torch.mm(zero_f, layer_precision) * zero_f).sum(1)
         loss = torch.mean(-pure_gau)
         loss.backward()
         # torch.ge(a, 0): 逐个元素和0比较大小
         gradient =  torch.ge(data.grad.data, 0)
-        gradient = (gradient.float() - 0.5) * 2
-        gradient.index_copy_(1, torch.LongTensor([0]).cuda(), gradient.index_select(1, torch.LongTensor([0]).cuda()) / (63.0/255.0))
-        gradient.index_copy_(1, torch.LongTensor([1]).cuda(), gradient.index_select(1, torch.LongTensor([1]).cuda()) / (62.1/255.0))
-        gradient.index_copy_(1, torch.LongTensor([2]).cuda(), gradient.index_select(1, torch.LongTensor([2]).cuda()) / (66.7/255.0))
-        
+        gradient = (gradient.float() - 0.5) * 2 / std
 
-        tempInputs = torch.add(data.data, -magnitude, gradient)
+        tempInputs = torch.add(data.data, gradient, alpha=-magnitude)
         with torch.no_grad():
             noise_out_features = model.intermediate_forward(tempInputs, layer_index)
         noise_out_features = noise_out_features.view(noise_out_features.size(0), noise_out_features.size(1), -1)
         noise_out_features = torch.mean(noise_out_features, 2)
-        noise_gaussian_score = 0
-        for i in range(num_classes):
-            batch_sample_mean = sample_mean[layer_index][i]
-            zero_f = noise_out_features.data - batch_sample_mean
-            term_gau = -0.5*torch.mm(torch.mm(zero_f, precision[layer_index]), zero_f.t()).diag()
-            if i == 0:
-                noise_gaussian_score = term_gau.view(-1,1)
-            else:
-                noise_gaussian_score = torch.cat((noise_gaussian_score, term_gau.view(-1,1)), 1)      
-
-        # print(noise_gaussian_score)
-        # print(noise_gaussian_score.shape)
-        # batch_size * num_sample_per_class
-        # exit(0)
+        noise_gaussian_score = gaussian_scores(noise_out_features, layer_precision, mean_p, mean_term)
+
+        # batch_size * num_classes
         gaussian_entropy_score = noise_gaussian_score.mean(1) - torch.logsumexp(noise_gaussian_score, dim=1) 
-        # print(t.shape)
-        # exit(0)
 
         noise_gaussian_score, _ = torch.max(noise_gaussian_score, dim=1) 
-        # print(noise_gaussian_score.shape)
-        # batch_size
-        # exit(0)
-        Mahalanobis.extend(-noise_gaussian_score.cpu().numpy())
-        Gassion_Entropy.extend(-gaussian_entropy_score.cpu().numpy())
+
+        end = start + data.size(0)
+        Mahalanobis[start:end] = -noise_gaussian_score.cpu().numpy()
+        Gassion_Entropy[start:end] = -gaussian_entropy_score.cpu().numpy()
+        start = end
         
-    return np.asarray(Mahalanobis, dtype=np.float32), np.asarray(Gassion_Entropy, dtype=np.float32)
+    return Mahalanobis[:start], Gassion_Entropy[:start]
+
+
+def new_class_statistics(num_classes, num_features, device):
+    '''
+    empty statistics for update_class_statistics
+    '''
+    def zeros(*shape):
+        return torch.zeros(*shape, dtype=torch.float64, device=device)
+
+    return {'count': zeros(num_classes), 'mean': zeros(num_classes, num_features),
+            'scatter': zeros(num_features, num_features)}
+
+
+def update_class_statistics(stats, features, target, num_classes):
+    '''
+    Merge one batch into the running per-class counts and means and the shared (tied) scatter matrix,
+    using the pairwise update of Chan et al. so the scatter stays accurate without keeping samples.
+    stats: dict with count (C), mean (C x D) and scatter (D x D), all float64
+    '''
+    f = features.double()
+    batch_count = torch.bincount(target, minlength=num_classes).double()
+    batch_mean = torch.zeros_like(stats['mean']).index_add_(0, target, f) / batch_count.clamp(min=1).unsqueeze(1)
+
+    centered = f - batch_mean.index_select(0, target)
+    delta = batch_mean - stats['mean']
+    new_count = stats['count'] + batch_count
+    weight = stats['count'] * batch_count / new_count.clamp(min=1)
+
+    stats['scatter'] += torch.mm(centered.t(), centered) + torch.mm(delta.t() * weight, delta)
+    stats['mean'] += delta * (batch_count / new_count.clamp(min=1)).unsqueeze(1)
+    stats['count'] = new_count
+
+
+def update_fourth_moment(stats, features, target):
+    '''
+    add sum ||x - mu_c||^4 of one batch to stats['fourth'], around the final class means of stats
+    (the Ledoit-Wolf shrinkage needs it, so it comes from a second pass once the means are known)
+    '''
+    centered = features.double() - stats['mean'].index_select(0, target)
+    stats['fourth'] = stats.get('fourth', 0.) + ((centered ** 2).sum(1) ** 2).sum()
 
 
-def sample_estimator(model, num_classes, feature_list, train_loader):
+def tied_precision(stats, shrinkage=None):
+    '''
+    Precision of the tied covariance (what sklearn EmpiricalCovariance fits on class-centred features),
+    optionally with Ledoit-Wolf shrinkage towards a scaled identity
+    '''
+    num_samples = stats['count'].sum()
+    num_features = stats['scatter'].size(0)
+    covariance = stats['scatter'] / num_samples
+
+    if shrinkage == 'ledoit_wolf':
+        # sklearn.covariance.ledoit_wolf_shrinkage written in terms of the streamed moments
+        mu = torch.trace(covariance) / num_features
+        delta_ = (covariance ** 2).sum()
+        beta = (stats['fourth'] / num_samples - delta_) / (num_features * num_samples)
+        delta = (delta_ - 2. * mu * torch.trace(covariance) + num_features * mu ** 2) / num_features
+        beta = torch.min(beta, delta)
+        coef = 0. if beta == 0 else float(beta / delta)
+        covariance = (1. - coef) * covariance
+        covariance.diagonal().add_(coef * mu)
+    elif shrinkage is not None:
+        raise ValueError('unknown shrinkage: {}'.format(shrinkage))
+
+    return torch.linalg.pinv(covariance, hermitian=True)
+
+
+def sample_estimator(model, num_classes, feature_list, train_loader, shrinkage=None):
     # feature_list: 特征的维数 = 128
     """
     compute sample mean and precision (inverse of covariance)
+    Features are streamed into per-class counts and sums and one shared scatter matrix per layer,
+    so memory is O(num_classes * D + D^2) whatever the size of the training set.
+    shrinkage: None for the empirical covariance, 'ledoit_wolf' for Ledoit-Wolf shrinkage (one more
+    pass over train_loader, for the fourth moment around the class means)
     return: sample_class_mean: list of class mean
              precision: list of precisions
     """
-    import sklearn.covariance
-    
     model.eval()
-    group_lasso = sklearn.covariance.EmpiricalCovariance(assume_centered=False)
     correct, total = 0, 0
-    num_output = len(feature_list)
-    # print('num_output: ', num_output) # 1
-    # exit(0)
-    num_sample_per_class = np.empty(num_classes)
-    # print(num_sample_per_class.shape) # (10,)
-    # exit(0)
-    num_sample_per_class.fill(0)
-    list_features = []
-    for i in range(num_output):
-        temp_list = []
-        for j in range(num_classes):
-            temp_list.append(0)
-        list_features.append(temp_list)
-    # print(list_features)
-    # [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
-    # exit(0)
+    stats = None
+
+    def layer_features(out):
+        # hidden features: mean over the spatial dimensions of a layer
+        return torch.mean(out.view(out.size(0), out.size(1), -1), 2)
 
     with torch.no_grad():
         for data, target in train_loader:
             total += data.size(0)
-            data = data.cuda()
-            # data = Variable(data, volatile=True)
+            data = to_device(data, model)
+            target = target.to(data.device)
             output, out_features = model.feature_list(data)
-            # print('before :',out_features)
-            # print(out_features[0].shape)
-            # 2 * 128 * 8 * 8: batchsize * channel * length * height
-            # print(len(out_features[0])) 
-            # batch_size
-            
-            # get hidden features
-            for i in range(num_output):
-                out_features[i] = out_features[i].view(out_features[i].size(0), out_features[i].size(1), -1)
-                # 把feature拉直
-                # print('type: ', type(out_features[i]))
-                # print(out_features[i].shape)
-                # 2 * 128  * 64
-                # print('out_features[i].size(0): ', out_features[i].size(0))
-                # batch_size: 2
-                # print('out_features[i].size(1): ', out_features[i].size(1))
-                # channel: 128
-                # print("++++++++++++++++++++++++++++++++++")
-                # print('after: ', out_features[i].shape)
-                # 2 * 128 * 64
-                # exit(0)
-                # print(out_features[i])
-                out_features[i] = torch.mean(out_features[i].data, 2)
-                # 2 表示求第三维度的均值, 每个样本的特征的均值
-                
-
-                # print(out_features[i])
-                # print(out_features[i].shape)
-                # 2 * 128 每个通道的均值
-                # exit(0)
-                
+
+            if stats is None:
+                stats = [new_class_statistics(num_classes, int(num_feature), data.device) for num_feature in feature_list]
+
+            for i in range(len(feature_list)):
+                update_class_statistics(stats[i], layer_features(out_features[i]), target, num_classes)
+
             # compute the accuracy
             pred = output.data.max(1)[1]
-            equal_flag = pred.eq(target.cuda()).cpu()
-            correct += equal_flag.sum()
-
-            # print(list_features)
-            # [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
-            
-            # construct the sample matrix
-            for i in range(data.size(0)):
-                label = target[i]
-                if num_sample_per_class[label] == 0:
-                    out_count = 0
-                    for out in out_features:
-                        list_features[out_count][label] = out[i].view(1, -1)
-                        out_count += 1
-                else:
-                    out_count = 0
-                    for out in out_features:
-                        list_features[out_count][label] \
-                        = torch.cat((list_features[out_count][label], out[i].view(1, -1)), 0)
-                        out_count += 1                
-                num_sample_per_class[label] += 1
-            # print(num_sample_per_class)
-            # 每一类样本的数目
-            # exit(0)
-                
-    sample_class_mean = []
-    out_count = 0
-    # t3 = 0
-    for num_feature in feature_list:
-        # t3 = t3 + 1
-        temp_list = torch.Tensor(num_classes, int(num_feature)).cuda()
-        for j in range(num_classes):
-            temp_list[j] = torch.mean(list_features[out_count][j], 0)
-        sample_class_mean.append(temp_list)
-        out_count += 1
-    # print(sample_class_mean)
-    # print(sample_class_mean[0].shape)
-    # 10*128
-    # exit(0)
-    # print('t3: ', t3)
-    # t3 = 1
-    precision = []
-    inv_precision = []
-
-    for k in range(num_output):
-        # 因为feature_list是列表(含有一个张量), 
-        # 所以num_output = len(feature_list) = 1, num_out = 1, k = 0, 只会循环1次
-        for i in range(num_classes):
-            if i == 0:
-                X = list_features[k][i] - sample_class_mean[k][i]
-            else:
-                X = torch.cat((X, list_features[k][i] - sample_class_mean[k][i]), 0)
-        # print(X)
-        # print(X.shape)
-        # [5w,128]
-        # exit(0)     
-        # find inverse            
-        group_lasso.fit(X.cpu().numpy())
-        
-        temp_precision = group_lasso.precision_
-        
+            correct += pred.eq(target).sum().item()
 
-        temp_inv_precision = torch.from_numpy(np.linalg.inv(temp_precision)).float().cuda()
-        temp_precision = torch.from_numpy(temp_precision).float().cuda()
-        
-        precision.append(temp_precision)
-        # print(temp_precision.shape)
-        # print(torch.det(temp_precision))
-        # exit(0)
-        inv_precision.append(temp_inv_precision)
+        if shrinkage == 'ledoit_wolf':
+            # the fourth moment around the final class means, in a second pass over the same loader
+            for data, target in train_loader:
+                data = to_device(data, model)
+                target = target.to(data.device)
+                out_features = model.feature_list(data)[1]
+                for i in range(len(feature_list)):
+                    update_fourth_moment(stats[i], layer_features(out_features[i]), target)
+
+    sample_class_mean = [layer['mean'].float() for layer in stats]
+    precision = [tied_precision(layer, shrinkage).float() for layer in stats]
 
-        
     print('\n Training Accuracy:({:.2f}%)\n'.format(100. * correct / total))
 
     return sample_class_mean, precision
-    # return sample_class_mean, inv_precision
+
+
+def cached_sample_estimator(model, num_classes, feature_list, train_loader, cache_file, shrinkage=None):
+    '''
+    sample_estimator whose output is stored in cache_file; the caller keys the file on everything
+    the estimate depends on (checkpoint content, architecture, tapped layers, shrinkage)
+    '''
+    device = next(model.parameters()).device
+
+    if os.path.isfile(cache_file):
+        cached = torch.load(cache_file)
+        print('Loaded sample mean and precision:', cache_file)
+        return [m.to(device) for m in cached['sample_mean']], [p.to(device) for p in cached['precision']]
+
+    sample_mean, precision = sample_estimator(model, num_classes, feature_list, train_loader, shrinkage)
+
+    # write then rename, so concurrent or interrupted runs never read a partial file
+    torch.save({'sample_mean': [m.cpu() for m in sample_mean], 'precision': [p.cpu() for p in precision],
+                'feature_list': [int(num_feature) for num_feature in feature_list], 'shrinkage': shrinkage},
+               cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+
+    return sample_mean, precision
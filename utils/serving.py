@@ -0,0 +1,166 @@
+import json
+import time
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.device import to_device
+from utils.score_calculation import get_scores, logits_of
+
+
+class LatencyStats(object):
+    '''
+    request counters and the latencies of the most recent requests
+    '''
+    def __init__(self, window=100000):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.start = None
+
+    def add(self, latency):
+        if self.start is None:
+            self.start = time.perf_counter() - latency
+        self.latencies.append(latency)
+        self.requests += 1
+
+    def summary(self):
+        latencies = 1000 * np.asarray(self.latencies) if self.latencies else np.zeros(1)
+        elapsed = time.perf_counter() - self.start if self.start is not None else 0.
+        return {'requests': self.requests, 'batches': self.batches,
+                'mean_batch': self.requests / max(self.batches, 1),
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'throughput': self.requests / elapsed if elapsed > 0 else 0.}
+
+
+class MicroBatcher(object):
+    '''
+    Coalesces concurrent single-image requests into batches: a batch is run as soon as it holds
+    max_batch images, or max_wait seconds after its first request. Images are staged in
+    preallocated buffers and the forward pass runs in a worker thread, so the event loop keeps
+    accepting requests meanwhile.
+    score(image) takes a H x W x 3 uint8 array and returns the predicted class and the scores
+    (score_calculation.get_scores, higher = more OOD) of that image.
+    '''
+    def __init__(self, net, mean, std, score_names, T=1., max_batch=64, max_wait=0.005, image_size=32):
+        self.net = net
+        self.score_names = score_names
+        self.T = T
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.raw = np.empty((max_batch, image_size, image_size, 3), dtype=np.uint8)
+        self.images = torch.empty(max_batch, 3, image_size, image_size)
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+        # one batch in flight at a time, so the buffers are never shared
+        self.executor = ThreadPoolExecutor(1)
+        self.stats = LatencyStats()
+
+    async def score(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.forward, [item[0] for item in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self.stats.batches += 1
+            for (_, future, start), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+                self.stats.add(now - start)
+
+    def forward(self, images):
+        n = len(images)
+        for i, image in enumerate(images):
+            self.raw[i] = image
+        data = self.images[:n]
+        data.copy_(torch.from_numpy(self.raw[:n]).permute(0, 3, 1, 2))
+        data.div_(255).sub_(self.mean).div_(self.std)
+
+        with torch.inference_mode():
+            output = logits_of(self.net(to_device(data, self.net))).float()
+            scores = get_scores(output, self.score_names, self.T)
+            preds = output.argmax(1).cpu().numpy()
+
+        return [dict([('pred', int(preds[i]))] + [(name, float(scores[name][i])) for name in self.score_names])
+                for i in range(n)]
+
+
+class BadRequest(Exception):
+    pass
+
+
+async def read_request(reader):
+    '''
+    the next HTTP/1.1 request of a connection as (method, path, body); None once the client is gone.
+    A malformed request line or Content-Length raises BadRequest.
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise BadRequest('malformed request line: {!r}'.format(line))
+    method, path = parts[:2]
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in [b'\r\n', b'\n', b'']:
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            if not value.strip().isdigit():
+                raise BadRequest('malformed Content-Length: {!r}'.format(value.strip()))
+            length = int(value)
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path, body
+
+
+def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, len(body)).encode() + body)
+
+
+async def read_response(reader):
+    '''
+    status code and json payload of an HTTP/1.1 response
+    '''
+    status = int((await reader.readline()).split(b' ')[1])
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in [b'\r\n', b'\n', b'']:
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
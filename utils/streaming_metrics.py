@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+from utils.display_results import recall_level_default
+
+
+class StreamingMeasures(object):
+    '''
+    Approximate AUROC, AUPR and FPR at recall from fixed-resolution histograms of the positive (in-
+    distribution) and negative (OOD) scores, as in display_results.get_measures: higher scores are
+    more positive. Memory is O(num_bins) whatever the number of samples; update adds a batch of
+    scores on the device they live on, and measures can be read at any time.
+    Scores outside score_range fall into an underflow and an overflow bin. The measures are exact
+    for the scores rounded down to their bin, so only pairs of samples sharing a bin are uncertain:
+    auroc_error is a bound on the AUROC error they can cause.
+    Accumulators with the same bins are merged by adding their histograms (merge, or all_reduce
+    across torch.distributed workers).
+    '''
+    def __init__(self, num_bins=10000, score_range=(-100., 100.), device='cpu'):
+        self.num_bins = num_bins
+        self.low, self.high = float(score_range[0]), float(score_range[1])
+        if not self.high > self.low:
+            raise ValueError('empty score range: {}'.format(score_range))
+        self.width = (self.high - self.low) / num_bins
+        # row 0: positives, row 1: negatives; bin 0 is the underflow and bin num_bins + 1 the overflow bin
+        self.hist = torch.zeros(2, num_bins + 2, dtype=torch.float64, device=device)
+
+    def update(self, scores, positive, weights=None):
+        # weights: how often every score counts (e.g. its multiplicity in a resampled run)
+        scores = torch.as_tensor(scores, device=self.hist.device).reshape(-1).double()
+        bins = torch.floor((scores - self.low) / self.width).clamp_(-1, self.num_bins).long() + 1
+        if weights is not None:
+            weights = torch.as_tensor(weights, device=self.hist.device).reshape(-1).double()
+        self.hist[0 if positive else 1] += torch.bincount(bins, weights, minlength=self.num_bins + 2).double()
+
+    def merge(self, other):
+        if (other.num_bins, other.low, other.high) != (self.num_bins, self.low, self.high):
+            raise ValueError('cannot merge histograms with different bins')
+        self.hist += other.hist.to(self.hist.device)
+        return self
+
+    def all_reduce(self):
+        torch.distributed.all_reduce(self.hist)
+        return self
+
+    def score_range(self):
+        return self.low, self.high
+
+    def lower_edges(self):
+        return np.r_[-np.inf, self.low + self.width * np.arange(self.num_bins + 1)]
+
+    def measures(self, recall_levels=(recall_level_default,)):
+        '''
+        return: dict with auroc, aupr_in, aupr_out, auroc_error, and the fpr and score threshold
+        (samples scoring at least the threshold are positive) for every recall level
+        '''
+        hist = self.hist.cpu().numpy()[:, ::-1]
+        edges = self.lower_edges()[::-1]
+        # every non-empty bin is one curve vertex, visited from the highest scores down
+        vertex = hist.sum(0) > 0
+        pos, neg, edges = hist[0][vertex], hist[1][vertex], edges[vertex]
+        tps, fps = np.cumsum(pos), np.cumsum(neg)
+        num_pos, num_neg = tps[-1], fps[-1]
+        if num_pos == 0 or num_neg == 0:
+            raise ValueError('measures need positive and negative scores')
+        prev_tps, prev_fps = tps - pos, fps - neg
+
+        auroc = np.sum(neg * (tps + prev_tps)) / (2 * num_pos * num_neg)
+        aupr_in = np.sum(pos * tps / (tps + fps)) / num_pos
+        tns = num_neg - prev_fps
+        aupr_out = np.sum(neg * tns / (tns + num_pos - prev_tps)) / num_neg
+        # ties inside a bin are counted as half right; the truth lies within that half of their pairs
+        auroc_error = np.sum(pos * neg) / (2 * num_pos * num_neg)
+
+        recall = tps / num_pos
+        candidate = np.arange(len(tps)) <= np.argmax(tps >= num_pos)
+        fpr, threshold = {}, {}
+        for recall_level in recall_levels:
+            distance = np.where(candidate, np.abs(recall - recall_level), np.inf)
+            cutoff = len(distance) - 1 - np.argmin(distance[::-1])
+            fpr[recall_level] = fps[cutoff] / num_neg
+            threshold[recall_level] = edges[cutoff]
+
+        return {'auroc': float(auroc), 'aupr_in': float(aupr_in), 'aupr_out': float(aupr_out),
+                'auroc_error': float(auroc_error), 'fpr': fpr, 'threshold': threshold}
+
+
+def get_streaming_measures(_pos, _neg, num_bins, score_range, recall_level=recall_level_default):
+    '''
+    get_measures from StreamingMeasures histograms: (auroc, aupr, fpr, auroc_error)
+    '''
+    accumulator = StreamingMeasures(num_bins, score_range)
+    accumulator.update(_pos, True)
+    accumulator.update(_neg, False)
+    measures = accumulator.measures((recall_level,))
+    return measures['auroc'], measures['aupr_in'], measures['fpr'][recall_level], measures['auroc_error']
@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+
+def dataset_arrays(dataset):
+    '''
+    the uint8 images (N x H x W x 3) and labels of a torchvision CIFAR dataset, or of a part of one
+    (validation_dataset.PartialDataset)
+    '''
+    if hasattr(dataset, 'parent_ds'):
+        images, targets = dataset_arrays(dataset.parent_ds)
+        return images[dataset.offset:dataset.offset + len(dataset)], targets[dataset.offset:dataset.offset + len(dataset)]
+    return np.asarray(dataset.data), np.asarray(dataset.targets, dtype=np.int64)
+
+
+class TensorCIFAR(object):
+    '''
+    A whole CIFAR split held as one uint8 N x 3 x H x W tensor on device (about 150 MB for the
+    training set); share_memory puts a CPU copy in shared memory so that several processes on a
+    machine read the same pages. Batches are gathered and augmented with tensor ops by TensorLoader.
+    '''
+    def __init__(self, dataset, mean, std, device='cpu', share_memory=False):
+        images, targets = dataset_arrays(dataset)
+        self.images = torch.from_numpy(np.ascontiguousarray(images.transpose(0, 3, 1, 2))).to(device)
+        self.targets = torch.from_numpy(targets).to(device)
+        if share_memory and self.images.device.type == 'cpu':
+            self.images.share_memory_()
+            self.targets.share_memory_()
+        # normalization of the uint8 pixels: (x - 255 * mean) / (255 * std)
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(std, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class TensorLoader(object):
+    '''
+    Iterates over a TensorCIFAR in batches of (normalized float images, labels), like a DataLoader
+    with RandomHorizontalFlip, RandomCrop(size, padding) (zero padding), ToTensor and Normalize, but
+    without worker processes: the crop and the flip of a whole batch are one gather on the device.
+    sampler: optional sampler of the sample order (e.g. checkpoint.ResumableRandomSampler), instead of shuffle
+    '''
+    def __init__(self, dataset, batch_size, shuffle=False, flip=False, crop_padding=None, drop_last=False,
+                 sampler=None):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.flip = flip
+        self.crop_padding = crop_padding
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        device = self.dataset.images.device
+        n = len(self.dataset)
+        if self.sampler is not None:
+            order = torch.as_tensor(list(self.sampler), device=device)
+        else:
+            order = torch.randperm(n).to(device) if self.shuffle else torch.arange(n, device=device)
+        num_batches = len(order) // self.batch_size if self.drop_last else (len(order) + self.batch_size - 1) // self.batch_size
+        for i in range(num_batches):
+            idxs = order[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.augment(self.dataset.images[idxs]), self.dataset.targets[idxs]
+
+    def augment(self, images):
+        b, c, h, w = images.shape
+        rows = torch.arange(h, device=images.device).expand(b, h)
+        cols = torch.arange(w, device=images.device).expand(b, w)
+
+        if self.crop_padding:
+            p = self.crop_padding
+            images = torch.nn.functional.pad(images, (p, p, p, p))
+            rows = rows + torch.randint(0, 2 * p + 1, (b, 1), device=images.device)
+            cols = cols + torch.randint(0, 2 * p + 1, (b, 1), device=images.device)
+        if self.flip:
+            flipped = torch.rand(b, 1, device=images.device) < 0.5
+            cols = torch.where(flipped, cols.flip(1), cols)
+
+        if self.crop_padding or self.flip:
+            batch = torch.arange(b, device=images.device).view(b, 1, 1, 1)
+            channels = torch.arange(c, device=images.device).view(1, c, 1, 1)
+            images = images[batch, channels, rows.view(b, 1, h, 1), cols.view(b, 1, 1, w)]
+
+        return images.float().sub_(self.dataset.mean).div_(self.dataset.std)
@@ -1,58 +1,86 @@
+import os
+
 import numpy as np
 import torch
-from bisect import bisect_left
 
 
 class TinyImages(torch.utils.data.Dataset):
-
-    def __init__(self, transform=None, exclude_cifar=True):
-
-        # data_file = open('/opt/data/private/ood/data/80million/tiny_images.bin', "rb")
-        data_file = open('/data1/church/ood/data/80million/tiny_images.bin', "rb")
-
-        def load_image(idx):
-            data_file.seek(idx * 3072)
-            data = data_file.read(3072)
-            return np.fromstring(data, dtype='uint8').reshape(32, 32, 3, order="F")
-
-        self.load_image = load_image
+    '''
+    The 80 Million Tiny Images binary, memory-mapped: an image is a zero-copy 32 x 32 x 3 uint8 view
+    of the file (stored channel-major and column-major, 3072 bytes per image), and get_batch reads
+    the images of a whole batch with one gather, so reading is bounded by memory bandwidth instead of
+    one seek and read per image.
+    With exclude_cifar, index i is the i-th image that is not in CIFAR (sorted exclusion list, rank
+    mapping with searchsorted): every index is a valid outlier and no index is redrawn, so sample()
+    draws from the complement deterministically from the generator it is given.
+    The file is opened lazily in each process, so the dataset pickles cheaply into loader workers.
+    '''
+    def __init__(self, transform=None, exclude_cifar=True,
+                 root='/data1/church/ood/data/80million/tiny_images.bin',
+                 cifar_idxs_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), '80mn_cifar_idxs.txt')):
+        # root = '/opt/data/private/ood/data/80million/tiny_images.bin'
+        self.root = root
+        self.num_images = os.path.getsize(root) // 3072
+        self.memmap = None
         self.offset = 0     # offset index
 
         self.transform = transform
         self.exclude_cifar = exclude_cifar
 
+        self.cifar_idxs = np.empty(0, dtype=np.int64)
         if exclude_cifar:
-            self.cifar_idxs = []
-            with open('../utils/80mn_cifar_idxs.txt', 'r') as idxs:
-                for idx in idxs:
-                    # indices in file take the 80mn database to start at 1, hence "- 1"
-                    self.cifar_idxs.append(int(idx) - 1)
-
-            # hash table option
-            self.cifar_idxs = set(self.cifar_idxs)
-            self.in_cifar = lambda x: x in self.cifar_idxs
-
-            # bisection search option
-            # self.cifar_idxs = tuple(sorted(self.cifar_idxs))
-            #
-            # def binary_search(x, hi=len(self.cifar_idxs)):
-            #     pos = bisect_left(self.cifar_idxs, x, 0, hi)  # find insertion position
-            #     return True if pos != hi and self.cifar_idxs[pos] == x else False
-            #
-            # self.in_cifar = binary_search
+            # indices in file take the 80mn database to start at 1, hence "- 1"
+            self.cifar_idxs = np.unique(np.loadtxt(cifar_idxs_file, dtype=np.int64, ndmin=1) - 1)
+            self.cifar_idxs = self.cifar_idxs[(self.cifar_idxs >= 0) & (self.cifar_idxs < self.num_images)]
+        # the number of kept images before each excluded one
+        self.kept_before = self.cifar_idxs - np.arange(len(self.cifar_idxs))
 
-    def __getitem__(self, index):
-        index = (index + self.offset) % 79302016
+    @property
+    def data(self):
+        # N x 3 x 32 x 32, (channel, column, row); copy-on-write, so tensors built from views are writable
+        if self.memmap is None:
+            self.memmap = np.memmap(self.root, dtype=np.uint8, mode='c', shape=(self.num_images, 3, 32, 32))
+        return self.memmap
 
-        if self.exclude_cifar:
-            while self.in_cifar(index):
-                index = np.random.randint(79302017)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memmap'] = None
+        return state
 
-        img = self.load_image(index)
+    def file_index(self, index):
+        '''
+        file positions of the kept images index (int or array)
+        '''
+        index = np.asarray(index, dtype=np.int64)
+        return index + np.searchsorted(self.kept_before, index, side='right')
+
+    def get_batch(self, idxs):
+        '''
+        the uint8 images (B x 32 x 32 x 3 view) of the samples idxs, read with one gather
+        '''
+        positions = self.file_index((np.asarray(idxs, dtype=np.int64) + self.offset) % len(self))
+        return np.asarray(self.data[positions]).transpose(0, 3, 2, 1)
+
+    def sample(self, n, rng):
+        '''
+        n outliers drawn uniformly (with replacement) by the numpy Generator rng, as in get_batch
+        '''
+        return self.get_batch(rng.integers(0, len(self), n))
+
+    def __getitem__(self, index):
+        index = (index + self.offset) % len(self)
+        img = np.asarray(self.data[int(self.file_index(index))]).transpose(2, 1, 0)
         if self.transform is not None:
             img = self.transform(img)
 
         return img, 0  # 0 is the class
 
+    def __getitems__(self, indices):
+        # DataLoader fetches a whole batch through here: one gather, then the per-image transform
+        images = self.get_batch(indices)
+        if self.transform is not None:
+            return [(self.transform(img), 0) for img in images]
+        return [(img, 0) for img in images]
+
     def __len__(self):
-        return 79302017
+        return self.num_images - len(self.cifar_idxs)